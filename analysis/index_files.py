@@ -1,5 +1,6 @@
 import datetime
 import glob
+import json
 import logging
 import os
 import re
@@ -204,6 +205,34 @@ def index_configs(db, force=False):
                     (camera_id, dt, rpath))
 
 
+def index_config_store(db, force=False):
+    """Index configs stored by id (content hash) in configs/store"""
+    if table_exists(db, 'config_store'):
+        if not force:
+            logging.warning("table config_store already exists, skipping")
+            return False
+        db.execute("DROP TABLE config_store;");
+    logging.info("creating config_store table")
+    # the same config can be stored by more than 1 module
+    db.execute(
+        "CREATE TABLE config_store ("
+        "config_hash TEXT PRIMARY KEY,"
+        "path TEXT"
+        ");")
+
+    modules = get_modules()
+    for module_index in modules:
+        module_path = modules[module_index]
+        config_paths = sorted(
+            glob.glob(os.path.join(module_path, 'configs/store/*.json')))
+        for config_path in config_paths:
+            rpath = os.path.relpath(config_path, data_dir)
+            config_hash = os.path.splitext(os.path.basename(rpath))[0]
+            db.execute(
+                "INSERT OR IGNORE INTO config_store (config_hash, path) "
+                "VALUES (?, ?)", (config_hash, rpath))
+
+
 def index_detections(db, force=False):
     if table_exists(db, 'detections'):
         if not force:
@@ -216,8 +245,12 @@ def index_detections(db, force=False):
         "detection_id INTEGER PRIMARY KEY,"
         "camera_id INTEGER,"
         "timestamp TIMESTAMP,"
-        "path TEXT"
+        "path TEXT,"
+        "config_hash TEXT"
         ");")
+    # join detections to config_store on config_hash
+    db.execute(
+        "CREATE INDEX detections_config_hash ON detections (config_hash);")
 
     modules = get_modules()
     cameras = get_cameras(db, by_module_mac=True)
@@ -239,9 +272,17 @@ def index_detections(db, force=False):
                 ts = '_'.join('_'.join(rpath.split(os.path.sep)[-2:]).split('_')[:-1])
                 dt = datetime.datetime.strptime(ts, '%y%m%d_%H%M%S_%f')
                 logging.debug(f"Found detection for camera {camera_id} at {dt} in file {rpath}")
+                # older detections contain the whole config (no config_id)
+                try:
+                    with open(detection_path, 'r') as f:
+                        config_hash = json.load(f)['meta'].get('config_id', None)
+                except (OSError, ValueError, KeyError) as e:
+                    # truncated/corrupt (power loss), still index the path
+                    logging.warning(f"Failed to read config_id from {rpath}: {e}")
+                    config_hash = None
                 db.execute(
-                    "INSERT INTO detections (camera_id, timestamp, path) VALUES (?, ?, ?)",
-                    (camera_id, dt, rpath))
+                    "INSERT INTO detections (camera_id, timestamp, path, config_hash) VALUES (?, ?, ?, ?)",
+                    (camera_id, dt, rpath, config_hash))
 
 
 def index_videos(db, force=False):
@@ -331,6 +372,7 @@ if __name__ == '__main__':
     with sqlite3.connect(dbfn) as db:
         index_cameras(db, force)
         index_configs(db, force)
+        index_config_store(db, force)
         index_detections(db, force)
         index_videos(db, force)
         index_stills(db, force)
@@ -19,6 +19,8 @@ The raw data is organized in a file heirarchy:
         - configs: camera config changes, a file is generated for each config change
             - <mac address>: camera mac address
                 - <YYMMDD_HHMMSS_ffffff>: timestamped config (f.. = partial second)
+            - store: each unique config (referenced by detection events)
+                - <config id>.json: config named by (hash) id
         - detections:
             - <mac address>: camera mac address
                 - <YYMMDD>: detection day
@@ -62,6 +64,10 @@ detection_fn = os.path.join(
 # import module for loading/saving json data
 import json
 
+# the module (Module[1-4]) the event is from, its configs and videos
+# are in the same module
+module = os.path.relpath(detection_fn, data_dir).split(os.sep)[0]
+
 # open the file for 'r'eading and store it in variable f
 with open(detection_fn, 'r') as f:
     # load it as json data
@@ -82,8 +88,14 @@ print("Image rois: " + str(detection_event['meta']['rois']))
 print("Detections: " + str(detection_event['meta']['detections']))
 
 # the state of the detector configuration
+# older events contain the whole config, newer events contain a 'config_id'
+# which is the name of the config in <module>/configs/store
+from pollinatorcam import config
+detector_config = config.event_config(
+    detection_event['meta'],
+    os.path.join(data_dir, module, 'configs', 'store'))
 print("Detector config:")
-print("\t" + str(detection_event['meta']['config']))
+print("\t" + str(detector_config))
 
 # the trigger state (events are saved for rising edges, falling edges and timeouts)
 print("Trigger state: " + str(detection_event['meta']['state']))
@@ -97,8 +109,7 @@ else:
     # /mnt/data/videos
     # so strip this original prefix and add our new prefix
     video_fn = os.path.join(
-        data_dir,
-        'Module1/videos/',
+        data_dir, module, 'videos',
         os.path.relpath(video_fn, '/mnt/data/videos/'))
     if not os.path.exists(video_fn):
         raise IOError(f"Failed to find detection video: {video_fn}")
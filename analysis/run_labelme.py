@@ -11,6 +11,10 @@ run_labelme.py
   -f <first hour> -l <last hour>
   -s <data source/directory>
   -D <database file path>
+  -C <cache directory> (stage images on a local disk, see stage_images.py)
+  -S <cache size in GB>
+  -w <preview width> (also make downscaled previews, 0 = no previews)
+  -n (dry run: print the annotation changes without saving them)
 
 cmd args take precedence
 
@@ -38,6 +42,8 @@ import os
 import sqlite3
 import subprocess
 
+import stage_images
+
 
 options = [
     ('camera_id', 'c', '10'),
@@ -47,6 +53,9 @@ options = [
     ('data_dir', 'D', '/media/graham/377CDC5E2ECAB822'),
     ('database_filename', 'b', 'pcam.sqlite'),
     ('tmp_dir', 't', 'tmp'),
+    ('cache_dir', 'C', ''),
+    ('cache_size', 'S', 8.0),
+    ('preview_width', 'w', 0),
 ]
 
 cfg_fn = os.path.expanduser('~/.pcam_run_labelme.json')
@@ -71,6 +80,9 @@ parser.add_argument(
 parser.add_argument(
     '-s', '--start_end_limit', default=False, action='store_true',
     help="Limit images to those between start and end tags")
+parser.add_argument(
+    '-n', '--dry_run', default=False, action='store_true',
+    help="Print a summary of annotation changes without saving them")
 
 args = parser.parse_args()
 if args.verbose:
@@ -173,6 +185,41 @@ def load_lookups_from_table(table_name):
     return table, rtable
 
 
+# annotation tables: (row id column, annotation columns)
+annotation_tables = {
+    'tags': ('annotation_id', ('tag_id', )),
+    'labels': ('annotation_id', ('label_id', 'x', 'y')),
+    'bboxes': ('bbox_id', ('label_id', 'left', 'top', 'right', 'bottom')),
+}
+
+
+def load_annotations(still_ids=None):
+    """
+    Load all tags, labels and bboxes for this camera and time range
+    (3 queries total instead of 3 per image)
+
+    Returns {still_id: {table: {annotation: [row ids]}}} where annotation
+    is a tuple of the annotation columns (e.g. (label_id, x, y) for labels)
+    if still_ids is provided, only annotations for these stills are returned
+    """
+    annotations = {}
+    for table, (row_id_column, columns) in annotation_tables.items():
+        for r in db.execute(
+                f"SELECT {row_id_column}, still_id, {', '.join(columns)} "
+                f"FROM {table} WHERE still_id IN ("
+                "SELECT still_id FROM stills WHERE "
+                "camera_id=? AND timestamp>=? AND timestamp<=?);",
+                (args.camera_id, min_time, max_time)):
+            row_id, still_id = r[:2]
+            if still_ids is not None and still_id not in still_ids:
+                continue
+            if still_id not in annotations:
+                annotations[still_id] = {t: {} for t in annotation_tables}
+            annotations[still_id][table].setdefault(
+                tuple(r[2:]), []).append(row_id)
+    return annotations
+
+
 tags, rtags = load_lookups_from_table('tag_names')
 labels, rlabels = load_lookups_from_table('label_names')
 bbox_labels, rbbox_labels = load_lookups_from_table('bbox_labels')
@@ -215,6 +262,14 @@ flags_template = {name: False for name in iter(tags.values())}
 #rlabels = {v: k for (k, v) in labels.items()}
 #rbbox_labels = {v: k for (k, v) in labels.items()}
 
+def find_stills(start, end):
+    return db.execute(
+        "SELECT * FROM stills WHERE "
+        "camera_id=? AND "
+        "timestamp>=? AND timestamp<=?;",
+        (args.camera_id, start, end))
+
+
 # get fns from database selecting for camera and time
 file_infos = []
 
@@ -222,11 +277,7 @@ file_infos = []
 if args.start_end_limit:
     found_start = False
     found_end = False
-for s in db.execute(
-        "SELECT * FROM stills WHERE "
-        "camera_id=? AND "
-        "timestamp>=? AND timestamp<=?;",
-        (args.camera_id, min_time, max_time)):
+for s in find_stills(min_time, max_time):
     still_id, args.camera_id, timestamp, path = s
     if args.start_end_limit:
         if found_end:
@@ -244,6 +295,7 @@ for s in db.execute(
                 found_end = True
     file_infos.append({
         'path': os.path.join(args.data_dir, path),
+        'rel_path': path,
         'timestamp': timestamp,
         'camera_id': args.camera_id,
         'still_id': still_id})
@@ -270,11 +322,27 @@ else:
         os.remove(os.path.join(args.tmp_dir, tfn))
 
 
+# stage images to a local cache in the background
+if len(args.cache_dir):
+    cache = stage_images.StillCache(
+        args.cache_dir, int(args.cache_size * 1e9))
+    stager = stage_images.Stager(
+        cache, args.data_dir, preview_width=args.preview_width)
+    stager.start()
+else:
+    stager = None
+stage_paths = []
+stage_links = []
+
 # symlink files to temp directory
 #ndigits = int(math.log10(len(fns)) + 1)
 ndigits = int(math.log10(len(file_infos)) + 1)
 fn_indices = {}
 previously_annotated_images = set()
+if args.resume:
+    previous_annotations = {}
+else:
+    previous_annotations = load_annotations()
 for (index, fi) in enumerate(file_infos):
     fn = fi['path']
     ts = fi['timestamp'].strftime('%y%m%d_%H%M')
@@ -289,6 +357,13 @@ for (index, fi) in enumerate(file_infos):
 
     fn_indices[tfn] = index
 
+    if stager is not None:
+        stage_paths.append(fi['rel_path'])
+        stage_links.append(os.path.join(args.tmp_dir, tfn))
+        # link directly to stills that were already staged
+        if cache.touch(fi['rel_path']):
+            fn = cache.path(fi['rel_path'])
+
     if args.resume:
         try:
             previous_image_fns.remove(tfn)
@@ -300,32 +375,20 @@ for (index, fi) in enumerate(file_infos):
 
     os.symlink(os.path.abspath(fn), os.path.join(args.tmp_dir, tfn))
 
-    previous_tags = []
-    for r in db.execute("SELECT tag_id FROM tags WHERE still_id=?", (still_id, )):
-        logging.debug(f"Found previous tag {r} for {still_id}")
+    previous = previous_annotations.get(still_id, {})
+    if still_id in previous_annotations:
+        logging.debug(f"Found previous annotations {previous} for {still_id}")
         previously_annotated_images.add(still_id)
-        previous_tags.append(tags[r[0]])
 
-    previous_labels = []
-    for r in db.execute(
-            "SELECT label_id, x, y FROM labels WHERE still_id=?", (still_id, )):
-        logging.debug(f"Found previous point {r} for {still_id}")
-        previously_annotated_images.add(still_id)
-        previous_labels.append({
-            'name': labels[r[0]],
-            'xy': (r[1], r[2]),
-        })
-
-    previous_bboxes = []
-    for r in db.execute(
-            "SELECT label_id, left, top, right, bottom FROM bboxes WHERE still_id=?",
-            (still_id, )):
-        logging.debug(f"Found previous bboxes {r} for {still_id}")
-        previously_annotated_images.add(still_id)
-        previous_bboxes.append({
-            'name': bbox_labels[r[0]],
-            'points': [[r[1], r[2]], [r[3], r[4]]],
-        })
+    previous_tags = [tags[r[0]] for r in previous.get('tags', {})]
+
+    previous_labels = [
+        {'name': labels[r[0]], 'xy': (r[1], r[2])}
+        for r in previous.get('labels', {})]
+
+    previous_bboxes = [
+        {'name': bbox_labels[r[0]], 'points': [[r[1], r[2]], [r[3], r[4]]]}
+        for r in previous.get('bboxes', {})]
 
     # write out json for any previous annotations
     if len(previous_tags) or len(previous_labels) or len(previous_bboxes):
@@ -353,6 +416,16 @@ if args.resume and len(previous_image_fns) != 0:
     print("Files in tmp that weren't in db: ", previous_image_fns)
     raise Exception("Failing to resume because not all temp files were found in db")
 
+if stager is not None:
+    # stage this day (switching links as stills are copied)
+    stager.stage(stage_paths, stage_links, pin=True)
+    # then prefetch the next day
+    next_day = day + datetime.timedelta(days=1)
+    stager.stage([
+        s[3] for s in find_stills(
+            next_day + datetime.timedelta(hours=args.first_hour),
+            next_day + datetime.timedelta(hours=args.last_hour))])
+
 # run labelme to annotate images
 # some tag and label names have spaces, will these work in command or
 # will they need to be written to a separate file?
@@ -374,95 +447,130 @@ cmd = [
     label_names,
 ]
 subprocess.check_call(cmd)
+if stager is not None:
+    stager.stop()
 
-# remove all old annotations for this camera/date
-for still_id in previously_annotated_images:
-    logging.debug(f"Removing previous annotations for {still_id}")
-    db.execute("DELETE FROM tags WHERE still_id=?", (still_id, ))
-    db.execute("DELETE FROM labels WHERE still_id=?", (still_id, ))
-    db.execute("DELETE FROM bboxes WHERE still_id=?", (still_id, ))
-
-# parse annotations
+# parse annotations: {still_id: {table: set of annotations}}
+# label and bbox names are kept as names until new names are added to the db
+new_annotations = {}
 annotation_filenames = sorted(glob.glob(os.path.join(args.tmp_dir, '*.json')))
 for afn in annotation_filenames:
     # load and parse annotation
     with open(afn, 'r') as f:
         data = json.load(f)
 
-        index = fn_indices[data["imagePath"]]
-        info = file_infos[index]
-        still_id = info['still_id']
-        logging.debug(f"Found annotations for {still_id}")
-
-        # save flags
-        flags = data['flags']
-        for flag in data["flags"]:
-            if data["flags"][flag]:
-                tag_id = rtags[flag]
-                # add flag/tag to database (if not already there)
-                if not db.execute(
-                        "SELECT tag_id FROM tags WHERE "
-                        "still_id=? AND tag_id=?", (still_id, tag_id)).fetchone():
-                    logging.debug(f"\tinserting tag {tag_id} into database")
-                    db.execute(
-                        "INSERT INTO tags (still_id, tag_id) VALUES (?, ?);",
-                        (still_id, tag_id))
-                    db.commit()
-
-        # save labels
-        for s in data['shapes']:
-            if s['shape_type'] == 'point':
-                pts = s['points']
-                assert len(pts) == 1
-                x, y = pts[0]
-                # check for new label
-                if s['label'] not in rlabels:
-                    # insert into database
-                    db.execute(
-                        'INSERT INTO label_names (name) VALUES (?);',
-                        (s['label'], ))
-                    db.commit()
-                    # reload labels
-                    labels, rlabels = load_lookups_from_table('label_names')
-                label_id = rlabels[s['label']]
-                datum = (still_id, label_id, int(x), int(y))
-                if not db.execute(
-                        "SELECT label_id FROM labels WHERE "
-                        "still_id=? AND label_id=? AND x=? AND y=?", datum).fetchone():
-                    logging.debug(f"\tinserting point{datum[1:]} into database")
-                    db.execute(
-                        "INSERT INTO labels (still_id, label_id, x, y) "
-                        "VALUES (?, ?, ?, ?);", datum)
-                    db.commit()
-            elif s['shape_type'] == 'rectangle':
-                pts = s['points']
-                assert len(pts) == 2
-                (x0, y0), (x1, y1) = pts[0], pts[1]
-                top, bottom = (y0, y1) if y0 < y1 else (y1, y0)
-                left, right = (x0, x1) if x0 < x1 else (x1, x0)
-                # check for new bbox_label
-                if s['label'] not in rbbox_labels:
-                    # insert into database
-                    db.execute(
-                        'INSERT INTO bbox_labels (name) VALUES (?);',
-                        (s['label'], ))
-                    db.commit()
-                    # reload labels
-                    bbox_labels, rbbox_labels = load_lookups_from_table('bbox_labels')
-                label_id = rbbox_labels[s['label']]
-                datum = (still_id, label_id, left, top, right, bottom)
-                if not db.execute(
-                        "SELECT bbox_id FROM bboxes WHERE "
-                        "still_id=? AND label_id=? AND left=? AND top=? "
-                        "AND right=? AND bottom=?", datum).fetchone():
-                    logging.debug(f"\tinserting bbox{datum[1:]} into database")
-                    db.execute(
-                        "INSERT INTO bboxes"
-                        "(still_id, label_id, left, top, right, bottom) "
-                        "VALUES (?, ?, ?, ?, ?, ?);", datum)
-            else:
-                logging.warning(f"\tinvalid shape type {s['shape_type']}")
-                continue
+    index = fn_indices[data["imagePath"]]
+    info = file_infos[index]
+    still_id = info['still_id']
+    logging.debug(f"Found annotations for {still_id}")
+    annotation = {t: set() for t in annotation_tables}
+    new_annotations[still_id] = annotation
+
+    # save flags
+    for flag in data["flags"]:
+        if data["flags"][flag]:
+            annotation['tags'].add((rtags[flag], ))
+
+    # save labels
+    for s in data['shapes']:
+        if s['shape_type'] == 'point':
+            pts = s['points']
+            assert len(pts) == 1
+            x, y = pts[0]
+            annotation['labels'].add((s['label'], int(x), int(y)))
+        elif s['shape_type'] == 'rectangle':
+            pts = s['points']
+            assert len(pts) == 2
+            (x0, y0), (x1, y1) = pts[0], pts[1]
+            top, bottom = (y0, y1) if y0 < y1 else (y1, y0)
+            left, right = (x0, x1) if x0 < x1 else (x1, x0)
+            annotation['bboxes'].add((s['label'], left, top, right, bottom))
+        else:
+            logging.warning(f"\tinvalid shape type {s['shape_type']}")
+            continue
+
+# all changes are written in 1 transaction (rolled back on error or dry run)
+new_names = {
+    'label_names': sorted({
+        a[0] for an in new_annotations.values()
+        for a in an['labels'] if a[0] not in rlabels}),
+    'bbox_labels': sorted({
+        a[0] for an in new_annotations.values()
+        for a in an['bboxes'] if a[0] not in rbbox_labels}),
+}
+try:
+    # add new label and bbox names, then convert names to ids
+    for table, names in new_names.items():
+        if len(names):
+            logging.debug(f"\tinserting {table} {names} into database")
+            db.executemany(
+                f'INSERT INTO {table} (name) VALUES (?);',
+                [(name, ) for name in names])
+    labels, rlabels = load_lookups_from_table('label_names')
+    bbox_labels, rbbox_labels = load_lookups_from_table('bbox_labels')
+    for annotation in new_annotations.values():
+        annotation['labels'] = {
+            (rlabels[a[0]], ) + a[1:] for a in annotation['labels']}
+        annotation['bboxes'] = {
+            (rbbox_labels[a[0]], ) + a[1:] for a in annotation['bboxes']}
+
+    # diff against existing annotations (loaded once for all stills)
+    # annotations for stills that were loaded into labelme are replaced,
+    # others (e.g. when resuming) are only added to
+    affected_still_ids = previously_annotated_images.union(new_annotations)
+    existing_annotations = load_annotations(affected_still_ids)
+    changes = {t: {'insert': [], 'delete': []} for t in annotation_tables}
+    changed_still_ids = set()
+    for still_id in affected_still_ids:
+        old = existing_annotations.get(still_id, {})
+        new = new_annotations.get(still_id, {})
+        for table in annotation_tables:
+            old_rows = old.get(table, {})
+            new_rows = new.get(table, set())
+            if still_id in previously_annotated_images:
+                for row, row_ids in old_rows.items():
+                    if row in new_rows:
+                        # keep 1 copy, remove any duplicates
+                        row_ids = row_ids[1:]
+                    changes[table]['delete'].extend(
+                        (row_id, ) for row_id in row_ids)
+                    if len(row_ids):
+                        changed_still_ids.add(still_id)
+            for row in new_rows:
+                if row not in old_rows:
+                    changes[table]['insert'].append((still_id, ) + row)
+                    changed_still_ids.add(still_id)
+
+    for table, (row_id_column, columns) in annotation_tables.items():
+        if len(changes[table]['delete']):
+            db.executemany(
+                f"DELETE FROM {table} WHERE {row_id_column}=?;",
+                changes[table]['delete'])
+        if len(changes[table]['insert']):
+            db.executemany(
+                f"INSERT INTO {table} (still_id, {', '.join(columns)}) "
+                f"VALUES (?, {', '.join('?' * len(columns))});",
+                changes[table]['insert'])
+
+    print(
+        f"{len(changed_still_ids)} of {len(file_infos)} images "
+        "have annotation changes")
+    for table, names in new_names.items():
+        if len(names):
+            print(f"\tnew {table}: {', '.join(names)}")
+    for table in annotation_tables:
+        print(
+            f"\t{table}: {len(changes[table]['insert'])} inserted, "
+            f"{len(changes[table]['delete'])} deleted")
+except Exception:
+    db.rollback()
+    raise
+
+if args.dry_run:
+    print("Dry run, not saving annotation changes")
+    db.rollback()
+    db.close()
+    raise SystemExit(0)
 
 # write annotations to disk
 db.commit()
@@ -0,0 +1,264 @@
+"""
+Stage (copy) stills from the (slow, usb) archive drive to a local cache
+directory (ssd or tmpfs) in the background so annotators don't wait on
+cold reads
+
+- stills are copied in the order they will be annotated
+- once copied, the annotation link is switched (atomically) to the cached
+  copy so labelme always sees a valid file
+- the cache has a size limit, least recently used stills are removed first
+  and stills pinned for the current annotation are never removed
+- optionally, downscaled previews are written to <cache_dir>/previews/
+- stills queued without links (e.g. the next day) are prefetched after the
+  current stills are staged
+
+used by run_labelme.py (see -C/--cache_dir)
+"""
+
+import collections
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+preview_dir = 'previews'
+partial_ext = '.partial'
+
+
+class StillCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key = path relative to cache_dir, value = bytes (with preview)
+        # ordered least recently used first
+        self.files = collections.OrderedDict()
+        self.pinned = set()
+        self.n_bytes = 0
+        self.scan()
+
+    def scan(self):
+        """Load cache contents (ordered by mtime) from a previous run"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entries = []
+        for root, dirs, fns in os.walk(self.cache_dir):
+            if root == self.cache_dir and preview_dir in dirs:
+                dirs.remove(preview_dir)
+            for fn in fns:
+                path = os.path.join(root, fn)
+                if fn.endswith(partial_ext):
+                    # left over from an interrupted copy
+                    os.remove(path)
+                    continue
+                rel = os.path.relpath(path, self.cache_dir)
+                st = os.stat(path)
+                size = st.st_size
+                ppath = self.preview_path(rel)
+                if os.path.exists(ppath):
+                    size += os.path.getsize(ppath)
+                entries.append((st.st_mtime, rel, size))
+        for _, rel, size in sorted(entries):
+            self.files[rel] = size
+            self.n_bytes += size
+        logging.info(
+            f"Found {len(self.files)} cached stills "
+            f"({self.n_bytes / 1e9:0.2f} of {self.max_bytes / 1e9:0.2f} GB)")
+
+    def path(self, rel):
+        return os.path.join(self.cache_dir, rel)
+
+    def preview_path(self, rel):
+        return os.path.join(self.cache_dir, preview_dir, rel)
+
+    def pin(self, rels):
+        with self.lock:
+            self.pinned.update(rels)
+
+    def unpin(self, rels=None):
+        with self.lock:
+            if rels is None:
+                self.pinned.clear()
+            else:
+                self.pinned.difference_update(rels)
+
+    def touch(self, rel):
+        """Mark as recently used, returns True if rel is cached"""
+        with self.lock:
+            if rel not in self.files:
+                return False
+            self.files.move_to_end(rel)
+        try:
+            os.utime(self.path(rel))
+        except OSError:
+            pass
+        return True
+
+    def reserve(self, n_bytes):
+        """Evict least recently used (unpinned) stills to make room and
+        count n_bytes as used (until add or release)
+
+        Returns False (reserving nothing) if n_bytes will not fit
+        """
+        with self.lock:
+            for rel in list(self.files):
+                if self.n_bytes + n_bytes <= self.max_bytes:
+                    break
+                if rel in self.pinned:
+                    continue
+                self._remove(rel)
+            if self.n_bytes + n_bytes > self.max_bytes:
+                return False
+            self.n_bytes += n_bytes
+            return True
+
+    def release(self, n_bytes):
+        """Return reserved bytes (if the still wasn't added)"""
+        with self.lock:
+            self.n_bytes -= n_bytes
+
+    def _remove(self, rel):
+        logging.debug(f"Evicting {rel} from cache")
+        self.n_bytes -= self.files.pop(rel)
+        for path in (self.path(rel), self.preview_path(rel)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def add(self, rel, n_bytes, reserved=0):
+        """Add a cached still of n_bytes (replacing reserved bytes)"""
+        with self.lock:
+            self.n_bytes -= reserved
+            if rel in self.files:
+                self.n_bytes -= self.files[rel]
+            self.files[rel] = n_bytes
+            self.files.move_to_end(rel)
+            self.n_bytes += n_bytes
+
+
+def make_preview(src, dst, width):
+    import cv2
+
+    im = cv2.imread(src, cv2.IMREAD_REDUCED_COLOR_2)
+    if im is None:
+        raise IOError(f"Failed to read {src}")
+    h, w = im.shape[:2]
+    if w > width:
+        im = cv2.resize(
+            im, (width, int(h * width / w)), interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode('.jpg', im)
+    if not ok:
+        raise IOError(f"Failed to encode {dst}")
+    # same suffix as other partial files so scan removes leftovers
+    tdst = dst + partial_ext
+    with open(tdst, 'wb') as f:
+        f.write(buf.tobytes())
+    os.replace(tdst, dst)
+
+
+def relink(link, target):
+    """Atomically point link at target"""
+    tmp_link = link + partial_ext
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+
+
+class Stager(threading.Thread):
+    def __init__(self, cache, data_dir, preview_width=None, *args, **kwargs):
+        kwargs['daemon'] = kwargs.get('daemon', True)
+        super(Stager, self).__init__(*args, **kwargs)
+        self.cache = cache
+        self.data_dir = data_dir
+        self.preview_width = preview_width
+        if self.preview_width:
+            # fail now (not in the thread) if previews can't be made
+            import cv2
+        self.queue = queue.Queue()
+        self.keep_running = True
+        self.stats = {'staged': 0, 'cached': 0, 'skipped': 0, 'bytes': 0}
+
+    def stage(self, rels, links=None, pin=False):
+        """Queue stills for staging
+
+        rels: still paths relative to data_dir
+        links: (optional) 1 symlink per still to switch to the cached copy
+        pin: if True, do not evict these stills (the current annotation)
+        """
+        if links is None:
+            links = [None] * len(rels)
+        assert len(links) == len(rels)
+        if pin:
+            self.cache.pin(rels)
+        self.queue.put((list(rels), list(links)))
+
+    def stage_one(self, rel, link):
+        cached = self.cache.path(rel)
+        if not self.cache.touch(rel):
+            src = os.path.join(self.data_dir, rel)
+            n_bytes = os.path.getsize(src)
+            if not self.cache.reserve(n_bytes):
+                self.stats['skipped'] += 1
+                return False
+            reserved = n_bytes
+            ppath = self.cache.preview_path(rel)
+            try:
+                d = os.path.dirname(cached)
+                if not os.path.exists(d):
+                    os.makedirs(d)
+                shutil.copyfile(src, cached + partial_ext)
+                os.replace(cached + partial_ext, cached)
+                if self.preview_width:
+                    d = os.path.dirname(ppath)
+                    if not os.path.exists(d):
+                        os.makedirs(d)
+                    make_preview(cached, ppath, self.preview_width)
+                    n_bytes += os.path.getsize(ppath)
+            except Exception:
+                # don't leave (or count) a partly staged still
+                for path in (
+                        cached + partial_ext, cached,
+                        ppath + partial_ext, ppath):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.cache.release(reserved)
+                raise
+            self.cache.add(rel, n_bytes, reserved)
+            self.stats['staged'] += 1
+            self.stats['bytes'] += n_bytes
+        else:
+            self.stats['cached'] += 1
+        if link is not None:
+            relink(link, cached)
+        return True
+
+    def run(self):
+        while self.keep_running:
+            try:
+                rels, links = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            t0 = time.monotonic()
+            n_full = 0
+            for rel, link in zip(rels, links):
+                if not self.keep_running:
+                    break
+                try:
+                    if not self.stage_one(rel, link):
+                        n_full += 1
+                except Exception as e:
+                    logging.warning(f"Failed to stage {rel}: {e}")
+            if n_full:
+                logging.warning(
+                    f"Cache full, {n_full} of {len(rels)} stills not staged")
+            logging.info(
+                f"Staged {len(rels) - n_full} of {len(rels)} stills in "
+                f"{time.monotonic() - t0:0.1f} seconds: {self.stats}")
+
+    def stop(self):
+        if self.is_alive():
+            self.keep_running = False
+            self.join()
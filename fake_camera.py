@@ -0,0 +1,289 @@
+"""
+Fake dahua camera http (cgi) api for testing dahuacam without a camera
+
+Supports digest auth and (a subset of):
+    configManager.cgi getConfig/setConfig (backed by an in-memory table)
+    global.cgi getCurrentTime/setCurrentTime
+    magicBox.cgi reboot
+    eventManager.cgi attach (multipart event stream, see send_event)
+
+Run:
+    python fake_camera.py -p 8080
+and connect with:
+    cam = dahuacam.DahuaCamera('127.0.0.1:8080', 'admin', 'admin')
+"""
+
+import argparse
+import collections
+import datetime
+import hashlib
+import http.server
+import os
+import queue
+import threading
+import urllib.parse
+import urllib.request
+
+
+realm = 'Login to fake camera'
+
+default_table = {
+    'Encode[0].MainFormat[0].Video.FPS': '20',
+    'Encode[0].SnapFormat[0].Video.FPS': '1',
+    'General.MachineName': '001f54000000',
+    'Network.eth0.PhysicalAddress': '00:1f:54:00:00:00',
+    'NAS[0].Address': '10.1.1.2',
+    'NAS[0].Enable': 'false',
+    'VideoWidget[0].ChannelTitle.EncodeBlend': 'true',
+    'VideoWidget[0].TimeTitle.EncodeBlend': 'true',
+    'MotionDetect[0].Enable': 'true',
+    'RecordStoragePoint[0].TimingSnapShot.FTP': 'false',
+    'Snap[0].HolidayEnable': 'false',
+}
+
+
+def md5(s):
+    return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+
+def parse_digest_header(header):
+    if not header.startswith('Digest '):
+        return None
+    values = {}
+    for item in urllib.request.parse_http_list(header[len('Digest '):]):
+        if '=' not in item:
+            continue
+        k, v = item.split('=', 1)
+        values[k.strip()] = v.strip().strip('"')
+    return values
+
+
+class FakeCamera:
+    def __init__(self, user='admin', password='admin', max_url_length=None):
+        self.user = user
+        self.password = password
+        self.max_url_length = max_url_length
+        self.table = dict(default_table)
+        self.nonces = set()
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'challenges': 0, 'reboots': 0}
+        # paths of recent authorized requests
+        self.paths = collections.deque(maxlen=256)
+        # status to respond with (instead of handling) and # of requests
+        self.fail_status = None
+        self.n_failures = 0
+        # 1 queue per attached event stream
+        self.event_queues = []
+
+    def send_event(self, code, action='Start', index=0, data=None):
+        """Send an event to all attached event streams"""
+        text = 'Code=%s;action=%s;index=%s' % (code, action, index)
+        if data is not None:
+            text += ';data=%s' % data
+        with self.lock:
+            for q in self.event_queues:
+                q.put(text)
+
+    def fail_next(self, status=503, n=1):
+        """Respond to the next n (authorized) requests with status"""
+        with self.lock:
+            self.fail_status = status
+            self.n_failures = n
+
+    def take_failure(self):
+        """Returns status if the request should fail (else None)"""
+        with self.lock:
+            if self.n_failures <= 0:
+                return None
+            self.n_failures -= 1
+            return self.fail_status
+
+    def drop_streams(self):
+        """Close all attached event streams (like a camera reboot)"""
+        with self.lock:
+            for q in self.event_queues:
+                q.put(None)
+
+    def attach(self):
+        q = queue.Queue()
+        with self.lock:
+            self.event_queues.append(q)
+        return q
+
+    def detach(self, q):
+        with self.lock:
+            self.event_queues.remove(q)
+
+    def new_nonce(self):
+        nonce = os.urandom(16).hex()
+        with self.lock:
+            self.nonces.add(nonce)
+            self.stats['challenges'] += 1
+        return nonce
+
+    def check_auth(self, method, header):
+        values = parse_digest_header(header or '')
+        if values is None:
+            return False
+        if values.get('username') != self.user:
+            return False
+        if values.get('nonce') not in self.nonces:
+            return False
+        ha1 = md5('%s:%s:%s' % (self.user, realm, self.password))
+        ha2 = md5('%s:%s' % (method, values.get('uri', '')))
+        if values.get('qop') == 'auth':
+            expected = md5(':'.join((
+                ha1, values['nonce'], values.get('nc', ''),
+                values.get('cnonce', ''), 'auth', ha2)))
+        else:
+            expected = md5('%s:%s:%s' % (ha1, values['nonce'], ha2))
+        return values.get('response') == expected
+
+    def get_config(self, name):
+        lines = [
+            'table.%s=%s' % (k, v) for (k, v) in sorted(self.table.items())
+            if k == name or k.startswith(name + '.') or
+            k.startswith(name + '[')]
+        if not len(lines):
+            return 400, 'Error\r\nBad Request!\r\n'
+        return 200, '\r\n'.join(lines) + '\r\n'
+
+    def handle(self, path, query):
+        cgi = path.split('/')[-1]
+        action = query.pop('action', [''])[0]
+        if cgi == 'configManager.cgi':
+            if action == 'getConfig':
+                return self.get_config(query.get('name', [''])[0])
+            if action == 'setConfig':
+                with self.lock:
+                    for k, vs in query.items():
+                        self.table[k] = vs[0]
+                return 200, 'OK\r\n'
+        elif cgi == 'global.cgi':
+            if action == 'getCurrentTime':
+                return 200, 'result=%s\r\n' % (
+                    datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            if action == 'setCurrentTime':
+                return 200, 'OK\r\n'
+        elif cgi == 'magicBox.cgi':
+            if action == 'reboot':
+                self.stats['reboots'] += 1
+                return 200, 'OK\r\n'
+        return 400, 'Error\r\nBad Request!\r\n'
+
+
+class FakeCameraHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_text(self, code, text, headers=None):
+        body = text.encode('ascii')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_part(self, text):
+        body = text.encode('ascii')
+        self.wfile.write(
+            b'--myboundary\r\nContent-Type: text/plain\r\n'
+            b'Content-Length: ' + str(len(body)).encode('ascii') +
+            b'\r\n\r\n' + body + b'\r\n\r\n')
+        self.wfile.flush()
+
+    def stream_events(self, query):
+        camera = self.server.camera
+        heartbeat = float(query.get('heartbeat', ['5'])[0])
+        # no content length, the stream ends when the connection closes
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header(
+            'Content-Type', 'multipart/x-mixed-replace; boundary=myboundary')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        q = camera.attach()
+        try:
+            while True:
+                try:
+                    text = q.get(timeout=heartbeat)
+                except queue.Empty:
+                    text = 'Heartbeat'
+                if text is None:  # dropped (see drop_streams)
+                    break
+                self.send_part(text)
+        except OSError:  # client disconnected
+            pass
+        finally:
+            camera.detach(q)
+
+    def do_GET(self):
+        camera = self.server.camera
+        with camera.lock:
+            camera.stats['requests'] += 1
+        if not camera.check_auth('GET', self.headers.get('Authorization')):
+            self.send_text(401, 'Error\r\nUnauthorized\r\n', {
+                'WWW-Authenticate': (
+                    'Digest realm="%s", qop="auth", nonce="%s", '
+                    'opaque=""' % (realm, camera.new_nonce())),
+            })
+            return
+        if (
+                camera.max_url_length is not None and
+                len(self.path) > camera.max_url_length):
+            self.send_text(414, 'Error\r\nURI Too Long\r\n')
+            return
+        camera.paths.append(self.path)
+        status = camera.take_failure()
+        if status is not None:
+            self.send_text(status, 'Error\r\nService Unavailable\r\n')
+            return
+        url = urllib.parse.urlsplit(self.path)
+        # keep_blank_values so settings can be cleared
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        if (
+                url.path.endswith('eventManager.cgi') and
+                query.get('action') == ['attach']):
+            return self.stream_events(query)
+        code, text = camera.handle(url.path, query)
+        self.send_text(code, text)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(FakeCameraHandler, self).log_message(format, *args)
+
+
+def serve(
+        host='127.0.0.1', port=8080, camera=None, verbose=False,
+        in_thread=False):
+    """Start a fake camera server, returns server
+
+    if in_thread, the server runs in a (daemon) thread, stop it with
+    server.shutdown()
+    """
+    if camera is None:
+        camera = FakeCamera()
+    server = http.server.ThreadingHTTPServer((host, port), FakeCameraHandler)
+    server.daemon_threads = True
+    server.camera = camera
+    server.verbose = verbose
+    if in_thread:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-m', '--max_url_length', type=int, default=None)
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('-P', '--password', default='admin')
+    parser.add_argument('-u', '--user', default='admin')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    camera = FakeCamera(args.user, args.password, args.max_url_length)
+    print("Serving fake camera on %s:%s" % (args.host, args.port))
+    serve(args.host, args.port, camera, args.verbose)
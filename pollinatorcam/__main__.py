@@ -2,7 +2,9 @@ import sys
 
 from . import dahuacam
 from . import discover
+from . import fleet
 from . import grabber
+from . import retention
 from . import ui
 
 
@@ -14,6 +16,12 @@ if __name__ == '__main__':
         elif sys.argv[1] == 'configure':
             sys.argv.pop(1)
             dahuacam.cmdline_run()
+        elif sys.argv[1] == 'fleet':
+            sys.argv.pop(1)
+            fleet.cmdline_run()
+        elif sys.argv[1] == 'retention':
+            sys.argv.pop(1)
+            retention.cmdline_run()
         elif sys.argv[1] == 'ui':
             sys.argv.pop(1)
             ui.cmdline_run()
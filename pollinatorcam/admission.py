@@ -0,0 +1,146 @@
+"""
+Admit (or limit) triggered recordings based on disk space
+
+Disk free space is sampled (at most every check_interval seconds) to
+estimate how fast the disk is filling (all cameras and anything else
+writing to it) and so the time until it is full. Bytes written by this
+camera's recordings are also tracked.
+
+As the predicted time to full shrinks recordings are limited:
+- normal: recording config is used as is
+- limited: duty_cycle and max_time are scaled down (by time to full /
+  target_hours, no lower than min_scale)
+- snapshot: no videos are recorded (camera snapshots continue)
+
+Each decision is a dict (see Admission.check) that is added to the
+trigger meta (and so saved with detections).
+"""
+
+import logging
+import os
+import shutil
+import time
+
+
+# seconds between disk space checks
+check_interval = 60.0
+# below this free fraction of the disk, only snapshots are saved
+snapshot_free = 0.02
+# below this many hours until full, only snapshots are saved
+snapshot_hours = 1.0
+# below this many hours until full, recordings are limited
+target_hours = 48.0
+# smallest scale of duty_cycle and max_time when limited
+min_scale = 0.1
+# weight of each new sample in the (exponential) fill rate average
+rate_weight = 0.2
+
+
+class Admission:
+    def __init__(self, directory, name=None):
+        self.directory = directory
+        self.name = name
+        self.last_check = None
+        self.last_free = None
+        # bytes/second the disk is filling (None until 2 checks)
+        self.fill_rate = None
+        self.usage = None
+        # recordings that may still be written to (sized at each check)
+        self.pending = {}
+        self.bytes_written = 0
+        self.decision = None
+
+    def add_recording(self, filename):
+        """Track bytes written to a (finished or in progress) recording"""
+        if filename is not None:
+            self.pending[filename] = self.pending.get(filename, 0)
+
+    def update_bytes_written(self):
+        for fn in list(self.pending):
+            try:
+                size = os.path.getsize(fn)
+            except OSError:  # recording moved or removed
+                del self.pending[fn]
+                continue
+            self.bytes_written += size - self.pending[fn]
+            self.pending[fn] = size
+        # only keep the most recent recordings (older ones are finished)
+        for fn in sorted(self.pending)[:-2]:
+            del self.pending[fn]
+
+    def update_fill_rate(self, t):
+        self.usage = shutil.disk_usage(self.directory)
+        free = self.usage.free
+        if self.last_free is not None and t > self.last_check:
+            rate = (self.last_free - free) / (t - self.last_check)
+            if self.fill_rate is None:
+                self.fill_rate = rate
+            else:
+                self.fill_rate += rate_weight * (rate - self.fill_rate)
+        self.last_free = free
+        self.last_check = t
+
+    def time_to_full(self):
+        """Seconds until the disk is full (None if not filling)"""
+        if self.fill_rate is None or self.fill_rate <= 0:
+            return None
+        return self.usage.free / self.fill_rate
+
+    def check(self, duty_cycle, max_time, min_time=0., force=False):
+        """Decide if (and how) a recording can be started
+
+        duty_cycle, max_time and min_time are the configured limits,
+        returns dict with
+        - level: 'normal', 'limited' or 'snapshot'
+        - admit: True if a video can be recorded
+        - duty_cycle, max_time: limits to use
+        - free: free bytes on disk
+        - time_to_full: predicted seconds until full (None if not filling)
+        - bytes_written: bytes of video recorded (by this camera)
+        """
+        t = time.monotonic()
+        if (
+                force or self.last_check is None or
+                t - self.last_check >= check_interval):
+            try:
+                self.update_fill_rate(t)
+                self.update_bytes_written()
+            except OSError as e:
+                logging.warning("Failed to check disk usage: %s", e)
+        if self.usage is None:
+            # disk usage unknown, don't limit
+            return {
+                'level': 'normal', 'admit': True,
+                'duty_cycle': duty_cycle, 'max_time': max_time,
+                'free': None, 'time_to_full': None,
+                'bytes_written': self.bytes_written,
+            }
+
+        ttf = self.time_to_full()
+        level = 'normal'
+        scale = 1.0
+        if (
+                self.usage.free < self.usage.total * snapshot_free or
+                (ttf is not None and ttf < snapshot_hours * 3600.)):
+            level = 'snapshot'
+            scale = min_scale
+        elif ttf is not None and ttf < target_hours * 3600.:
+            level = 'limited'
+            scale = max(min_scale, ttf / (target_hours * 3600.))
+        decision = {
+            'level': level,
+            'admit': level != 'snapshot',
+            'duty_cycle': duty_cycle * scale,
+            'max_time': max(min_time, max_time * scale),
+            'free': self.usage.free,
+            'time_to_full': ttf,
+            'bytes_written': self.bytes_written,
+        }
+        if self.decision is None or level != self.decision['level']:
+            logging.info(
+                "Recording admission [%s] changed to %s: "
+                "%0.1f GB free, %s hours to full",
+                self.name, level, self.usage.free / 1e9,
+                'n/a' if ttf is None else '%0.1f' % (ttf / 3600.))
+        self.decision = decision
+        return decision
@@ -0,0 +1,106 @@
+"""
+Clocks with timers for time based state machines (see trigger.Trigger)
+
+MonotonicClock uses time.monotonic and runs timer callbacks in a
+(single) scheduler thread.
+SimulatedClock only moves when advanced and runs timer callbacks
+(in order) as it passes them, so code using it can be run in simulated
+time (much faster than real time, and deterministic).
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class Timer:
+    def __init__(self, t, callback):
+        self.t = t
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        if not self.cancelled:
+            self.callback()
+
+
+class MonotonicClock:
+    """time.monotonic clock, timers are run (in order) by 1 scheduler
+    thread (started on the first call_at)"""
+    def __init__(self):
+        self.timers = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def time(self):
+        return time.monotonic()
+
+    def call_at(self, t, callback):
+        """Call callback (in the scheduler thread) at time t, returns Timer
+        """
+        timer = Timer(t, callback)
+        with self.condition:
+            heapq.heappush(self.timers, (t, next(self.counter), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return timer
+
+    def next_timer(self):
+        """Wait for (and remove) the next due timer"""
+        with self.condition:
+            while True:
+                # drop cancelled timers
+                while len(self.timers) and self.timers[0][2].cancelled:
+                    heapq.heappop(self.timers)
+                if not len(self.timers):
+                    self.condition.wait()
+                    continue
+                dt = self.timers[0][0] - self.time()
+                if dt <= 0:
+                    return heapq.heappop(self.timers)[2]
+                self.condition.wait(dt)
+
+    def run(self):
+        while True:
+            timer = self.next_timer()
+            try:
+                timer.fire()
+            except Exception as e:
+                logging.error("Timer callback failed: %s", e)
+
+
+class SimulatedClock:
+    def __init__(self, t=0.0):
+        self.t = t
+        self.timers = []
+        # break ties by scheduling order
+        self.counter = itertools.count()
+
+    def time(self):
+        return self.t
+
+    def call_at(self, t, callback):
+        """Call callback when the clock is advanced to t, returns Timer"""
+        timer = Timer(t, callback)
+        heapq.heappush(self.timers, (t, next(self.counter), timer))
+        return timer
+
+    def advance(self, dt):
+        """Move time forward dt seconds, running any timers due"""
+        target = self.t + dt
+        while len(self.timers) and self.timers[0][0] <= target:
+            t, _, timer = heapq.heappop(self.timers)
+            self.t = max(self.t, t)
+            timer.fire()
+        self.t = target
+
+
+default_clock = MonotonicClock()
@@ -16,6 +16,8 @@ Might also be used for discovery with
 - likely cameras (that aren't configured)
 """
 
+import functools
+import hashlib
 import json
 import logging
 import os
@@ -26,6 +28,10 @@ static_cfg_dir = os.path.expanduser('~/.pcam/')
 working_cfg_dir = '/dev/shm/pcam/'  # should be on a tmpfs
 
 
+# number of hex digits of the config hash used as config id
+config_id_length = 16
+
+
 class ConfigLoadError(Exception):
     pass
 
@@ -71,5 +77,59 @@ def save_config(config, name, static=False):
     if not os.path.exists(dn):
         logging.debug("Making directory for config: %s", fn)
         os.makedirs(dn)
-    with open(fn, 'w') as f:
+    # write to a temporary file and rename so readers never see
+    # a partially written config
+    tfn = fn + '.tmp'
+    with open(tfn, 'w') as f:
         json.dump(config, f)
+    os.replace(tfn, fn)
+
+
+def config_id(config):
+    """Content hash of a config (same config = same id)"""
+    b = json.dumps(config, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.sha1(b).hexdigest()[:config_id_length]
+
+
+def store_config(config, store_dir):
+    """Save config by id in store_dir (if not already stored), returns id
+
+    Detection events refer to configs by this id, see resolve_config
+    """
+    cid = config_id(config)
+    fn = os.path.join(store_dir, cid + '.json')
+    if os.path.exists(fn):
+        return cid
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    tfn = fn + '.tmp'
+    with open(tfn, 'w') as f:
+        json.dump(config, f)
+    os.replace(tfn, fn)
+    logging.debug("Stored config %s in %s", cid, store_dir)
+    return cid
+
+
+@functools.lru_cache(maxsize=256)
+def _load_stored_config(cid, store_dir):
+    fn = os.path.join(store_dir, cid + '.json')
+    if not os.path.exists(fn):
+        raise ConfigLoadError("Config %s not found in %s" % (cid, store_dir))
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+
+def resolve_config(cid, store_dir):
+    """Load a stored config by id (loaded configs are cached, do not
+    modify the returned config)"""
+    return _load_stored_config(cid, os.path.abspath(store_dir))
+
+
+def event_config(meta, store_dir):
+    """Return config for a detection event meta
+
+    older events contain the full config, newer events a config_id
+    """
+    if 'config' in meta:
+        return meta['config']
+    return resolve_config(meta['config_id'], store_dir)
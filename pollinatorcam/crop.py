@@ -0,0 +1,202 @@
+"""
+Crop rois from camera frames, resize and convert (BGR to RGB) to model input
+
+The crop plan is computed once per frame size/rois/model input (see
+CropEngine) so each analyzed frame only:
+- resizes (INTER_AREA) each roi straight from the BGR frame (no copy of
+  the frame or the roi)
+- converts the small resized roi to RGB into a preallocated
+  (n_rois, height, width, 3) output buffer
+
+Rois of the same size that overlap (and line up on the resized pixel grid,
+so the result is identical) are resized once as their union and sliced, so
+overlapping pixels are only resized once.
+
+Run this module to benchmark against cropping a RGB (strided) view:
+    python -m pollinatorcam.crop
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy
+
+
+class CropEngine:
+    def __init__(self, image_shape, coords, input_shape, out=None):
+        """
+        image_shape: (height, width[, 3]) of camera frames
+        coords: [(top, bottom, left, right), ...] for each roi
+        input_shape: (height, width) of model input
+        out: optional (n_rois, height, width, 3) uint8 output buffer
+        """
+        self.image_shape = tuple(image_shape[:2])
+        self.coords = list(coords)
+        th, tw = input_shape
+        self.input_shape = (th, tw)
+        if out is None:
+            out = numpy.empty((len(self.coords), th, tw, 3), dtype='uint8')
+        assert out.shape == (len(self.coords), th, tw, 3)
+        self.out = out
+        self.plans = []
+        self.build_plans()
+
+    def build_plans(self):
+        """Group same sized rois that overlap so they share a resize
+
+        each plan is (union coords, resized shape,
+                      [(roi index, row offset, column offset), ...])
+        """
+        th, tw = self.input_shape
+        h, w = self.image_shape
+        by_size = {}
+        for i, (t, b, l, r) in enumerate(self.coords):
+            assert 0 <= t < b <= h and 0 <= l < r <= w
+            by_size.setdefault((b - t, r - l), []).append(i)
+        for (rh, rw), indices in sorted(by_size.items()):
+            groups = []
+            for i in indices:
+                t, b, l, r = self.coords[i]
+                # merge into the first group where sharing a resize
+                # is cheaper than resizing separately
+                for g in groups:
+                    ut, ub, ul, ur = g[0]
+                    # offsets must be whole resized pixels
+                    if (t - ut) * th % rh or (l - ul) * tw % rw:
+                        continue
+                    nt, nb = min(t, ut), max(b, ub)
+                    nl, nr = min(l, ul), max(r, ur)
+                    separate = (ub - ut) * (ur - ul) + rh * rw
+                    if (nb - nt) * (nr - nl) < separate:
+                        g[0] = (nt, nb, nl, nr)
+                        g[1].append(i)
+                        break
+                else:
+                    groups.append([(t, b, l, r), [i]])
+            for (ut, ub, ul, ur), members in groups:
+                if len(members) == 1:
+                    self.plans.append(((ut, ub, ul, ur), (th, tw), [
+                        (members[0], 0, 0)]))
+                    continue
+                uh = (ub - ut) * th // rh
+                uw = (ur - ul) * tw // rw
+                offsets = []
+                for i in members:
+                    t, _, l, _ = self.coords[i]
+                    offsets.append((
+                        i, (t - ut) * th // rh, (l - ul) * tw // rw))
+                self.plans.append(((ut, ub, ul, ur), (uh, uw), offsets))
+        # preallocate resize buffers
+        self.buffers = [
+            numpy.empty((p[1][0], p[1][1], 3), dtype='uint8')
+            for p in self.plans]
+
+        # roi index: (buffer, row offset, column offset)
+        self.sources = {}
+        for plan, buf in zip(self.plans, self.buffers):
+            for i, oy, ox in plan[2]:
+                self.sources[i] = (buf, oy, ox)
+
+    def resize(self, image):
+        """Resize all rois of a BGR frame (see convert)"""
+        assert image.shape[:2] == self.image_shape
+        for plan, buf in zip(self.plans, self.buffers):
+            (t, b, l, r), (rh, rw), offsets = plan
+            # roi is a (positive strided) view, cv2 reads it in place
+            cv2.resize(
+                image[t:b, l:r], (rw, rh), dst=buf,
+                interpolation=cv2.INTER_AREA)
+
+    def convert(self, index):
+        """Convert resized roi index to RGB into out[index], returns it"""
+        th, tw = self.input_shape
+        buf, oy, ox = self.sources[index]
+        dst = self.out[index]
+        cv2.cvtColor(
+            buf[oy:oy + th, ox:ox + tw], cv2.COLOR_BGR2RGB, dst=dst)
+        return dst
+
+    def __call__(self, image):
+        """Crop/resize/convert a BGR frame, returns out (RGB)"""
+        self.resize(image)
+        for i in range(len(self.coords)):
+            self.convert(i)
+        return self.out
+
+
+def crop_rgb_view(image, coords, input_shape):
+    """Previous crop: slice a RGB (negative strided) view and resize"""
+    th, tw = input_shape
+    rgb = image[:, :, ::-1]
+    return [
+        cv2.resize(rgb[t:b, l:r], (tw, th), interpolation=cv2.INTER_AREA)
+        for (t, b, l, r) in coords]
+
+
+def benchmark(image_shape, coords, input_shape, n=200):
+    """Returns seconds per frame for (previous crop, CropEngine) and the
+    max difference between the two"""
+    image = numpy.random.randint(
+        0, 256, size=(image_shape[0], image_shape[1], 3), dtype='uint8')
+    # smooth so area resize rounding differences are representative
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    engine = CropEngine(image.shape, coords, input_shape)
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        old = crop_rgb_view(image, coords, input_shape)
+    old_dt = (time.perf_counter() - t0) / n
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        new = engine(image)
+    new_dt = (time.perf_counter() - t0) / n
+
+    diff = max(
+        numpy.abs(o.astype('i2') - nw.astype('i2')).max()
+        for o, nw in zip(old, new))
+    return old_dt, new_dt, diff
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-H', '--height', type=int, default=480,
+        help='frame height')
+    parser.add_argument(
+        '-n', '--n_frames', type=int, default=200,
+        help='frames to time')
+    parser.add_argument(
+        '-s', '--size', type=int, default=224,
+        help='model input size')
+    parser.add_argument(
+        '-W', '--width', type=int, default=640,
+        help='frame width')
+    args = parser.parse_args()
+
+    h, w, s = args.height, args.width, args.size
+    d = min(h, w)
+    c = (w - d) // 2
+    q = d // 2
+    cases = {
+        '1 central roi': [(0, d, c, c + d)],
+        '4 separate rois': [
+            (0, q, 0, q), (0, q, w - q, w),
+            (h - q, h, 0, q), (h - q, h, w - q, w)],
+        '3 overlapping rois': [
+            (0, q, c, c + q), (0, q, c + q // 2, c + q // 2 + q),
+            (q // 2, q // 2 + q, c, c + q)],
+    }
+    print("Frame %ix%i to %ix%i, %i frames" % (w, h, s, s, args.n_frames))
+    for name, coords in cases.items():
+        old_dt, new_dt, diff = benchmark(
+            (h, w), coords, (s, s), args.n_frames)
+        print(
+            "%s: previous %0.3f ms, engine %0.3f ms "
+            "(%0.1fx), max difference %i" % (
+                name, old_dt * 1000, new_dt * 1000, old_dt / new_dt, diff))
+
+
+if __name__ == '__main__':
+    cmdline_run()
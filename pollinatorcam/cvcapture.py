@@ -23,6 +23,8 @@ class CVCaptureThread(threading.Thread):
 
         self.timestamp = None
         self.image = None
+        # frames read (frames not taken by next_image are dropped)
+        self.n_frames = 0
         self.image_ready = threading.Condition() 
 
     def _start_cap(self):
@@ -39,8 +41,10 @@ class CVCaptureThread(threading.Thread):
             #if self.timestamp is not None:
             #    print("Frame dt:", time.time() - self.timestamp)
             self.timestamp = time.time()
-            self.image = im[:, :, ::-1]  # BGR to RGB
+            # keep BGR, crop.CropEngine converts (only) the rois to RGB
+            self.image = im
             self.error = None
+            self.n_frames += 1
             self.image_ready.notify()
 
     def run(self):
@@ -71,5 +75,10 @@ class CVCaptureThread(threading.Thread):
             self.keep_running = False
             self.join()
 
+    def release(self):
+        """Stop reading and close the stream (waits for a pending read)"""
+        self.stop()
+        self.cap.release()
+
     def __del__(self):
         self.stop()
@@ -6,10 +6,29 @@
 import argparse
 import datetime
 import os
+import re
 import urllib
 import socket
+import threading
+import time
 
 import requests
+import requests.adapters
+import urllib3.util.retry
+
+
+# seconds (connect, read) to wait for each request
+default_timeout = (3.05, 10.0)
+# connection retries (with backoff_factor * 2 ** retry second waits)
+default_retries = 3
+default_backoff_factor = 0.5
+# connections kept open to each camera
+pool_size = 4
+# longest request url the camera firmware accepts, longer
+# set_config requests are split into several requests
+max_url_length = 1024
+# seconds to reuse cached config snapshots (see get_config_snapshot)
+default_config_ttl = 300.0
 
 
 def build_camera_url(
@@ -28,23 +47,14 @@ def build_camera_url(
             subtype=subtype))
 
 
-def mac_address_to_name(cam):
-    mac = cam.get_config('Network.eth0.PhysicalAddress').strip().split('=')[1]
+def mac_address_to_name(cam, ttl=None):
+    mac = cam.get_config_value('Network.eth0.PhysicalAddress', ttl)
     return ''.join(mac.split(':'))
 
 
-def initial_configuration(c, reboot=True):
-    # TODO combine with snap config
-    # TODO pull out a 'config' structure that contains settings
-    # TODO add error checking
-    config_result = {}
-    if c.password != os.environ['PCAM_PASSWORD']:
-        r = c.set_password(os.environ['PCAM_PASSWORD'])
-        config_result['password'] = r
-
-    # set current time
-    r = c.set_current_time()
-    config_result['time'] = r
+def video_config():
+    """Desired video config as [(name, prefix, [(key, value), ...]), ...]"""
+    groups = []
 
     # extra format
     prefix = 'Encode[0].ExtraFormat[0].Video'
@@ -72,9 +82,7 @@ def initial_configuration(c, reboot=True):
         ('QualityRange', '6'),
         ('SVCTLayer', '1'),
     ]
-    r = c.set_config(config, prefix=prefix)
-    config_result['extra'] = r
-    #print("Set %s: %s" % (prefix, r))
+    groups.append(('extra', prefix, config))
 
     #table.Encode[0].ExtraFormat[0].VideoEnable=true
 
@@ -101,31 +109,117 @@ def initial_configuration(c, reboot=True):
         ('SVCTLayer', '1'),
         ('Width', '2592'),
     ]
-    r = c.set_config(config, prefix=prefix)
-    config_result['main'] = r
-    #print("Set %s: %s" % (prefix, r))
+    groups.append(('main', prefix, config))
 
     #table.Encode[0].MainFormat[0].VideoEnable=true
 
     # disable motion detection
-    r = c.set_config([
+    config = [
         ('MotionDetect[0].Enable', 'false'),
         ('MotionDetect[0].EventHandler.RecordEnable', 'false'),
-    ])
+    ]
+    groups.append(('motion', None, config))
+    return groups
 
-    # videowidget overlay
-    t = c.get_video_widget()
+
+def widget_config(widget):
+    """Desired videowidget config (all overlays off) from the current
+    videowidget config (text or parsed dict)"""
+    if isinstance(widget, str):
+        widget = parse_response(widget)
+    return [(k, 'false') for k in widget if 'EncodeBlend' in k]
+
+
+def snap_config(nas, fps=1/60.):
+    """Desired snapshot config as [(name, prefix, [(key, value), ...]), ...]
+
+    nas must contain ip, user and password
+    """
+    groups = []
+
+    # set storage location
+    # TODO RecordStoragePoint[0].TimingRecord.FTP=false
+    config = [
+        ('RecordStoragePoint[0].TimingSnapShot.FTP', 'true'),]
+    groups.append(('storagepoint', None, config))
+
+    # Encode[0].SnapFormat[0]
+    # - resolution 2592x1944
+    # - quality 5
+    # - FPS (can be fractional)
+    prefix = 'Encode[0].SnapFormat[0].Video'
+    config = [
+        ('resolution', '2592x1944'),
+        ('Quality', '5'),
+        ('FPS', str(fps)),
+    ]
+    groups.append(('encode', prefix, config))
+
+    # Snap[0]:
+    # - HolidayEnable=true
+    # - TimeSection[0-6][0]=1 00:00:00-23:59:59
+    prefix = 'Snap[0]'
+    config = [('HolidayEnable', 'true')]
+    key_bs = 'TimeSection[{}][{}]'
+    value_bs = '{} 00:00:00-23:59:59'
+    for ts in range(8):
+        #for dow in range(6):
+        for dow in range(1):  # not allowed to set anything other than 0
+            k = key_bs.format(ts, dow)
+            v = value_bs.format(int(dow == 0))
+            config.append((k, v))
+    groups.append(('snap', prefix, config))
+
+    # NAS[0]:
+    # - Address=<NAS IP>
+    # - Enable=true
+    # - UserName=<user>
+    # - Password=<password>
+    prefix = 'NAS[0]'
+    config = [
+        ('Address', nas['ip']),
+        ('UserName', nas['user']),
+        ('Password', nas['password']),
+        ('Directory', str(nas.get('directory', ' '))),
+        ('Enable', str(nas.get('enable', False)).lower()),
+    ]
+    groups.append(('nas', prefix, config))
+    return groups
+
+
+def flatten_config(groups):
+    """Convert config groups to [(full key, value), ...]"""
     config = []
-    for l in t.splitlines():
-        if 'EncodeBlend' in l:
-            k = '.'.join(l.split('.')[1:]).split('=')[0]
-            config.append((k, 'false'))
-    r = c.set_config(config)
+    for _, prefix, group in groups:
+        for k, v in group:
+            if prefix is not None:
+                k = '.'.join((prefix, k))
+            config.append((k, v))
+    return config
+
+
+def initial_configuration(c, reboot=True):
+    # TODO combine with snap config
+    # TODO add error checking
+    config_result = {}
+    if c.password != os.environ['PCAM_PASSWORD']:
+        r = c.set_password(os.environ['PCAM_PASSWORD'])
+        config_result['password'] = r
+
+    # set current time
+    r = c.set_current_time()
+    config_result['time'] = r
+
+    for name, prefix, config in video_config():
+        r = c.set_config(config, prefix=prefix)
+        config_result[name] = r
+
+    # videowidget overlay
+    r = c.set_config(widget_config(c.get_video_widget()))
     config_result['widget'] = r
 
     # set name to mac address
-    mac = c.get_config('Network.eth0.PhysicalAddress').strip().split('=')[1]
-    name = ''.join(mac.split(':'))
+    name = mac_address_to_name(c)
     r = c.set_config([('General.MachineName', name),])
     config_result['name'] = r
 
@@ -167,7 +261,8 @@ def set_continuous_video():
     pass
 
 
-def set_snap_config(c, nas=None, fps=1/60.):
+def fill_nas_config(c, nas=None):
+    """Fill in missing nas ip (this host), user and password (from env)"""
     if nas is None:
         nas = {'user': 'ipcam', 'enable': True}
     if 'ip' not in nas:
@@ -178,6 +273,11 @@ def set_snap_config(c, nas=None, fps=1/60.):
         nas['password'] = os.environ['PCAM_NAS_PASSWORD']
     for k in ('ip', 'user', 'password'):
         assert k in nas, "nas config missing %s" % k
+    return nas
+
+
+def set_snap_config(c, nas=None, fps=1/60.):
+    nas = fill_nas_config(c, nas)
 
     config_result = {}
 
@@ -185,56 +285,9 @@ def set_snap_config(c, nas=None, fps=1/60.):
     r = c.set_current_time()
     config_result['time'] = r
 
-    # set storage location
-    # TODO RecordStoragePoint[0].TimingRecord.FTP=false
-    r = c.set_config([
-        ('RecordStoragePoint[0].TimingSnapShot.FTP', 'true'),])
-    config_result['storagepoint'] = r
-
-    # Encode[0].SnapFormat[0]
-    # - resolution 2592x1944
-    # - quality 5
-    # - FPS (can be fractional)
-    prefix = 'Encode[0].SnapFormat[0].Video'
-    config = [
-        ('resolution', '2592x1944'),
-        ('Quality', '5'),
-        ('FPS', str(fps)),
-    ]
-    r = c.set_config(config, prefix=prefix)
-    config_result['encode'] = r
-
-    # Snap[0]:
-    # - HolidayEnable=true
-    # - TimeSection[0-6][0]=1 00:00:00-23:59:59
-    prefix = 'Snap[0]'
-    config = [('HolidayEnable', 'true')]
-    key_bs = 'TimeSection[{}][{}]'
-    value_bs = '{}%2000:00:00-23:59:59'
-    for ts in range(8):
-        #for dow in range(6):
-        for dow in range(1):  # not allowed to set anything other than 0
-            k = key_bs.format(ts, dow)
-            v = value_bs.format(int(dow == 0))
-            config.append((k, v))
-    r = c.set_config(config, prefix=prefix)
-    config_result['snap'] = r
-
-    # NAS[0]:
-    # - Address=<NAS IP>
-    # - Enable=true
-    # - UserName=<user>
-    # - Password=<password>
-    prefix = 'NAS[0]'
-    config = [
-        ('Address', nas['ip']),
-        ('UserName', nas['user']),
-        ('Password', nas['password']),
-        ('Directory', str(nas.get('directory', ' '))),
-        ('Enable', str(nas.get('enable', False)).lower()),
-    ]
-    r = c.set_config(config, prefix=prefix)
-    config_result['nas'] = r
+    for name, prefix, config in snap_config(nas, fps):
+        r = c.set_config(config, prefix=prefix)
+        config_result[name] = r
 
     return config_result
 
@@ -243,8 +296,132 @@ class DahuaCameraError(Exception):
     pass
 
 
+def parse_response(text):
+    """Parse key=value lines returned by the camera to a dict
+
+    'table.' prefixes are removed from keys, lines without
+    an '=' (like 'OK') are skipped
+    """
+    values = {}
+    for l in text.splitlines():
+        if '=' not in l:
+            continue
+        k, v = l.split('=', 1)
+        k = k.strip()
+        if k.startswith('table.'):
+            k = k[len('table.'):]
+        values[k] = v.strip()
+    return values
+
+
+def split_config_key(key):
+    """Split a config key into parts, 'NAS[0].Address' -> ['NAS', 0, 'Address']"""
+    parts = []
+    for name, index in re.findall(r'([^.\[\]]+)|\[(\d+)\]', key):
+        if index:
+            parts.append(int(index))
+        else:
+            parts.append(name)
+    return parts
+
+
+def config_name(key):
+    """Top level config name of a key, 'NAS[0].Address' -> 'NAS'"""
+    return split_config_key(key)[0]
+
+
+def nest_config(values):
+    """Convert flat {key: value} to nested dicts (indices are int keys)
+
+    {'NAS[0].Address': '10.1.1.2'} -> {'NAS': {0: {'Address': '10.1.1.2'}}}
+    """
+    tree = {}
+    for k, v in values.items():
+        parts = split_config_key(k)
+        node = tree
+        for p in parts[:-1]:
+            node = node.setdefault(p, {})
+        node[parts[-1]] = v
+    return tree
+
+
+def parse_config(text):
+    """Parse a getConfig response to nested dicts (see nest_config)"""
+    return nest_config(parse_response(check_response(text)))
+
+
+def check_response(text):
+    """Raise DahuaCameraError if text is an error response"""
+    if text.strip().startswith('Error'):
+        raise DahuaCameraError(text.strip())
+    return text
+
+
+def sent_url_length(url):
+    """Length of url as sent (quoted spaces, brackets, etc take 3 characters)"""
+    return len(requests.Request('GET', url).prepare().url)
+
+
+# sessions are shared between DahuaCamera instances (for the same camera
+# and user) to reuse connections, digest auth (and nonces) are shared
+# between the sessions of a camera and user
+sessions = {}
+auths = {}
+sessions_lock = threading.Lock()
+
+
+# parsed config by camera ip and top level config name, entries are
+# (time.monotonic() when read, {key: value}, nested config)
+config_cache = {}
+config_cache_lock = threading.Lock()
+
+
+def invalidate_config_cache(ip=None):
+    """Drop cached config for 1 camera (or all if ip is None)"""
+    with config_cache_lock:
+        if ip is None:
+            config_cache.clear()
+        else:
+            config_cache.pop(ip, None)
+
+
+def make_session(auth, retries, idempotent=True):
+    """Session retrying requests that were not sent (connection errors)
+
+    idempotent: also retry when the camera was temporarily unavailable
+    (a 502, 503 or 504 response). Not for requests that change the camera
+    (set_config, reboot, etc) as these might have been applied.
+    """
+    session = requests.Session()
+    session.auth = auth
+    retries = urllib3.util.retry.Retry(
+        total=retries, read=0,
+        backoff_factor=default_backoff_factor,
+        status_forcelist=(502, 503, 504) if idempotent else None)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(ip, user, password, retries=None, idempotent=True):
+    if retries is None:
+        retries = default_retries
+    key = (ip, user, password, retries, idempotent)
+    with sessions_lock:
+        if key not in sessions:
+            auth_key = (ip, user, password)
+            if auth_key not in auths:
+                auths[auth_key] = requests.auth.HTTPDigestAuth(
+                    user, password)
+            sessions[key] = make_session(
+                auths[auth_key], retries, idempotent)
+        return sessions[key]
+
+
 class DahuaCamera:
-    def __init__(self, ip, user=None, password=None):
+    def __init__(
+            self, ip, user=None, password=None, timeout=None, retries=None):
         if user is None:
             user = os.environ['PCAM_USER']
         if password is None:
@@ -252,10 +429,28 @@ class DahuaCamera:
         self.user = user
         self.password = password
         self.ip = ip
-
-        self.session = requests.Session()
-        self.session.auth = requests.auth.HTTPDigestAuth(
-            self.user, self.password)
+        # seconds [or (connect, read)] per request
+        if timeout is None:
+            timeout = default_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.max_url_length = max_url_length
+
+        self.make_sessions()
+
+    def make_sessions(self):
+        self.session = get_session(
+            self.ip, self.user, self.password, self.retries)
+        # for requests that change the camera (not retried on 50x)
+        self.set_session = get_session(
+            self.ip, self.user, self.password, self.retries, False)
+
+    def get(self, url, idempotent=True):
+        if idempotent:
+            r = self.session.get(url, timeout=self.timeout)
+        else:
+            r = self.set_session.get(url, timeout=self.timeout)
+        return r
 
     def rtsp_url(self, channel=1, subtype=0):
         return (
@@ -272,7 +467,7 @@ class DahuaCamera:
             "http://{ip}/cgi-bin/devVideoInput.cgi?"
             "action=getCaps&channel={channel}".format(
                 ip=self.ip, channel=channel))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -280,7 +475,7 @@ class DahuaCamera:
         url = (
             "http://{ip}/cgi-bin/recordManager.cgi?"
             "action=getCaps".format(ip=self.ip))
-        r = self.session.get(url)
+        r = self.get(url)
         return r.text
 
     # getConfig = get_input_options, get_config_caps, get_encode_config
@@ -291,7 +486,7 @@ class DahuaCamera:
             "action=getConfig&name={parameter}".format(
                 ip=self.ip,
                 parameter=parameter))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -300,43 +495,53 @@ class DahuaCamera:
         return self.get_config('VideoInOptions')
 
     def set_config(self, config, prefix=None):
+        """Set config [(key, value), ...] using as few requests as possible
+
+        Returns 'OK' (text) or the first error
+        """
         if prefix is None:
             add_prefix = lambda k: k
         else:
             add_prefix = lambda k: '.'.join((prefix, k))
-        url = (
+        base_url = (
             "http://{ip}/cgi-bin/configManager.cgi?"
             "action=setConfig".format(ip=self.ip))
         if len(config) == 0:
             raise ValueError("No parameters provided")
+        # split parameters into urls no longer than max_url_length
+        urls = []
+        url = base_url
         for c in config:
             assert len(c) == 2
             k, v = c
-            url += "&%s=%s" % (add_prefix(k), v)
-        #print(url)
-        r = self.session.get(url)
-        # TODO parse text, check return code
+            p = "&%s=%s" % (add_prefix(k), v)
+            if (
+                    url != base_url and
+                    sent_url_length(url + p) > self.max_url_length):
+                urls.append(url)
+                url = base_url
+            url += p
+        urls.append(url)
+        # even a failed set might have changed some values
+        invalidate_config_cache(self.ip)
+        for url in urls:
+            r = self.get(url, idempotent=False)
+            if r.text.strip() != 'OK':
+                return r.text
         return r.text
 
     def set_options(self, **kwargs):
         """Set video and audio input options or encode config"""
-        url = (
-            "http://{ip}/cgi-bin/configManager.cgi?"
-            "action=setConfig".format(ip=self.ip))
         if len(kwargs) == 0:
             raise ValueError("No parameters provided")
-        for k in kwargs:
-            v = kwargs[k]
-            url += "&%s=%s" % (k, v)
-        r = self.session.get(url)
-        # TODO parse text, check return code
+        return self.set_config(list(kwargs.items()))
 
     def get_config_caps(self):
         """Returns video and audio"""
         url = (
             "http://{ip}/cgi-bin/encode.cgi?"
             "action=getConfigCaps".format(ip=self.ip))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -357,7 +562,7 @@ class DahuaCamera:
         url = (
             "http://{ip}/cgi-bin/netApp.cgi?"
             "action=getInterfaces".format(ip=self.ip))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -365,7 +570,7 @@ class DahuaCamera:
         url = (
             "http://{ip}/cgi-bin/netApp.cgi?"
             "action=getUPnPStatus".format(ip=self.ip))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -415,7 +620,7 @@ class DahuaCamera:
         url = (
             "http://{ip}/cgi-bin/alarm.cgi?"
             "action={action}".format(ip=self.ip, action=action))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -450,7 +655,7 @@ class DahuaCamera:
             "http://{ip}/cgi-bin/eventManager.cgi?"
             "action=getEventIndexes&code={code}".format(
                 ip=self.ip, code=code))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -472,7 +677,7 @@ class DahuaCamera:
         url = (
             "http://{ip}/cgi-bin/global.cgi?"
             "action=getCurrentTime".format(ip=self.ip))
-        r = self.session.get(url)
+        r = self.get(url)
         # TODO parse text, check return code
         return r.text
 
@@ -484,7 +689,7 @@ class DahuaCamera:
         url = (
             "http://{ip}/cgi-bin/global.cgi?"
             "action=setCurrentTime&time={qs}".format(ip=self.ip, qs=qs))
-        r = self.session.get(url)
+        r = self.get(url, idempotent=False)
         # TODO parse text, check return code
         return r.text
 
@@ -498,25 +703,57 @@ class DahuaCamera:
             "pwd={new_password}&pwdOld={password}".format(
                 ip=self.ip, user=self.user,
                 new_password=password, password=self.password))
-        r = self.session.get(url)
+        r = self.get(url, idempotent=False)
         if r.ok:
             self.password = password
-            self.session.auth = requests.auth.HTTPDigestAuth(
-                self.user, self.password)
+            self.make_sessions()
         return r.text
 
     def reboot(self):
         url = (
             "http://{ip}/cgi-bin/magicBox.cgi?action=reboot".format(
                 ip=self.ip))
-        r = self.session.get(url)
+        invalidate_config_cache(self.ip)
+        r = self.get(url, idempotent=False)
         return r.text
 
-    def get_name(self):
-        r = self.get_config('General.MachineName')
-        if 'Error' in r or '=' not in r:
-            raise DahuaCameraError(r.strip())
-        return r.strip().split('=')[1]
+    def get_config_values(self, parameter):
+        """Returns parsed config as a dict of key=value
+        (raises DahuaCameraError on an error response)"""
+        return parse_response(check_response(self.get_config(parameter)))
+
+    def read_config_snapshot(self, name, ttl=None):
+        if ttl is None:
+            ttl = default_config_ttl
+        t = time.monotonic()
+        with config_cache_lock:
+            entry = config_cache.get(self.ip, {}).get(name)
+        if entry is None or t - entry[0] > ttl:
+            values = self.get_config_values(name)
+            entry = (t, values, nest_config(values))
+            with config_cache_lock:
+                config_cache.setdefault(self.ip, {})[name] = entry
+        return entry
+
+    def get_config_snapshot(self, name, ttl=None):
+        """Returns top level config name (e.g. 'NAS') as nested dicts
+
+        Snapshots are cached (for all DahuaCamera instances) for ttl seconds
+        (default_config_ttl if None, 0 to always read from the camera) and
+        are dropped by set_config and reboot.
+        """
+        return self.read_config_snapshot(name, ttl)[2]
+
+    def get_config_value(self, key, ttl=None):
+        """Returns value of key (e.g. 'NAS[0].Address') from the
+        (cached) snapshot of the key's top level config"""
+        values = self.read_config_snapshot(config_name(key), ttl)[1]
+        if key not in values:
+            raise DahuaCameraError("Missing config %s" % key)
+        return values[key]
+
+    def get_name(self, ttl=0):
+        return self.get_config_value('General.MachineName', ttl)
 
 
 def get_host_ip(ip, port=80):
@@ -617,5 +854,59 @@ def cmdline_run():
         cam.reboot()
 
 
+def test():
+    """Test requests against a fake camera (fake_camera.py in the
+    repository root, run from there)"""
+    import fake_camera
+
+    camera = fake_camera.FakeCamera()
+    server = fake_camera.serve(port=0, camera=camera, in_thread=True)
+    ip = '127.0.0.1:%i' % server.server_address[1]
+    try:
+        cam = DahuaCamera(ip, 'admin', 'admin')
+        assert cam.get_name() == '001f54000000'
+
+        # config values are cached
+        assert cam.get_config_value('NAS[0].Address') == '10.1.1.2'
+        n = camera.stats['requests']
+        assert cam.get_config_value('NAS[0].Enable') == 'false'
+        assert camera.stats['requests'] == n
+        assert 'NAS' in config_cache[ip]
+
+        # set_config is split into urls no longer than max_url_length
+        cam.max_url_length = 200
+        camera.max_url_length = 200  # longer urls fail (414)
+        cfg = [('NAS[0].Directory%i' % i, 'd' * 20) for i in range(20)]
+        camera.paths.clear()
+        assert cam.set_config(cfg).strip() == 'OK'
+        assert len(camera.paths) > 1, camera.paths
+        for path in camera.paths:
+            assert sent_url_length(
+                'http://%s%s' % (ip, path)) <= cam.max_url_length
+        for k, v in cfg:
+            assert camera.table[k] == v
+        # and drops the cached config
+        assert ip not in config_cache
+        assert cam.get_config_value('NAS[0].Directory0') == 'd' * 20
+
+        # requests that change the camera aren't retried on a 50x...
+        camera.fail_next(503)
+        n = camera.stats['requests']
+        assert cam.reboot().strip() != 'OK'
+        assert camera.stats['requests'] == n + 1
+        assert camera.stats['reboots'] == 0
+        # ...others are
+        camera.fail_next(503)
+        assert cam.get_name() == '001f54000000'
+        assert cam.reboot().strip() == 'OK'
+
+        # digest nonce is reused by all requests (and sessions)
+        assert camera.stats['challenges'] == 1, camera.stats
+    finally:
+        server.shutdown()
+        invalidate_config_cache(ip)
+    print("dahuacam test passed: %s" % (camera.stats, ))
+
+
 if __name__ == '__main__':
     cmdline_run()
@@ -20,11 +20,17 @@ when a new ip is found, check if it's a camera and add it to the config
 """
 
 import argparse
+import asyncio
+import concurrent.futures
+import ipaddress
 import json
 import logging
 import os
-import re
+import queue
+import select
+import socket
 import subprocess
+import threading
 import time
 
 from . import config
@@ -32,15 +38,38 @@ from . import dahuacam
 
 
 default_cidr = '10.1.1.0/24'
-ip_regex = re.compile(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})')
 cfg_name = 'ips.json'
 # dictionary where keys=ips, value=dict
 #   is_camera=True/False
 #   is_configured=True/False
 #   name=camera name (if a camera)
+#   mac=mac address (from arp table, None if unknown)
+#   checked=time (time.time) of last check_if_camera
 #   service={Active: True/False, UpTime: N}
 #   skip=True/False (if not present, assume false)
 
+# tcp ports to try when looking for hosts (rtsp & http)
+scan_ports = (554, 80)
+# seconds to wait for each host/port connection during a scan
+scan_timeout = 1.0
+# max number of connections to attempt at once during a scan
+scan_concurrency = 128
+# seconds (connect, read) to wait for each camera request
+probe_timeout = (3.05, 5.0)
+# max number of ips to check at once
+probe_workers = 32
+# seconds to reuse check_if_camera results for an unchanged ip & mac
+default_check_ttl = 600
+# daemon: seconds between full network scans
+full_scan_interval = 600
+# daemon: seconds between liveness checks of known cameras & new arp entries
+live_check_interval = 30
+# daemon: unit states of all services are re-read every this many cycles
+# (in between only those of started and rechecked cameras)
+service_refresh_cycles = 10
+# daemon: grabbers send camera ips here to request an immediate recheck
+recheck_socket_path = os.path.join(config.working_cfg_dir, 'discover.sock')
+
 
 def get_cameras():
     cfg = config.load_config(cfg_name, None)
@@ -51,34 +80,117 @@ def get_cameras():
         if cfg[ip]['is_camera'] and cfg[ip]['is_configured']}
 
 
-def scan_network_for_ips(cidr=None):
+async def probe_host(ip, ports, timeout, semaphore):
+    """Returns True if host responds (accepts or refuses) on any port"""
+    async with semaphore:
+        for port in ports:
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip, port), timeout)
+                writer.close()
+                return True
+            except ConnectionRefusedError:
+                # host is up, port is closed
+                return True
+            except (asyncio.TimeoutError, OSError):
+                continue
+    return False
+
+
+async def sweep_ips(ips, ports, timeout, concurrency, found):
+    """Probe all ips, calling found(ip) as each host responds"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(ip):
+        if await probe_host(ip, ports, timeout, semaphore):
+            found(ip)
+
+    await asyncio.gather(*[probe(ip) for ip in ips])
+
+
+def scan_network_for_ips(
+        cidr=None, ports=None, timeout=None, concurrency=None, macs=None):
+    """Yield ips on the network as they are found
+
+    Hosts already in the arp table (macs, read if None) are yielded first,
+    then hosts that respond to a tcp connection on any of ports (in the
+    order they respond)
+    """
     if cidr is None:
         cidr = default_cidr
-    cmd = "nmap -nsP {cidr}".format(cidr=cidr).split()
-    logging.debug("Running scan command: %s", cmd)
-    o = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
-    logging.debug("Parsing scan command output")
-    for l in o.stdout.decode('ascii').splitlines():
-        logging.debug("Parsing line: %s", l.strip())
-        ms = ip_regex.findall(l)
-        if len(ms):
-            logging.debug("Scan found ip: %s", ms[0])
-            yield ms[0]
+    if ports is None:
+        ports = scan_ports
+    if timeout is None:
+        timeout = scan_timeout
+    if concurrency is None:
+        concurrency = scan_concurrency
+    if macs is None:
+        macs = read_arp_table()
+    network = ipaddress.ip_network(cidr, strict=False)
+    found = set()
+
+    for ip in macs:
+        if ipaddress.ip_address(ip) in network:
+            logging.debug("Scan found ip in arp table: %s", ip)
+            found.add(ip)
+            yield ip
+
+    ips = [str(ip) for ip in network.hosts() if str(ip) not in found]
+    logging.debug(
+        "Scanning %i ips on ports %s [%s at once]", len(ips), ports, concurrency)
+    q = queue.Queue()
+
+    def run_sweep():
+        try:
+            asyncio.run(sweep_ips(ips, ports, timeout, concurrency, q.put))
+        except Exception as e:
+            logging.error("Network scan failed: %s", e)
+        finally:
+            q.put(None)
+
+    threading.Thread(target=run_sweep, daemon=True).start()
+    while True:
+        ip = q.get()
+        if ip is None:
+            break
+        logging.debug("Scan found ip: %s", ip)
+        yield ip
+
+
+def read_arp_table():
+    """Read kernel arp table, returns dict of key=ip, value=mac"""
+    macs = {}
+    try:
+        with open('/proc/net/arp', 'r') as f:
+            lines = f.readlines()[1:]  # skip header
+    except OSError as e:
+        logging.warning("Failed to read arp table: %s", e)
+        return macs
+    for l in lines:
+        tokens = l.split()
+        # flags 0x0 = incomplete (no mac)
+        if len(tokens) < 4 or tokens[2] == '0x0':
+            continue
+        macs[tokens[0]] = tokens[3].lower()
+    return macs
 
 
-def check_if_camera(ip):
+def check_if_camera(ip, timeout=None, config_ttl=None):
     """Check if the provided ip is a configured camera
+
+    name and mac are read from the (config_ttl second) config cache
     Returns:
         is_camera
         is_configured
         camera name
     """
     logging.debug("Checking if ip[%s] is a camera", ip)
-    dc = dahuacam.DahuaCamera(ip)
+    # don't retry, non-cameras should fail fast
+    dc = dahuacam.DahuaCamera(ip, timeout=timeout, retries=0)
     try:
-        n = dc.get_name()
+        n = dc.get_name(config_ttl)
         logging.debug("Camera returned name: %s", n)
-        mn = dahuacam.mac_address_to_name(dc)
+        mn = dahuacam.mac_address_to_name(dc, config_ttl)
         if len(n) != 12:
             logging.error("Camera name isn't 12 chars")
             return True, False, n
@@ -93,43 +205,26 @@ def check_if_camera(ip):
         return False, False, ''
 
 
-def start_camera_service(ip):
-    # compute systemd service name
-    name = 'pcam@%s' % ip
-    logging.info("Service %s not running, starting...", name)
-    # not running, try starting
-    cmd = 'sudo systemctl start %s' % name
-    o = subprocess.run(cmd.split(), check=True)
-
-
-def verify_camera_service(ip):
-    # compute systemd service name
-    name = 'pcam@%s' % ip
-    logging.debug("Checking status of %s service", name)
-
-    # check if service is running
-    cmd = 'sudo systemctl is-active %s --quiet' % name
-    logging.debug("Running %s", cmd)
-    o = subprocess.run(cmd.split())
-    logging.debug("Return code %i", o.returncode)
-    if o.returncode != 0:
-        logging.info("Service %s not running, starting...", name)
-        # not running, try starting
-        cmd = 'sudo systemctl start %s' % name
-        try:
-            o = subprocess.run(cmd.split(), check=True)
-            return True
-        except Exception as e:
-            logging.error("Failed to start service %s: %s", name, e)
-            return False
-    else:
-        return True
+def service_name(ip):
+    return 'pcam@%s' % ip
+
+
+def start_camera_services(ips):
+    """Start services for all ips with 1 systemctl call
+
+    Raises subprocess.CalledProcessError if any service failed to start
+    (other services will still be started)
+    """
+    names = [service_name(ip) for ip in ips]
+    logging.info("Services %s not running, starting...", names)
+    cmd = ['sudo', 'systemctl', 'start'] + names
+    subprocess.run(cmd, check=True)
 
 
-def verify_nas_config(ip):
+def verify_nas_config(ip, timeout=None):
     logging.debug("Checking NAS config for %s", ip)
-    dc = dahuacam.DahuaCamera(ip)
-    nas_ip = dc.get_config('NAS[0].Address').strip().split('=')[1]
+    dc = dahuacam.DahuaCamera(ip, timeout=timeout)
+    nas_ip = dc.get_config_value('NAS[0].Address')
     logging.debug("NAS host ip = %s", nas_ip)
     hip = dahuacam.get_host_ip(ip)
     if nas_ip != hip:
@@ -138,11 +233,59 @@ def verify_nas_config(ip):
             dc, {'user': 'ipcam', 'enable': True, 'ip': hip})
 
 
-def status_of_all_camera_services():
-    cmd = (
-        "sudo systemctl show "
-        "--property=Id,ActiveState,ActiveEnterTimestampMonotonic pcam@*")
-    o = subprocess.run(cmd.split(), stdout=subprocess.PIPE, check=True)
+def check_ip(ip, old=None, mac=None, ttl=None, timeout=None):
+    """Check if ip is a camera and verify the nas config of cameras
+
+    If the old result (from a previous check_cameras) is for the same
+    (known) mac and is less than ttl seconds old, it is reused instead of
+    rechecking. An ip without a known mac is always rechecked.
+
+    Returns dictionary of is_camera, is_configured, name, mac, checked
+    """
+    t = time.time()
+    if (
+            old is not None and ttl is not None and
+            'checked' in old and mac is not None and
+            old.get('mac') == mac and
+            t - old['checked'] < ttl):
+        logging.debug("Using previous check for %s[%s]", ip, mac)
+        cam = {
+            k: old[k] for k in
+            ('is_camera', 'is_configured', 'name', 'mac', 'checked')}
+    else:
+        # a forced recheck (ttl == 0) always reads from the camera
+        is_camera, is_configured, name = check_if_camera(
+            ip, timeout, 0 if ttl == 0 else None)
+        cam = {
+            'is_camera': is_camera,
+            'is_configured': is_configured,
+            'name': name,
+            'mac': mac,
+            'checked': t,
+        }
+
+    # verify nas config
+    if cam['is_camera'] and cam['is_configured']:
+        try:
+            verify_nas_config(ip, timeout)
+        except Exception as e:
+            logging.warning("Failed to verify NAS config for %s: %s", ip, e)
+    return cam
+
+
+def status_of_camera_services(ips=None):
+    """Read unit states of camera services (of ips or all if None)
+
+    Returns dict of key=ip, value={Active: True/False, Uptime: seconds}
+    """
+    if ips is None:
+        names = ['pcam@*']
+    else:
+        names = [service_name(ip) for ip in ips]
+    cmd = [
+        'sudo', 'systemctl', 'show',
+        '--property=Id,ActiveState,ActiveEnterTimestampMonotonic'] + names
+    o = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
     cams = {}
     cam_ip = None
     t = time.monotonic()
@@ -160,31 +303,97 @@ def status_of_all_camera_services():
     return cams
 
 
-def check_cameras(cidr=None):
+def update_services(cfg, start_ips):
+    """Start services for start_ips, updating service states in cfg"""
+    if not len(start_ips):
+        return
+    try:
+        start_camera_services(start_ips)
+        # all started, no need to rescan
+        for ip in start_ips:
+            cfg[ip]['service'] = {'Active': True, 'Uptime': 0.}
+    except Exception as e:
+        logging.warning("Failed to start cameras%s: %s", start_ips, e)
+        # some may have started, re-read their states
+        logging.debug("Rescanning services")
+        services = status_of_camera_services(start_ips)
+        for ip in services:
+            if ip not in cfg:
+                continue
+            cfg[ip]['service'] = services[ip]
+
+
+def check_cameras(
+        cidr=None, ttl=None, timeout=None,
+        scan_timeout=None, scan_concurrency=None, cfg=None, services=None):
+    """Scan network, check all ips and start services for found cameras
+
+    Results are saved (and returned) as the new cfg. If cfg is None
+    the last results are loaded from cfg_name. If services (see
+    status_of_camera_services) is None the unit states are read.
+    """
     # dictionary where keys=ips, value=dict
     #   is_camera=True/False
     #   is_configured=True/False
     #   name=camera name (if a camera)
+    #   mac=mac address (from arp table, None if unknown)
+    #   checked=time (time.time) of last check_if_camera
     #   service={Active: True/False, UpTime: N}
     #   skip=True/False (if not present, assume false)
-    cfg = config.load_config(cfg_name, {})
-    network_ips = list(scan_network_for_ips(cidr))
-    services = status_of_all_camera_services()
+    if ttl is None:
+        ttl = default_check_ttl
+    if timeout is None:
+        timeout = probe_timeout
+    if cfg is None:
+        cfg = config.load_config(cfg_name, {})
+    if services is None:
+        services = status_of_camera_services()
+    # read once per scan (ips found by the sweep that weren't in the
+    # table have no known mac so are rechecked)
+    macs = read_arp_table()
+
+    # check (non-blacklisted) ips as they are found by the scan
+    network_ips = []
+    futures = {}
+    t0 = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(probe_workers) as pool:
 
-    # add old cameras to network_ips
-    for ip in cfg:
-        if cfg[ip].get('skip', False):
-            continue
-        if not cfg[ip]['is_camera']:
-            continue
-        if ip not in network_ips:
+        def add_ip(ip):
+            if ip in network_ips:
+                return
             network_ips.append(ip)
+            if cfg.get(ip, {}).get('skip', False):
+                return
+            futures[pool.submit(
+                check_ip, ip, cfg.get(ip), macs.get(ip), ttl, timeout)] = ip
+
+        for ip in scan_network_for_ips(
+                cidr, timeout=scan_timeout, concurrency=scan_concurrency,
+                macs=macs):
+            add_ip(ip)
+        logging.debug(
+            "Scan finished in %0.4f seconds", time.monotonic() - t0)
+
+        # add old cameras to network_ips
+        for ip in cfg:
+            if cfg[ip].get('skip', False):
+                continue
+            if not cfg[ip]['is_camera']:
+                continue
+            add_ip(ip)
+
+        checks = {}
+        for future in concurrent.futures.as_completed(futures):
+            checks[futures[future]] = future.result()
+    logging.debug(
+        "Checked %i ips in %0.4f seconds",
+        len(checks), time.monotonic() - t0)
 
     logging.debug("Found ips: %s", network_ips)
     logging.debug("Old ips: %s", list(cfg.keys()))
     logging.debug("Service ips: %s", list(services.keys()))
-    # if we have to start a service, rescan after starting
-    rescan_services = False
+    # services to start (all started with 1 systemctl call)
+    start_ips = []
     new_cfg = {}
     # TODO error catching, save on error?
     for ip in network_ips:
@@ -193,48 +402,279 @@ def check_cameras(cidr=None):
             new_cfg[ip] = cfg[ip]
             continue
 
-        is_camera, is_configured, name = check_if_camera(ip)
-        cam = {
-            'is_camera': is_camera,
-            'is_configured': is_configured,
-            'name': name,
-        }
+        cam = checks[ip]
 
         # service running?
         cam['service'] = services.get(ip, {'Active': False, 'Uptime': 0})
 
-        # verify nas config
-        if is_camera and is_configured:
-            verify_nas_config(ip)
+        if cam['is_camera'] and cam['is_configured']:
             if not cam['service']['Active']:
-                try:
-                    start_camera_service(ip)
-                    rescan_services = True
-                except Exception as e:
-                    logging.warning("Failed to start camera[%s]: %s", ip, e)
+                start_ips.append(ip)
         new_cfg[ip] = cam
 
-    # a service was started, rescan
-    if rescan_services:
-        logging.debug("Rescanning services")
-        services = status_of_all_camera_services()
-        for ip in services:
-            if ip not in new_cfg:
-                continue
-            new_cfg[ip]['service'] = services[ip]
-
+    update_services(new_cfg, start_ips)
 
     config.save_config(new_cfg, cfg_name)
+    return new_cfg
+
+
+def request_recheck(ip):
+    """Ask a running discover daemon to recheck ip (e.g. on rtsp failure)
+
+    Returns False if no daemon is listening
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.sendto(ip.encode('ascii'), recheck_socket_path)
+        return True
+    except OSError as e:
+        logging.debug("Failed to request recheck of %s: %s", ip, e)
+        return False
+
+
+class DiscoverDaemon:
+    """Keep the camera registry (cfg_name) up to date
+
+    - every full_interval seconds: scan network and check all ips
+    - every live_interval seconds: check that known cameras respond,
+      that their services are running and check new ips in the arp table
+    - on request (see request_recheck): immediately recheck an ip
+
+    Unit states are cached between cycles (see service_states). The
+    registry is saved after every change.
+    """
+    def __init__(
+            self, cidr=None, ttl=None, full_interval=None,
+            live_interval=None, scan_timeout=None, scan_concurrency=None):
+        if cidr is None:
+            cidr = default_cidr
+        self.cidr = cidr
+        self.network = ipaddress.ip_network(cidr, strict=False)
+        self.ttl = ttl
+        if full_interval is None:
+            full_interval = full_scan_interval
+        self.full_interval = full_interval
+        if live_interval is None:
+            live_interval = live_check_interval
+        self.live_interval = live_interval
+        self.scan_timeout = scan_timeout
+        self.scan_concurrency = scan_concurrency
+
+        self.registry = config.load_config(cfg_name, {})
+        self.socket = None
+
+        # last unit states by ip: (active, time.monotonic() it started)
+        self.services = {}
+        # ips to re-read the unit state of in the next cycle
+        self.stale_services = set()
+        self.service_cycles = 0
+
+    def save(self):
+        config.save_config(self.registry, cfg_name)
+
+    def camera_ips(self):
+        return [
+            ip for ip in self.registry
+            if self.registry[ip].get('is_camera', False) and
+            self.registry[ip].get('is_configured', False) and
+            not self.registry[ip].get('skip', False)]
+
+    def open_socket(self):
+        d = os.path.dirname(recheck_socket_path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        if os.path.exists(recheck_socket_path):
+            os.remove(recheck_socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(recheck_socket_path)
+        self.socket.setblocking(False)
+
+    def close_socket(self):
+        if self.socket is None:
+            return
+        self.socket.close()
+        self.socket = None
+        if os.path.exists(recheck_socket_path):
+            os.remove(recheck_socket_path)
+
+    def read_requests(self):
+        ips = []
+        while True:
+            try:
+                data = self.socket.recv(256)
+            except BlockingIOError:
+                break
+            ip = data.decode('ascii', errors='ignore').strip()
+            try:
+                ipaddress.ip_address(ip)
+            except ValueError:
+                logging.warning("Invalid recheck request: %r", data)
+                continue
+            if ip not in ips:
+                ips.append(ip)
+        return ips
+
+    def read_services(self, ips=None):
+        """Re-read unit states (of ips or all if None) into the cache"""
+        t = time.monotonic()
+        if ips is None:
+            self.services = {}
+        for ip, s in status_of_camera_services(ips).items():
+            self.services[ip] = (s['Active'], t - s['Uptime'])
+
+    def service_states(self, ips=()):
+        """Return unit states (see status_of_camera_services)
+
+        All units are re-read every service_refresh_cycles calls, in
+        between only ips and units started since the last call.
+        """
+        ips = self.stale_services.union(ips)
+        self.stale_services = set()
+        if self.service_cycles % service_refresh_cycles == 0:
+            self.read_services()
+        elif len(ips):
+            self.read_services(sorted(ips))
+        self.service_cycles += 1
+        t = time.monotonic()
+        return {
+            ip: {'Active': active, 'Uptime': t - start}
+            for (ip, (active, start)) in self.services.items()}
+
+    def mark_started(self, services):
+        """Re-read units started since services were read (next cycle)"""
+        for ip, cam in self.registry.items():
+            s = cam.get('service', None)
+            if (
+                    s is not None and s['Active'] and
+                    not services.get(ip, {}).get('Active', False)):
+                self.stale_services.add(ip)
+
+    def full_scan(self):
+        logging.info("Running full scan of %s", self.cidr)
+        t0 = time.monotonic()
+        services = self.service_states()
+        self.registry = check_cameras(
+            self.cidr, ttl=self.ttl, scan_timeout=self.scan_timeout,
+            scan_concurrency=self.scan_concurrency, cfg=self.registry,
+            services=services)
+        self.mark_started(services)
+        logging.info(
+            "Full scan took %0.4f seconds", time.monotonic() - t0)
+
+    def recheck(self, ips):
+        """Check ips (ignoring previous checks) and start services"""
+        ips = [
+            ip for ip in ips
+            if not self.registry.get(ip, {}).get('skip', False)]
+        if not len(ips):
+            return
+        logging.info("Rechecking %s", ips)
+        macs = read_arp_table()
+        with concurrent.futures.ThreadPoolExecutor(
+                min(probe_workers, len(ips))) as pool:
+            cams = pool.map(
+                lambda ip: check_ip(
+                    ip, self.registry.get(ip), macs.get(ip), 0,
+                    probe_timeout),
+                ips)
+            cams = dict(zip(ips, cams))
+        # a recheck might be from a grabber that exited, re-read its unit
+        services = self.service_states(ips)
+        start_ips = []
+        for ip, cam in cams.items():
+            cam['service'] = services.get(ip, {'Active': False, 'Uptime': 0})
+            if (
+                    cam['is_camera'] and cam['is_configured'] and
+                    not cam['service']['Active']):
+                start_ips.append(ip)
+            self.registry[ip] = cam
+        update_services(self.registry, start_ips)
+        self.mark_started(services)
+        self.save()
+
+    def live_check(self):
+        ips = self.camera_ips()
+        alive = set()
+        if len(ips):
+            asyncio.run(sweep_ips(
+                ips, (80, ), self.scan_timeout or scan_timeout,
+                self.scan_concurrency or scan_concurrency, alive.add))
+        services = self.service_states()
+        start_ips = []
+        for ip in ips:
+            cam = self.registry[ip]
+            cam['service'] = services.get(ip, {'Active': False, 'Uptime': 0})
+            if ip not in alive:
+                logging.debug("Camera %s did not respond", ip)
+                continue
+            if not cam['service']['Active']:
+                start_ips.append(ip)
+        update_services(self.registry, start_ips)
+        self.mark_started(services)
+        self.save()
+
+        # check any new ips (in the arp table)
+        new_ips = [
+            ip for ip in read_arp_table()
+            if ip not in self.registry and
+            ipaddress.ip_address(ip) in self.network]
+        if len(new_ips):
+            self.recheck(new_ips)
+
+    def run(self):
+        self.open_socket()
+        try:
+            next_full = time.monotonic()
+            next_live = next_full + self.live_interval
+            while True:
+                t = time.monotonic()
+                try:
+                    if t >= next_full:
+                        next_full = t + self.full_interval
+                        next_live = t + self.live_interval
+                        self.full_scan()
+                    elif t >= next_live:
+                        next_live = t + self.live_interval
+                        self.live_check()
+                except Exception as e:
+                    logging.error("Discover failed: %s", e)
+                timeout = max(0., min(next_full, next_live) - time.monotonic())
+                r, _, _ = select.select([self.socket], [], [], timeout)
+                if len(r):
+                    try:
+                        self.recheck(self.read_requests())
+                    except Exception as e:
+                        logging.error("Recheck failed: %s", e)
+        finally:
+            self.close_socket()
 
 
 def cmdline_run():
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=scan_concurrency,
+        help="max number of connections at once during network scan")
+    parser.add_argument(
+        '-d', '--daemon', action='store_true',
+        help="keep running, periodically rescanning the network")
+    parser.add_argument(
+        '-f', '--full_interval', type=float, default=full_scan_interval,
+        help="daemon: seconds between full network scans")
     parser.add_argument(
         '-i', '--ips', type=str, default="",
         help="ips to scan (as cidr)")
+    parser.add_argument(
+        '-l', '--live_interval', type=float, default=live_check_interval,
+        help="daemon: seconds between camera liveness checks")
     parser.add_argument(
         '-p', '--print', action='store_true',
         help="print last discover results")
+    parser.add_argument(
+        '-t', '--ttl', type=float, default=default_check_ttl,
+        help="seconds to reuse previous camera checks (0 to always check)")
+    parser.add_argument(
+        '-T', '--timeout', type=float, default=scan_timeout,
+        help="seconds to wait for each host during network scan")
     parser.add_argument(
         '-v', '--verbose', action='store_true',
         help="enable verbose logging")
@@ -278,9 +718,22 @@ def cmdline_run():
     else:
         cidr = None
 
+    if args.daemon:
+        daemon = DiscoverDaemon(
+            cidr, ttl=args.ttl, full_interval=args.full_interval,
+            live_interval=args.live_interval, scan_timeout=args.timeout,
+            scan_concurrency=args.concurrency)
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
+        return
+
     #time running of check_cameras
     t0 = time.monotonic()
-    check_cameras(cidr)
+    check_cameras(
+        cidr, ttl=args.ttl,
+        scan_timeout=args.timeout, scan_concurrency=args.concurrency)
     t1 = time.monotonic()
     logging.debug("check_cameras took %0.4f seconds", t1 - t0)
 
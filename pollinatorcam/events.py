@@ -0,0 +1,252 @@
+"""
+Stream camera events (motion, video loss, storage errors...)
+
+Instead of polling (get_event_indices, alarm getters), keep 1 long-lived
+eventManager.cgi?action=attach request open per camera. The camera replies
+with a never-ending multipart response, 1 part per event (and a Heartbeat
+part every heartbeat seconds):
+
+    --myboundary
+    Content-Type: text/plain
+    Content-Length: 37
+
+    Code=VideoMotion;action=Start;index=0
+
+Parts are parsed as they arrive and passed to a callback. If the stream
+fails (or a heartbeat is missed) it is reconnected with backoff.
+"""
+
+import json
+import logging
+import threading
+import time
+
+
+# event codes to subscribe to
+default_codes = (
+    'VideoMotion', 'VideoLoss', 'VideoBlind',
+    'StorageFailure', 'StorageNotExist', 'StorageLowSpace')
+# seconds between heartbeats sent by the camera
+default_heartbeat = 5
+# a stream is considered dead after this many missed heartbeats
+missed_heartbeats = 3
+# seconds to wait before reconnecting (doubles after each failure)
+min_backoff = 1.0
+max_backoff = 60.0
+
+
+def parse_event(text):
+    """Parse 'Code=VideoMotion;action=Start;index=0[;data={...}]' to a dict
+
+    index is converted to an int, data (which can contain ';') to json
+    (if possible)
+    """
+    event = {}
+    data = None
+    if ';data=' in text:
+        text, data = text.split(';data=', 1)
+    for item in text.strip().split(';'):
+        if '=' not in item:
+            continue
+        k, v = item.split('=', 1)
+        event[k.strip()] = v.strip()
+    if 'index' in event:
+        try:
+            event['index'] = int(event['index'])
+        except ValueError:
+            pass
+    if data is not None:
+        try:
+            event['data'] = json.loads(data)
+        except ValueError:
+            event['data'] = data.strip()
+    return event
+
+
+def read_parts(fp):
+    """Read multipart parts (bytes) from file-like fp as they arrive
+
+    Parts with a Content-Length are read in 1 read (so the part is available
+    without waiting for the next boundary), otherwise the body is read up
+    to the next blank line.
+    """
+    while True:
+        line = fp.readline()
+        if not line:  # stream closed
+            return
+        line = line.strip()
+        if not line.startswith(b'--'):
+            # blank line or trailing data between parts
+            continue
+        if line.endswith(b'--'):  # closing boundary
+            return
+        headers = {}
+        while True:
+            line = fp.readline()
+            if not line:
+                return
+            line = line.strip()
+            if not line:
+                break
+            if b':' in line:
+                k, v = line.split(b':', 1)
+                headers[k.strip().lower()] = v.strip()
+        if b'content-length' in headers:
+            n = int(headers[b'content-length'])
+            body = fp.read(n)
+            if len(body) != n:
+                return
+        else:
+            lines = []
+            while True:
+                line = fp.readline()
+                if not line:
+                    return
+                if not line.strip():
+                    break
+                lines.append(line)
+            body = b''.join(lines)
+        yield body
+
+
+class EventStream(threading.Thread):
+    """Keep an event stream open to 1 camera, call callback(event)
+    (in this thread) for each event"""
+    def __init__(
+            self, cam, callback, codes=None, heartbeat=None,
+            *args, **kwargs):
+        kwargs['daemon'] = kwargs.get('daemon', True)
+        super(EventStream, self).__init__(*args, **kwargs)
+        self.cam = cam
+        self.callback = callback
+        if codes is None:
+            codes = default_codes
+        self.codes = codes
+        if heartbeat is None:
+            heartbeat = default_heartbeat
+        self.heartbeat = heartbeat
+        self.keep_running = True
+        self.response = None
+        self.backoff = min_backoff
+        self.stats = {'connects': 0, 'events': 0, 'heartbeats': 0}
+
+    def url(self):
+        return (
+            "http://{ip}/cgi-bin/eventManager.cgi?"
+            "action=attach&codes=[{codes}]&heartbeat={heartbeat}".format(
+                ip=self.cam.ip, codes=','.join(self.codes),
+                heartbeat=self.heartbeat))
+
+    def read_stream(self):
+        connect_timeout = self.cam.timeout
+        if isinstance(connect_timeout, (tuple, list)):
+            connect_timeout = connect_timeout[0]
+        # the read timeout catches missed heartbeats
+        r = self.cam.session.get(
+            self.url(), stream=True,
+            timeout=(connect_timeout, self.heartbeat * missed_heartbeats))
+        try:
+            r.raise_for_status()
+            self.response = r
+            self.stats['connects'] += 1
+            logging.info("Event stream connected: %s", self.cam.ip)
+            for part in read_parts(r.raw):
+                if not self.keep_running:
+                    break
+                # stream is working, reset backoff
+                self.backoff = min_backoff
+                text = part.decode('utf-8', 'replace').strip()
+                if text == 'Heartbeat':
+                    self.stats['heartbeats'] += 1
+                    continue
+                event = parse_event(text)
+                if 'Code' not in event:
+                    logging.debug("Unknown event: %r", text)
+                    continue
+                self.stats['events'] += 1
+                logging.debug("Event from %s: %s", self.cam.ip, event)
+                try:
+                    self.callback(event)
+                except Exception as e:
+                    logging.warning("Event callback failed: %s", e)
+        finally:
+            self.response = None
+            r.close()
+
+    def run(self):
+        while self.keep_running:
+            try:
+                self.read_stream()
+            except Exception as e:
+                if not self.keep_running:
+                    break
+                logging.warning("Event stream error [%s]: %s", self.cam.ip, e)
+            if not self.keep_running:
+                break
+            logging.info(
+                "Reconnecting event stream to %s in %0.1f seconds",
+                self.cam.ip, self.backoff)
+            t = time.monotonic() + self.backoff
+            while self.keep_running and time.monotonic() < t:
+                time.sleep(0.1)
+            self.backoff = min(self.backoff * 2, max_backoff)
+
+    def stop(self):
+        if self.is_alive():
+            self.keep_running = False
+            # close the stream to interrupt a blocking read
+            r = self.response
+            if r is not None:
+                r.close()
+            self.join()
+
+
+def test():
+    """Stream events from a fake camera (fake_camera.py in the
+    repository root, run from there)"""
+    import queue
+
+    import fake_camera
+    from . import dahuacam
+
+    def wait_for(f, timeout=5.0):
+        t0 = time.monotonic()
+        while not f():
+            if time.monotonic() - t0 > timeout:
+                return False
+            time.sleep(0.01)
+        return True
+
+    camera = fake_camera.FakeCamera()
+    server = fake_camera.serve(port=0, camera=camera, in_thread=True)
+    cam = dahuacam.DahuaCamera(
+        '127.0.0.1:%i' % server.server_address[1], 'admin', 'admin')
+    events = queue.Queue()
+    stream = EventStream(cam, events.put, heartbeat=1)
+    stream.start()
+    try:
+        assert wait_for(lambda: len(camera.event_queues) == 1)
+        camera.send_event('VideoMotion', 'Start')
+        camera.send_event('VideoMotion', 'Stop', data='{"Id": [0]}')
+        e = events.get(timeout=2)
+        assert e == {
+            'Code': 'VideoMotion', 'action': 'Start', 'index': 0}, e
+        e = events.get(timeout=2)
+        assert e['action'] == 'Stop' and e['data'] == {'Id': [0]}, e
+
+        # server drops the stream, it's reconnected (after backoff)
+        camera.drop_streams()
+        assert wait_for(lambda: stream.stats['connects'] == 2)
+        assert wait_for(lambda: len(camera.event_queues) == 1)
+        camera.send_event('VideoLoss', 'Start', 1)
+        e = events.get(timeout=2)
+        assert e['Code'] == 'VideoLoss' and e['index'] == 1, e
+        assert stream.stats['events'] == 3, stream.stats
+    finally:
+        stream.stop()
+        server.shutdown()
+    print("events test passed: %s" % (stream.stats, ))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,267 @@
+"""
+In memory index of files in (data) directories
+
+Listing a directory with many files (detections for a busy day) on every
+ui request is slow. DirectoryIndex lists each directory once, keeps the
+sorted file names in memory and updates them from inotify events (or, if
+inotify isn't available, re-lists a directory when its mtime changes).
+
+Directories that don't exist yet (today's detections before the first
+trigger) are listed as empty and re-listed when they are created.
+
+Each listing has a digest (xor of file name crcs) that is the same in
+every process for the same files so can be used for ETags (the ui runs
+in several uwsgi processes, each with its own index).
+"""
+
+import bisect
+import collections
+import logging
+import os
+import threading
+import zlib
+
+from . import inotify
+
+
+# number of directories to keep listed (least recently used are dropped)
+default_max_directories = 256
+
+
+def name_digest(name):
+    return zlib.crc32(name.encode('utf-8', 'replace'))
+
+
+def get_mtime(directory):
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Listing:
+    def __init__(self, names, mtime=None):
+        self.names = sorted(names)
+        self.digest = 0
+        for name in self.names:
+            self.digest ^= name_digest(name)
+        self.mtime = mtime
+
+    def add(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return
+        self.names.insert(i, name)
+        self.digest ^= name_digest(name)
+
+    def remove(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            return
+        del self.names[i]
+        self.digest ^= name_digest(name)
+
+
+class DirectoryIndex:
+    def __init__(self, max_directories=None, use_inotify=True):
+        if max_directories is None:
+            max_directories = default_max_directories
+        self.max_directories = max_directories
+        self.lock = threading.RLock()
+        # directory: Listing
+        self.listings = collections.OrderedDict()
+        # watched ancestor: set of listed directories that don't exist
+        self.missing = {}
+        self.watcher = None
+        if use_inotify:
+            try:
+                self.watcher = inotify.Watcher(self.on_event)
+                self.watcher.start()
+            except OSError as e:
+                logging.warning(
+                    "inotify not available [%s], polling directories", e)
+                self.watcher = None
+
+    def watch_missing(self, directory):
+        """Watch the closest existing ancestor of a missing directory"""
+        ancestor = directory
+        while True:
+            parent = os.path.dirname(ancestor)
+            if parent == ancestor:
+                return
+            ancestor = parent
+            if self.watcher.add_watch(ancestor):
+                break
+        self.missing.setdefault(ancestor, set()).add(directory)
+
+    def unwatch(self, directory):
+        if directory not in self.listings and directory not in self.missing:
+            self.watcher.remove_watch(directory)
+
+    def drop(self, directory):
+        self.listings.pop(directory, None)
+        if self.watcher is None:
+            return
+        for ancestor in list(self.missing):
+            self.missing[ancestor].discard(directory)
+            if not self.missing[ancestor]:
+                del self.missing[ancestor]
+                self.unwatch(ancestor)
+        self.unwatch(directory)
+
+    def load(self, directory):
+        if self.watcher is not None:
+            # watch before listing so no files are missed
+            if not self.watcher.add_watch(directory):
+                self.watch_missing(directory)
+        mtime = get_mtime(directory)
+        try:
+            names = [
+                e.name for e in os.scandir(directory) if not e.is_dir()]
+        except (FileNotFoundError, NotADirectoryError):
+            names = []
+        listing = Listing(names, mtime)
+        self.listings[directory] = listing
+        while len(self.listings) > self.max_directories:
+            self.drop(next(iter(self.listings)))
+        return listing
+
+    def get(self, directory):
+        directory = os.path.abspath(directory)
+        listing = self.listings.get(directory, None)
+        if listing is not None and self.watcher is None:
+            if get_mtime(directory) != listing.mtime:
+                listing = None
+        if listing is None:
+            return self.load(directory)
+        self.listings.move_to_end(directory)
+        return listing
+
+    def summary(self, directory, n=None):
+        """Return (count, digest, last n file names) for a directory"""
+        with self.lock:
+            listing = self.get(directory)
+            if n is None:
+                recent = list(listing.names)
+            elif n > 0:
+                recent = listing.names[-n:]
+            else:
+                recent = []
+            return len(listing.names), listing.digest, recent
+
+    def page(self, directory, offset=0, limit=None):
+        """Return (count, file names[offset:offset + limit])"""
+        with self.lock:
+            listing = self.get(directory)
+            if limit is None:
+                return len(listing.names), listing.names[offset:]
+            return len(listing.names), listing.names[offset:offset + limit]
+
+    def last(self, directory):
+        """Return the last (sorted) file name in directory or None"""
+        with self.lock:
+            names = self.get(directory).names
+            return names[-1] if names else None
+
+    def last_matching(self, directory, prefix='', suffix=''):
+        """Return the last file name that starts with prefix and ends
+        with suffix (or None), file names that start with a timestamp
+        can be looked up by time by using the time as the prefix"""
+        with self.lock:
+            names = self.get(directory).names
+            # bisect to the end of names starting with prefix
+            i = bisect.bisect_right(names, prefix + '\U0010ffff')
+            while i > 0 and names[i - 1].startswith(prefix):
+                i -= 1
+                if names[i].endswith(suffix):
+                    return names[i]
+            return None
+
+    def on_event(self, directory, name, mask):
+        with self.lock:
+            if directory is None:  # events were lost, start over
+                logging.warning("inotify queue overflow, clearing index")
+                for d in list(self.listings):
+                    self.drop(d)
+                return
+            if directory in self.missing and (
+                    mask & inotify.IN_IGNORED or (
+                        mask & inotify.IN_ISDIR and
+                        mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO))):
+                # a directory was created (or the ancestor removed),
+                # re-list missing directories on their next request
+                for d in list(self.missing.get(directory, ())):
+                    self.drop(d)
+            listing = self.listings.get(directory, None)
+            if listing is None:
+                return
+            if mask & inotify.IN_IGNORED:  # directory removed
+                self.drop(directory)
+            elif not name or mask & inotify.IN_ISDIR:
+                return
+            elif mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                listing.add(name)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                listing.remove(name)
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+
+
+_index = None
+_index_pid = None
+
+
+def get_index():
+    """Index for this process (uwsgi forks workers, each needs its own
+    inotify watcher thread)"""
+    global _index, _index_pid
+    if _index is None or _index_pid != os.getpid():
+        _index = DirectoryIndex()
+        _index_pid = os.getpid()
+    return _index
+
+
+def test():
+    import tempfile
+    import time
+
+    def wait_for(f, timeout=2.0):
+        t0 = time.monotonic()
+        while not f():
+            if time.monotonic() - t0 > timeout:
+                return False
+            time.sleep(0.01)
+        return True
+
+    for use_inotify in (True, False):
+        with tempfile.TemporaryDirectory() as root:
+            index = DirectoryIndex(max_directories=2, use_inotify=use_inotify)
+            d = os.path.join(root, 'cam', '220101')
+            assert index.summary(d, 2) == (0, 0, [])
+            os.makedirs(d)
+            for n in ('b', 'a', 'c'):
+                open(os.path.join(d, n), 'w').close()
+            assert wait_for(lambda: index.summary(d)[0] == 3)
+            count, digest, recent = index.summary(d, 2)
+            assert recent == ['b', 'c']
+            assert digest == Listing(['a', 'b', 'c']).digest
+            os.remove(os.path.join(d, 'a'))
+            assert wait_for(lambda: index.summary(d)[2] == ['b', 'c'])
+            assert index.page(d, 1, 5) == (2, ['c'])
+            assert index.last(d) == 'c'
+            assert index.last_matching(d, 'b') == 'b'
+            assert index.last_matching(d, '', 'b') == 'b'
+            assert index.last_matching(d, 'd') is None
+            # evict d
+            index.summary(os.path.join(root, 'x'))
+            index.summary(os.path.join(root, 'y'))
+            assert len(index.listings) == 2
+            assert index.last(d) == 'c'
+            index.stop()
+    print("fileindex test passed")
+
+
+if __name__ == '__main__':
+    test()
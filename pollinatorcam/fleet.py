@@ -0,0 +1,307 @@
+"""
+Configure many cameras at once
+
+The desired config (video formats, snapshot schedule, nas target, widget
+overlay and name) is compared to each camera's current config and only
+changed keys are set. Cameras are configured concurrently and are only
+rebooted if a key that needs a reboot changed.
+
+Numbers are compared numerically (firmware formats fractional FPS its own
+way). Secret (write only or masked) keys like the NAS password can't be
+compared so are only set when forced (-s).
+
+Cameras can be listed (-i) or taken from the discover registry (-a).
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import time
+
+from . import config
+from . import dahuacam
+from . import discover
+
+
+# cameras configured at once
+default_workers = 8
+
+# relative tolerance when comparing numeric values
+numeric_tolerance = 1e-3
+# keys (suffixes) that can't be read back so are only set when forced
+secret_keys = ('.Password', )
+# changes to keys starting with these require a reboot to take effect
+reboot_keys = (
+    'Encode[0].MainFormat', 'Encode[0].ExtraFormat', 'NAS[0]',
+    'General.MachineName')
+
+# top level config names read to diff against the desired config
+current_config_names = (
+    'Encode', 'General', 'MotionDetect', 'NAS', 'Network',
+    'RecordStoragePoint', 'Snap', 'VideoWidget')
+
+
+def read_current_config(cam):
+    """Read (and parse) all config needed to diff against desired config"""
+    current = {}
+    for name in current_config_names:
+        # always read from the camera (this also refreshes the cache)
+        current.update(cam.read_config_snapshot(name, 0)[1])
+    return current
+
+
+def desired_config(cam, current, nas=None, fps=1/60., snap_only=False):
+    """Build desired config [(key, value), ...] for a camera
+
+    widget overlay and name depend on the current config
+    """
+    nas = dahuacam.fill_nas_config(cam, None if nas is None else dict(nas))
+    groups = dahuacam.snap_config(nas, fps)
+    if not snap_only:
+        groups.extend(dahuacam.video_config())
+        groups.append((
+            'widget', None, dahuacam.widget_config({
+                k: v for (k, v) in current.items()
+                if k.startswith('VideoWidget')})))
+        mac = current['Network.eth0.PhysicalAddress']
+        groups.append((
+            'name', None,
+            [('General.MachineName', ''.join(mac.split(':')))]))
+    return dahuacam.flatten_config(groups)
+
+
+def is_secret(key):
+    return key.endswith(secret_keys)
+
+
+def values_equal(desired, current):
+    """Compare values as sent (ignoring surrounding whitespace) or if both
+    are numbers, numerically"""
+    desired = str(desired).strip()
+    current = current.strip()
+    if desired == current:
+        return True
+    try:
+        d, c = float(desired), float(current)
+    except ValueError:
+        return False
+    return abs(d - c) <= numeric_tolerance * max(abs(d), abs(c))
+
+
+def diff_config(desired, current, secrets=False):
+    """Return [(key, value), ...] of desired config that differs from current
+
+    secret keys are only included (always) if secrets is True
+    """
+    changes = []
+    for k, v in desired:
+        if is_secret(k):
+            if secrets:
+                changes.append((k, v))
+            continue
+        if current.get(k, None) is None or not values_equal(v, current[k]):
+            changes.append((k, v))
+    return changes
+
+
+def needs_reboot(changes):
+    return any(k.startswith(reboot_keys) for (k, _) in changes)
+
+
+def configure_camera(
+        ip, nas=None, fps=1/60., snap_only=False, reboot=True,
+        dry_run=False, timeout=None, secrets=False):
+    """Configure 1 camera, returns dict of results
+
+    secrets: also set secret keys (NAS password)
+
+    - name: camera name (mac)
+    - changes: [(key, value), ...] that differed from the current config
+    - result: 'OK' or the first error
+    - rebooted: True if the camera was rebooted (only if a change needs it)
+    - timings: seconds spent on each step
+    """
+    timings = {}
+    result = {'ip': ip, 'changes': [], 'rebooted': False, 'timings': timings}
+    t0 = time.monotonic()
+    cam = dahuacam.DahuaCamera(ip, timeout=timeout)
+    current = read_current_config(cam)
+    result['name'] = current.get('General.MachineName', None)
+    t1 = time.monotonic()
+    timings['read'] = t1 - t0
+
+    changes = diff_config(
+        desired_config(cam, current, nas, fps, snap_only), current, secrets)
+    result['changes'] = changes
+    t0 = t1
+    t1 = time.monotonic()
+    timings['diff'] = t1 - t0
+
+    result['result'] = 'OK'
+    if len(changes) and not dry_run:
+        r = cam.set_config(changes)
+        result['result'] = r.strip()
+    t0 = t1
+    t1 = time.monotonic()
+    timings['set'] = t1 - t0
+
+    # set the time every time (it's not part of the config)
+    if not dry_run:
+        cam.set_current_time()
+    t0 = t1
+    t1 = time.monotonic()
+    timings['time'] = t1 - t0
+
+    if (
+            reboot and not dry_run and needs_reboot(changes) and
+            result['result'] == 'OK'):
+        cam.reboot()
+        result['rebooted'] = True
+    t0 = t1
+    t1 = time.monotonic()
+    timings['reboot'] = t1 - t0
+    timings['total'] = sum(timings.values())
+    return result
+
+
+def configure_cameras(ips, workers=None, **kwargs):
+    """Configure cameras concurrently, returns {ip: result}
+
+    kwargs are passed to configure_camera, failures are returned as
+    results with an error
+    """
+    if workers is None:
+        workers = default_workers
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {
+            pool.submit(configure_camera, ip, **kwargs): ip for ip in ips}
+        for future in concurrent.futures.as_completed(futures):
+            ip = futures[future]
+            try:
+                results[ip] = future.result()
+            except Exception as e:
+                logging.warning("Failed to configure %s: %s", ip, e)
+                results[ip] = {'ip': ip, 'error': str(e)}
+                continue
+            r = results[ip]
+            logging.info(
+                "Configured %s[%s]: %i changes, %s [%0.2f seconds]",
+                ip, r['name'], len(r['changes']), r['result'],
+                r['timings']['total'])
+    return results
+
+
+def cmdline_run():
+    nas = {
+        'user': 'ipcam',
+        'enable': True,
+    }
+
+    # look for options in env
+    if 'PCAM_NAS_USER' in os.environ:
+        nas['user'] = os.environ['PCAM_NAS_USER']
+    if 'PCAM_NAS_PASSWORD' in os.environ:
+        nas['password'] = os.environ['PCAM_NAS_PASSWORD']
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--all', action='store_true',
+        help='configure all cameras found by discover')
+    parser.add_argument(
+        '-D', '--nasdir', type=str, default=' ',
+        help='NAS directory to store snaps')
+    parser.add_argument(
+        '-F', '--fps', type=float, default=1/60.,
+        help="snapshot fps")
+    parser.add_argument(
+        '-i', '--ip', type=str, action='append', default=[],
+        help="camera ip address (can be provided more than once)")
+    parser.add_argument(
+        '-I', '--nasip', type=str,
+        help='NAS ip address, if not provided will be looked up')
+    parser.add_argument(
+        '-j', '--workers', type=int, default=default_workers,
+        help='number of cameras to configure at once')
+    parser.add_argument(
+        '-k', '--keepalive', action='store_true',
+        help='Do not reboot after configuration')
+    parser.add_argument(
+        '-n', '--dry_run', action='store_true',
+        help='only report changes, do not configure cameras')
+    parser.add_argument(
+        '-P', '--naspassword', type=str,
+        help='NAS password')
+    parser.add_argument(
+        '-s', '--secrets', action='store_true',
+        help='also set secrets (NAS password) that cannot be compared')
+    parser.add_argument(
+        '-S', '--snaponly', action='store_true',
+        help='Only set snap config')
+    parser.add_argument(
+        '-U', '--nasuser', type=str,
+        help='NAS user')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Make output more verbose')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.nasip is not None:
+        nas['ip'] = args.nasip
+    if args.nasuser is not None:
+        nas['user'] = args.nasuser
+    if args.naspassword is not None:
+        nas['password'] = args.naspassword
+    if args.secrets and 'password' not in nas:
+        parser.error("NAS password required (-P or PCAM_NAS_PASSWORD)")
+    # not compared (or set) unless secrets are set
+    nas.setdefault('password', '')
+    nas['directory'] = args.nasdir
+
+    ips = list(args.ip)
+    if args.all:
+        registry = config.load_config(discover.cfg_name, {})
+        ips.extend(
+            ip for ip in sorted(registry)
+            if registry[ip].get('is_camera', False) and ip not in ips)
+    if len(ips) == 0:
+        parser.error("No cameras to configure (use -i or -a)")
+
+    print("Configuring %i cameras" % len(ips))
+    t0 = time.monotonic()
+    results = configure_cameras(
+        ips, args.workers, nas=nas, fps=args.fps, snap_only=args.snaponly,
+        reboot=not args.keepalive, dry_run=args.dry_run,
+        secrets=args.secrets)
+    dt = time.monotonic() - t0
+
+    n_failed = 0
+    for ip in ips:
+        r = results[ip]
+        if 'error' in r:
+            n_failed += 1
+            print("%s: failed: %s" % (ip, r['error']))
+            continue
+        if r['result'] != 'OK':
+            n_failed += 1
+        print("%s[%s]: %i changes, %s%s" % (
+            ip, r['name'], len(r['changes']), r['result'],
+            ', rebooted' if r['rebooted'] else ''))
+        if args.verbose or args.dry_run:
+            for k, v in r['changes']:
+                print("\t%s=%s" % (k, v))
+        print("\t%s" % ', '.join(
+            '%s %0.2fs' % (k, r['timings'][k]) for k in
+            ('read', 'set', 'time', 'reboot', 'total')))
+    print("Configured %i cameras (%i failed) in %0.2f seconds" % (
+        len(ips), n_failed, dt))
+
+
+if __name__ == '__main__':
+    cmdline_run()
@@ -8,24 +8,33 @@ Grab images from camera
 """
 
 import argparse
+import collections
 import copy
 import datetime
 import json
 import logging
 import os
+import queue
+import threading
 import time
 
-import cv2
 import numpy
 import systemd.daemon
 
 import tfliteserve
 
+from . import admission
 from . import cvcapture
 from . import config
+from . import crop
 from . import dahuacam
+from . import discover
+from . import events
 #from . import gstcapture
 from . import logger
+from . import metrics
+from . import perfstats
+from . import preview
 from . import trigger
 
 
@@ -53,12 +62,26 @@ default_cfg = {
 
 data_dir = '/mnt/data/'
 
+# grabbers serve metrics on unix sockets here (by default)
+metrics_dir = os.path.join(config.working_cfg_dir, 'metrics')
+
+# seconds between writes of perf stats (see perfstats)
+perf_interval = 1.0
+# seconds of history used for perf rates and latency quantiles
+perf_window = 60.0
+
+# min seconds between asking discover to recheck this camera
+recheck_request_interval = 30.0
+# min seconds between capture restarts caused by camera events
+capture_restart_interval = 10.0
+
 
 class Grabber:
     def __init__(
             self, ip, name=None, retry=False,
             fake_detection=False, save_all_detections=True,
-            in_systemd=False):
+            in_systemd=False, watch_events=True, metrics_address=None,
+            preview_rate=None):
         self.cam = dahuacam.DahuaCamera(ip)
         # TODO do this every startup?
         self.cam.set_current_time()
@@ -66,17 +89,34 @@ class Grabber:
             name = self.cam.get_name()
         self.ip = ip
 
+        self.build_metrics(name, metrics_address)
+        self.build_preview(preview_rate)
+
         # TODO configure camera: see dahuacam for needed updates
         #dahuacam.initial_configuration(self.cam, reboot=False)
 
         logging.info("Starting capture thread: %s", self.ip)
         self.ip = ip
         self.retry = retry
+        self.last_recheck_request = None
+        # thread releasing the last replaced capture (see restart_capture)
+        self.capture_releaser = None
+        self.last_capture_restart = None
         self.fake_detection = fake_detection
         if self.fake_detection:
             self.last_detection = time.monotonic() - 5.0
         self.start_capture_thread()
         self.crop = None
+        # analyze the next frame (regardless of analyze_every_n)
+        self.analyze_next = False
+
+        # camera events (motion, video loss...) are queued by the
+        # event stream thread and handled in update
+        self.events = queue.Queue()
+        self.event_stream = None
+        if watch_events:
+            self.event_stream = events.EventStream(self.cam, self.events.put)
+            self.event_stream.start()
 
         self.name = name
         logging.info("Connecting to tfliteserve as %s", self.name)
@@ -88,6 +128,9 @@ class Grabber:
         if not os.path.exists(self.vdir):
             os.makedirs(self.vdir)
 
+        # limits recordings as the disk fills, kept across triggers
+        self.admission = admission.Admission(self.vdir, self.name)
+
         self.mdir = os.path.join(data_dir, 'detections', self.name)
         if not os.path.exists(self.mdir):
             os.makedirs(self.mdir)
@@ -110,12 +153,131 @@ class Grabber:
             self.reset_watchdog()
         logging.info("Process in systemd? %s", self.in_systemd)
 
+        # configs by id (content hash), events refer to these
+        self.cfg_store = os.path.join(data_dir, 'configs', 'store')
+
         self.cfg = default_cfg
+        self.cfg_id = None
         self.cfg_mtime = None
+        # id of the newest config in the 'log' directory
+        self.logged_cfg_id = self.last_logged_config_id()
         self.reload_config(force=True)
 
         self.build_trigger()
 
+    def build_metrics(self, name, address=None):
+        """Build metrics registry and serve it at address (port number or
+        unix socket path, default metrics_dir/<name>.sock, False to not
+        serve)"""
+        self.metrics = metrics.Registry({'camera': name})
+        for (mn, h) in (
+                ('capture_interval_seconds', 'Seconds between frames'),
+                ('crop_seconds', 'Seconds to crop rois of a frame'),
+                ('inference_seconds', 'Seconds to classify 1 roi'),
+                ('detector_seconds', 'Seconds to run detector on 1 roi'),
+                ('trigger_seconds', 'Seconds to update trigger'),
+                ('meta_write_seconds', 'Seconds to save detection meta')):
+            self.metrics.histogram(mn, h)
+        for (mn, h) in (
+                ('frames_total', 'Frames received'),
+                ('analyzed_frames_total', 'Frames analyzed'),
+                ('dropped_frames_total', 'Frames captured but not received'),
+                ('capture_restarts_total', 'Capture thread restarts'),
+                ('recorder_rebuilds_total', 'Recorder (trigger) rebuilds')):
+            self.metrics.counter(mn, h)
+        self.metrics.gauge('recording', '1 if recording, 0 if not')
+        self.last_frame_time = None
+        self.last_capture_frames = 0
+
+        # shared memory stats (read by the ui)
+        self.perf = perfstats.StatsWriter(name)
+        # (time, frames, analyzed frames, inference bucket counts,
+        #  bytes written) for the last perf_window seconds
+        self.perf_history = collections.deque()
+        self.last_perf_time = None
+
+        self.metrics_server = None
+        if address is False:
+            return
+        if address is None:
+            address = os.path.join(metrics_dir, '%s.sock' % name)
+        try:
+            if isinstance(address, int):
+                self.metrics_server = metrics.MetricsServer(
+                    self.metrics, port=address)
+            else:
+                self.metrics_server = metrics.MetricsServer(
+                    self.metrics, path=address)
+        except OSError as e:
+            logging.warning("Failed to serve metrics at %s: %s", address, e)
+
+    def build_preview(self, rate=None):
+        """Serve a live preview on the metrics server (if running)"""
+        self.preview = preview.Preview(rate)
+        if self.metrics_server is None or self.preview.rate <= 0:
+            return
+        self.metrics_server.add_handler('/preview', self.preview.serve_mjpeg)
+        self.metrics_server.add_handler(
+            '/preview.jpg', self.preview.serve_jpeg)
+
+    def update_perf(self):
+        """Write perf stats (at most every perf_interval seconds)"""
+        t = time.monotonic()
+        if (
+                self.last_perf_time is not None and
+                t - self.last_perf_time < perf_interval):
+            return
+        self.last_perf_time = t
+        m = self.metrics
+        inference = m['inference_seconds']
+        try:
+            self.admission.update_bytes_written()
+        except OSError:
+            pass
+        now = (
+            t, m['frames_total'].value, m['analyzed_frames_total'].value,
+            inference.bucket_counts(), self.admission.bytes_written)
+        self.perf_history.append(now)
+        while t - self.perf_history[0][0] > perf_window:
+            self.perf_history.popleft()
+        then = self.perf_history[0]
+        dt = t - then[0]
+        counts = [a - b for (a, b) in zip(now[3], then[3])]
+        p50 = inference.quantile(0.5, counts)
+        p99 = inference.quantile(0.99, counts)
+        buffer_fill = None
+        try:
+            buffer_fill = self.trigger.recorder.buffer_fill()
+        except Exception as e:
+            logging.debug("Failed to get recorder buffer fill: %s", e)
+        self.perf.write(
+            fps=(now[1] - then[1]) / dt if dt else 0,
+            analysis_rate=(now[2] - then[2]) / dt if dt else 0,
+            inference_p50=numpy.nan if p50 is None else p50,
+            inference_p99=numpy.nan if p99 is None else p99,
+            recording=m['recording'].value,
+            buffer_fill=-1 if buffer_fill is None else buffer_fill,
+            bytes_per_hour=(now[4] - then[4]) * 3600. / dt if dt else 0,
+            bytes_written=now[4],
+            frames=now[1],
+            dropped_frames=m['dropped_frames_total'].value,
+            capture_restarts=m['capture_restarts_total'].value,
+            recorder_rebuilds=m['recorder_rebuilds_total'].value)
+
+    def last_logged_config_id(self):
+        """Return the id of the newest config in the 'log' directory (or
+        None if there isn't one or it can't be read)"""
+        fns = os.listdir(self.cdir)
+        if not len(fns):
+            return None
+        fn = os.path.join(self.cdir, max(fns))
+        try:
+            with open(fn, 'r') as f:
+                return config.config_id(json.load(f))
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to read logged config %s: %s", fn, e)
+            return None
+
     def reload_config(self, force=False):
         mtime = config.get_modified_time(self.name)
         if not force and mtime == self.cfg_mtime:
@@ -127,8 +289,9 @@ class Grabber:
         self.cfg_mtime = mtime
         if mtime is None:
             config.save_config(self.cfg, self.name)
-        if self.cfg == old_cfg:
+        if self.cfg == old_cfg and self.cfg_id is not None:
             return
+        self.cfg_id = config.store_config(self.cfg, self.cfg_store)
         if (
                 (self.cfg['rois'] != old_cfg['rois']) or
                 (self.cfg['detector'] != old_cfg['detector'])):
@@ -136,23 +299,31 @@ class Grabber:
             self.crop = None
         if self.cfg['recording'] != old_cfg['recording']:
             self.build_trigger()
+        if self.cfg_id == self.logged_cfg_id:
+            # unchanged since the last log entry (a restart)
+            return
         # re-save in 'log' directory
         dt = datetime.datetime.now()
         fn = os.path.join(self.cdir, dt.strftime('%y%m%d_%H%M%S_%f'))
         with open(fn, 'w') as f:
             json.dump(self.cfg, f)
+        self.logged_cfg_id = self.cfg_id
 
     def build_trigger(self):
         if hasattr(self, 'trigger'):
             logging.debug("existing trigger found, deleting")
+            self.metrics['recorder_rebuilds_total'].inc()
+            self.trigger.cancel_timer()
             del self.trigger
         logging.debug("Building trigger")
         self.trigger = trigger.TriggeredRecording(
             self.cam.rtsp_url(channel=1, subtype=0),
-            self.vdir, self.name,
-            **self.cfg['recording'])
+            self.vdir, self.name, admission=self.admission,
+            on_activate=self.save_meta, **self.cfg['recording'])
 
     def start_capture_thread(self):
+        if hasattr(self, 'capture_thread'):
+            self.metrics['capture_restarts_total'].inc()
         self.capture_thread = cvcapture.CVCaptureThread(
             cam=self.cam, retry=self.retry)
         self.analyze_every_n = 10
@@ -160,9 +331,73 @@ class Grabber:
         #    url=self.cam.rtsp_url(channel=1, subtype=1))
         #self.analyze_every_n = 1
         self.capture_thread.start()
+        self.last_capture_frames = 0
+
+    def restart_capture(self):
+        """Replace the capture thread, the old capture is released in
+        a helper thread (a stalled read can take a while to return)
+
+        Restarts are ignored while the previous capture is still being
+        released or within capture_restart_interval of the last restart
+        (a flapping camera) so there are at most 2 rtsp clients.
+        """
+        t = time.monotonic()
+        if (
+                self.capture_releaser is not None and
+                self.capture_releaser.is_alive()):
+            logging.debug("Previous capture not yet released, not restarting")
+            return False
+        if (
+                self.last_capture_restart is not None and
+                t - self.last_capture_restart < capture_restart_interval):
+            logging.debug("Capture recently restarted, not restarting")
+            return False
+        self.last_capture_restart = t
+        self.capture_releaser = threading.Thread(
+            target=self.capture_thread.release, daemon=True)
+        self.capture_releaser.start()
+        self.start_capture_thread()
+        return True
 
     def __del__(self):
         self.capture_thread.stop()
+        if self.event_stream is not None:
+            self.event_stream.stop()
+
+    def request_recheck(self):
+        # tell discover the camera had an error (rate limited)
+        t = time.monotonic()
+        if (
+                self.last_recheck_request is not None and
+                t - self.last_recheck_request < recheck_request_interval):
+            return
+        self.last_recheck_request = t
+        logging.info("Requesting discover recheck of %s", self.ip)
+        discover.request_recheck(self.ip)
+
+    def handle_events(self):
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return
+            code = event['Code']
+            action = event.get('action')
+            if code == 'VideoMotion' and action == 'Start':
+                # check for a trigger now and make sure the recorder is
+                # ready to save
+                self.analyze_next = True
+                if not self.trigger.recorder.is_alive():
+                    self.build_trigger()
+            elif code in ('VideoLoss', 'VideoBlind') and action == 'Start':
+                logging.warning("Camera reported %s, restarting capture", code)
+                self.restart_capture()
+                self.request_recheck()
+            elif code.startswith('Storage') and action == 'Start':
+                # snapshots are saved to the nas, have discover verify
+                # the nas config
+                logging.error("Camera reported %s: %s", code, event)
+                self.request_recheck()
 
     def build_crop(self, example_image):
         _, th, tw, _ = self.client.buffers.meta['input']['shape']
@@ -204,24 +439,19 @@ class Grabber:
                 assert b > 0 and b <= h
                 coords.append((t, b, l, r))
 
-        # build rois and detectors
-        rois = []
-        for coord in coords:
-            t, b, l, r = coord
-            rois.append((
-                coord,
-                (slice(t, b), slice(l, r)),
-                trigger.RunningThreshold(**self.cfg['detector']),
-            ))
+        # build crop engine (frames are BGR) and detectors
+        engine = crop.CropEngine(example_image.shape, coords, (th, tw))
+        detectors = [
+            trigger.RunningThreshold(**self.cfg['detector']) for _ in coords]
 
+        # rois are converted (into the engine's buffers) as they are
+        # yielded so each is converted just before it's classified
+        # (client.run copies it to the model input)
         def cf(image):
-            for roi in rois:
-                coords, slices, detector = roi
-                yield (
-                    coords,
-                    cv2.resize(image[slices], (th, tw), interpolation=cv2.INTER_AREA),
-                    detector)
-        
+            engine.resize(image)
+            for i, coord in enumerate(coords):
+                yield (coord, engine.convert(i), detectors[i])
+
         return cf
 
     def analyze_frame(self, im):
@@ -242,59 +472,88 @@ class Grabber:
                 self.last_detection = time.monotonic()
         else:
             set_trigger = False
-            meta['detections'] = []
-            meta['indices'] = []
+            records = []
+            triggered = []
             meta['rois'] = []
-            for patch in self.crop(im):
+            # rois are cropped as they are generated
+            crop_time = 0.
+            t0 = time.perf_counter()
+            for roi, patch in enumerate(self.crop(im)):
                 coords, cim, detector = patch
+                t1 = time.perf_counter()
+                crop_time += t1 - t0
 
                 # run classification on cropped image
+                # (o is not kept past this roi so it can be a view of
+                # the shared output)
                 o = self.client.run(cim)
                 #o[0, 100] = 1.0
+                t2 = time.perf_counter()
+                self.metrics['inference_seconds'].observe(t2 - t1)
 
                 # run detector on classification results
                 t, info = detector(o)
+                self.metrics['detector_seconds'].observe(
+                    time.perf_counter() - t2)
                 if t:
                     set_trigger = True
+                triggered.append(bool(t))
 
-                detections = []
-                if len(info['indices']):
-                    lbls = self.client.buffers.meta['labels']
-                    detections = [
-                        (str(lbls[i]), o[0, i]) for i in
-                        sorted(
-                            info['indices'], key=lambda i: o[0, i], reverse=True)]
-                meta['detections'].append(detections)
-                meta['indices'].append(info['indices'])
+                # label names are only looked up when saved (render_meta)
+                records.append(
+                    logger.top_detections(o[0], info['indices'], roi))
                 meta['rois'].append(coords)
                 
                 # TODO
                 #if self.save_all_detections:
                 #    self.analysis_logger.save(
                 #        dt, {'labels': numpy.squeeze(o), 'detection': t})
-
+                t0 = time.perf_counter()
+            self.metrics['crop_seconds'].observe(crop_time)
+            meta['detections'] = numpy.concatenate(records)
+            if self.preview.watched():
+                lbls = self.client.buffers.meta['labels']
+                self.preview.set_detections(
+                    meta['rois'],
+                    [
+                        [(str(lbls[r['label']]), float(r['score']))
+                         for r in rs]
+                        for rs in records],
+                    triggered)
 
         if set_trigger:
             logging.debug("Triggered!")
             #print(meta['detections'][0][:5])
-        meta['config'] = self.cfg
-        r = self.trigger(set_trigger, meta)
+        # config by reference (see config.resolve_config)
+        meta['config_id'] = self.cfg_id
+        with self.metrics['trigger_seconds'].time():
+            # use the returned metas, a trigger timer can replace
+            # trigger.meta at any time
+            r, meta, last_meta = self.trigger(set_trigger, meta)
 
         if set_trigger or r:
-            # save trigger meta and last_meta
-            dt = self.trigger.meta['datetime']
-            d = os.path.join(self.mdir, dt.strftime('%y%m%d'))
-            if not os.path.exists(d):
-                os.makedirs(d)
-            mfn = os.path.join(
-                d,
-                '%s_%s.json' % (dt.strftime('%H%M%S_%f'), self.name))
-            with open(mfn, 'w') as f:
-                json.dump(
-                    {
-                        'meta': self.trigger.meta,
-                        'last_meta': self.trigger.last_meta},
-                    f, indent=True, cls=logger.MetaJSONEncoder)
+            self.save_meta(meta, last_meta)
+
+    def save_meta(self, meta, last_meta):
+        """Save trigger meta and last_meta (also called by the trigger
+        timer when it starts a recording)"""
+        t0 = time.perf_counter()
+        dt = meta['datetime']
+        d = os.path.join(self.mdir, dt.strftime('%y%m%d'))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        mfn = os.path.join(
+            d,
+            '%s_%s.json' % (dt.strftime('%H%M%S_%f'), self.name))
+        lbls = self.client.buffers.meta['labels']
+        with open(mfn, 'w') as f:
+            json.dump(
+                {
+                    'meta': logger.render_meta(meta, lbls),
+                    'last_meta': logger.render_meta(last_meta, lbls)},
+                f, indent=True, cls=logger.MetaJSONEncoder)
+        self.metrics['meta_write_seconds'].observe(
+            time.perf_counter() - t0)
 
     def reset_watchdog(self):
         if not self.in_systemd:
@@ -303,6 +562,7 @@ class Grabber:
         logging.debug("Reset watchdog")
 
     def update(self):
+        self.handle_events()
         try:
             # TODO wait frame period * 1.5
             r, im, ts = self.capture_thread.next_image(timeout=1.5)
@@ -310,6 +570,7 @@ class Grabber:
             # next image timed out
             if not self.capture_thread.is_alive():
                 logging.info("Restarting capture thread")
+                self.request_recheck()
                 self.start_capture_thread()
                 # TODO restart record also?
             else:
@@ -318,8 +579,24 @@ class Grabber:
         if not r or im is None:  # error
             #raise Exception("Snapshot error: %s" % im)
             logging.warning("Image error: %s", im)
+            self.request_recheck()
             return False
-        
+
+        # frames captured since the last frame was received were dropped
+        n = self.capture_thread.n_frames
+        if n - self.last_capture_frames > 1:
+            self.metrics['dropped_frames_total'].inc(
+                n - self.last_capture_frames - 1)
+        self.last_capture_frames = n
+        t = time.monotonic()
+        if self.last_frame_time is not None:
+            self.metrics['capture_interval_seconds'].observe(
+                t - self.last_frame_time)
+        self.last_frame_time = t
+        self.metrics['frames_total'].inc()
+        # only kept (and encoded) while someone watches the preview
+        self.preview.put(im, ts)
+
         self.reload_config()
 
         # have new image
@@ -335,9 +612,14 @@ class Grabber:
             self.crop = self.build_crop(im)
 
         # if frame should be checked...
-        if self.frame_count % self.analyze_every_n == 0:
+        if self.analyze_next or self.frame_count % self.analyze_every_n == 0:
             # TODO need to catch errors, etc
+            self.analyze_next = False
             self.analyze_frame(im)
+            self.metrics['analyzed_frames_total'].inc()
+        self.metrics['recording'].set(
+            int(self.trigger.filename is not None))
+        self.update_perf()
 
         # reset watchdog
         self.reset_watchdog()
@@ -358,18 +640,29 @@ def cmdline_run():
     parser.add_argument(
         '-D', '--in_systemd', action='store_true',
         help='running in sysd, reset watchdog')
+    parser.add_argument(
+        '-E', '--no_events', action='store_true',
+        help='do not watch camera events')
     parser.add_argument(
         '-f', '--fake', default=False, action='store_true',
         help='fake client detection')
     parser.add_argument(
         '-i', '--ip', type=str, required=True,
         help='camera ip address')
+    parser.add_argument(
+        '-m', '--metrics', default=None,
+        help=(
+            'serve metrics on this port or unix socket path '
+            '(default %s/<name>.sock, "off" to disable)' % metrics_dir))
     parser.add_argument(
         '-n', '--name', default=None,
         help='camera name')
     parser.add_argument(
         '-p', '--password', default=None,
         help='camera password')
+    parser.add_argument(
+        '-P', '--preview_rate', default=preview.default_rate, type=float,
+        help='live preview frames per second (0 to disable)')
     parser.add_argument(
         '-r', '--retry', default=False, action='store_true',
         help='retry on acquisition errors')
@@ -389,8 +682,15 @@ def cmdline_run():
     if args.user is not None:
         os.environ['PCAM_USER'] = args.user
 
+    metrics_address = args.metrics
+    if metrics_address == 'off':
+        metrics_address = False
+    elif metrics_address is not None and metrics_address.isdigit():
+        metrics_address = int(metrics_address)
+
     g = Grabber(
         args.ip, args.name, args.retry,
         fake_detection=args.fake, save_all_detections=args.save_all_detections,
-        in_systemd=args.in_systemd)
+        in_systemd=args.in_systemd, watch_events=not args.no_events,
+        metrics_address=metrics_address, preview_rate=args.preview_rate)
     g.run()
@@ -234,6 +234,13 @@ class Recorder(threading.Thread):
             self.join()
             self.teardown()
 
+    def buffer_fill(self):
+        """Fraction (0-1) of the pre-record (delay) queue filled"""
+        max_time = self.queue.get_property('max-size-time')
+        if not max_time:
+            return None
+        return self.queue.get_property('current-level-time') / max_time
+
     def print_pipeline_states(self, and_pads=False):
         for i in range(self.pipeline.get_children_count()):
             try:
@@ -0,0 +1,140 @@
+"""
+Minimal inotify (linux) directory watcher using ctypes (no dependencies)
+
+    w = Watcher(callback)
+    w.add_watch('/mnt/data/detections')
+    w.start()
+
+callback(directory, name, mask) is called (in the watcher thread) for each
+event in a watched directory. After a queue overflow (events were lost)
+callback(None, None, IN_Q_OVERFLOW) is called so the caller can rescan.
+
+Creating a Watcher raises OSError if inotify is not available.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# files (and directories) added or removed
+default_mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+event_header = struct.Struct('iIII')
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for f in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            if not hasattr(_libc, f):
+                raise OSError("inotify not available")
+    return _libc
+
+
+def parse_events(buf):
+    """Parse events read from an inotify fd, yields (wd, mask, name)"""
+    i = 0
+    while i + event_header.size <= len(buf):
+        wd, mask, cookie, n = event_header.unpack_from(buf, i)
+        i += event_header.size
+        name = buf[i:i + n].rstrip(b'\x00').decode('utf-8', 'replace')
+        i += n
+        yield wd, mask, name
+
+
+class Watcher(threading.Thread):
+    def __init__(self, callback, *args, **kwargs):
+        kwargs['daemon'] = kwargs.get('daemon', True)
+        super(Watcher, self).__init__(*args, **kwargs)
+        self.callback = callback
+        self.fd = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.lock = threading.Lock()
+        # watch descriptor: directory and directory: watch descriptor
+        self.directories = {}
+        self.watches = {}
+        self.keep_running = True
+
+    def add_watch(self, directory, mask=default_mask):
+        """Watch directory (returns False if it doesn't exist)"""
+        with self.lock:
+            if directory in self.watches:
+                return True
+            wd = libc().inotify_add_watch(
+                self.fd, os.fsencode(directory), mask | IN_ONLYDIR)
+            if wd < 0:
+                e = ctypes.get_errno()
+                logging.debug(
+                    "Failed to watch %s: %s", directory, os.strerror(e))
+                return False
+            self.directories[wd] = directory
+            self.watches[directory] = wd
+            return True
+
+    def remove_watch(self, directory):
+        with self.lock:
+            wd = self.watches.pop(directory, None)
+            if wd is None:
+                return
+            del self.directories[wd]
+            libc().inotify_rm_watch(self.fd, wd)
+
+    def handle(self, buf):
+        for wd, mask, name in parse_events(buf):
+            if mask & IN_Q_OVERFLOW:
+                self.callback(None, None, mask)
+                continue
+            with self.lock:
+                directory = self.directories.get(wd, None)
+                if mask & IN_IGNORED and directory is not None:
+                    # directory was removed (or unwatched)
+                    del self.directories[wd]
+                    del self.watches[directory]
+            if directory is None:
+                continue
+            try:
+                self.callback(directory, name, mask)
+            except Exception as e:
+                logging.warning("inotify callback failed: %s", e)
+
+    def run(self):
+        while self.keep_running:
+            r, _, _ = select.select([self.fd], [], [], 1.0)
+            if not r:
+                continue
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            self.handle(buf)
+
+    def stop(self):
+        if self.is_alive():
+            self.keep_running = False
+            self.join()
+        os.close(self.fd)
@@ -6,6 +6,55 @@ import struct
 import numpy
 
 
+# detections kept (highest scores first) per roi per analyzed frame
+max_detections = 10
+
+# 1 record per detection: roi index, label id, score
+detection_dtype = numpy.dtype([
+    ('roi', 'u1'), ('label', 'u2'), ('score', 'f4')])
+
+
+def top_detections(scores, indices, roi, k=None):
+    """Returns detection records for the top k (by score) of indices
+
+    scores: 1d array of scores for all labels
+    indices: label ids that were detected
+    """
+    if k is None:
+        k = max_detections
+    indices = numpy.asarray(indices)
+    if len(indices) > k:
+        # only the top k are partitioned out, not a full sort
+        indices = indices[numpy.argpartition(scores[indices], -k)[-k:]]
+    records = numpy.empty(len(indices), dtype=detection_dtype)
+    records['roi'] = roi
+    records['label'] = indices
+    records['score'] = scores[indices]
+    # sort the (at most k) records by score, highest first
+    return records[numpy.argsort(-records['score'], kind='stable')]
+
+
+def render_meta(meta, labels):
+    """Copy of meta with detection records converted for saving
+
+    detections: [[(label name, score), ...] per roi]
+    indices: [[label id, ...] per roi]
+    """
+    if not isinstance(meta.get('detections'), numpy.ndarray):
+        return meta
+    meta = dict(meta)
+    records = meta['detections']
+    n_rois = len(meta.get('rois', []))
+    detections = [[] for _ in range(n_rois)]
+    indices = [[] for _ in range(n_rois)]
+    for roi, label, score in records.tolist():
+        detections[roi].append((str(labels[label]), score))
+        indices[roi].append(label)
+    meta['detections'] = detections
+    meta['indices'] = indices
+    return meta
+
+
 class MetaJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, numpy.ndarray):
@@ -15,11 +64,24 @@ class MetaJSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# 1 (packed) record per analyzed frame in raw files (see AnalysisResultsSaver)
+raw_dtype = numpy.dtype([
+    ('detection', 'i1'), ('timestamp', 'f8'), ('labels', 'f8', (2988, ))])
+
+
+def load_raw_file(fn):
+    """Memory map all (complete) records of a raw file (see raw_dtype)"""
+    n = os.path.getsize(fn) // raw_dtype.itemsize
+    if n == 0:
+        return numpy.empty(0, dtype=raw_dtype)
+    return numpy.memmap(fn, dtype=raw_dtype, mode='r', shape=(n, ))
+
+
 def iter_raw_file(fn):
     data = [
         ('detection', 1, lambda b: struct.unpack('b', b)[0]),
         ('timestamp', 8, lambda b: struct.unpack('d', b)[0]),
-        ('labels', 2988 * 8, lambda b: numpy.fromstring(b, dtype='f8')),
+        ('labels', 2988 * 8, lambda b: numpy.frombuffer(b, dtype='f8')),
     ]
     reading = True
     with open(fn, 'rb') as f:
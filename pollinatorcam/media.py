@@ -0,0 +1,58 @@
+"""
+Serve (large) data files without tying up a ui worker
+
+Behind nginx (see services/pcam-ui.nginx) the response only contains an
+X-Accel-Redirect header and nginx sends the file from an internal
+location (with sendfile, byte ranges and conditional requests) while
+the uwsgi worker moves on to the next request. nginx tells the app the
+internal location in the PCAM_MEDIA_PREFIX uwsgi variable (which clients
+can't set).
+
+Without nginx (flask development server) files are sent by flask
+(also supporting byte ranges and conditional requests).
+"""
+
+import mimetypes
+import os
+import urllib.parse
+
+import flask
+
+
+# wsgi environ key of the internal nginx location serving data_dir
+prefix_key = 'PCAM_MEDIA_PREFIX'
+
+
+def relative_path(path, root):
+    """Return path relative to root (None if not within root)"""
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath((root, path)) != root or path == root:
+        return None
+    return os.path.relpath(path, root)
+
+
+def send_media(path, root, mimetype=None, max_age=None):
+    """Send file at path (absolute or relative to root) within root
+
+    Aborts with 404 if path is outside root or isn't a file
+    """
+    rel = relative_path(path, root)
+    if rel is None:
+        return flask.abort(404)
+    fn = os.path.join(root, rel)
+    if not os.path.isfile(fn):
+        return flask.abort(404)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(fn)[0] or 'application/octet-stream'
+    prefix = flask.request.environ.get(prefix_key, None)
+    if prefix is None:
+        return flask.send_file(
+            fn, mimetype=mimetype, conditional=True, max_age=max_age)
+    resp = flask.make_response('')
+    resp.mimetype = mimetype
+    resp.headers['X-Accel-Redirect'] = (
+        prefix.rstrip('/') + '/' + urllib.parse.quote(rel))
+    if max_age is not None:
+        resp.cache_control.max_age = max_age
+    return resp
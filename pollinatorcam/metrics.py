@@ -0,0 +1,253 @@
+"""
+In process metrics (counters, gauges and histograms)
+
+Metrics are kept in a Registry and rendered in the prometheus text format
+served (by MetricsServer) at /metrics over http or over a unix socket
+(1 per grabber when several cameras run on the same machine):
+    curl --unix-socket /dev/shm/pcam/metrics/<name>.sock http://pcam/metrics
+
+Other paths can be served by the same server (see MetricsServer.add_handler
+and preview).
+"""
+
+import bisect
+import http.server
+import logging
+import os
+import socketserver
+import threading
+import time
+
+
+# histogram bucket upper bounds (seconds) for latencies
+default_buckets = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0)
+
+# unix sockets are readable and writable by the owner and group (the ui
+# web server, nginx, needs to be in the group of the grabber's user)
+socket_mode = 0o660
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for (k, v) in sorted(labels.items()))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self, labels):
+        return ['%s%s %s' % (self.name, format_labels(labels), self.value)]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=None):
+        self.name = name
+        self.help = help
+        if buckets is None:
+            buckets = default_buckets
+        self.buckets = tuple(sorted(buckets))
+        # last count is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager that observes the seconds spent in it"""
+        return Timer(self)
+
+    def bucket_counts(self):
+        """Copy of the counts per bucket (subtract 2 copies to get the
+        counts for a time window, see quantile)"""
+        with self.lock:
+            return list(self.counts)
+
+    def quantile(self, q, counts=None):
+        """Estimate quantile q (0-1) by interpolating within buckets
+        (None if nothing was observed)
+
+        counts: bucket counts to use (default all observations)
+        """
+        if counts is None:
+            counts = self.bucket_counts()
+        count = sum(counts)
+        if count == 0:
+            return None
+        target = q * count
+        cumulative = 0
+        lower = 0.
+        for upper, n in zip(self.buckets, counts):
+            if n and cumulative + n >= target:
+                return lower + (upper - lower) * (target - cumulative) / n
+            cumulative += n
+            lower = upper
+        # above the largest bucket
+        return self.buckets[-1]
+
+    def samples(self, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        lines = []
+        cumulative = 0
+        for upper, n in zip(self.buckets + (float('inf'), ), counts):
+            cumulative += n
+            le = '+Inf' if upper == float('inf') else repr(upper)
+            lines.append('%s_bucket%s %i' % (
+                self.name, format_labels(dict(labels, le=le)), cumulative))
+        lines.append('%s_sum%s %r' % (self.name, format_labels(labels), total))
+        lines.append('%s_count%s %i' % (
+            self.name, format_labels(labels), count))
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.t0)
+
+
+class Registry:
+    def __init__(self, labels=None):
+        """labels are added to every metric (camera name...)"""
+        self.labels = labels or {}
+        self.metrics = {}
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric %s already exists" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help=''):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help=''):
+        return self.add(Gauge(name, help))
+
+    def histogram(self, name, help='', buckets=None):
+        return self.add(Histogram(name, help, buckets))
+
+    def __getitem__(self, name):
+        return self.metrics[name]
+
+    def render(self):
+        """Render all metrics in the prometheus text format"""
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            if metric.help:
+                lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            lines.extend(metric.samples(self.labels))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in self.server.handlers:
+            self.server.handlers[path](self)
+            return
+        if path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # don't log every scrape
+        pass
+
+
+class UnixHTTPServer(
+        socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        # handlers expect a (host, port) client address
+        return request, ('unix', 0)
+
+
+class MetricsServer:
+    """Serve a registry at /metrics on a port (if port is not None) or
+    a unix socket path (in a daemon thread)"""
+    def __init__(self, registry, port=None, path=None, host='0.0.0.0'):
+        self.registry = registry
+        if port is not None:
+            self.server = http.server.ThreadingHTTPServer(
+                (host, port), MetricsHandler)
+            self.server.daemon_threads = True
+            self.address = '%s:%s' % (host, port)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):  # left by a previous run
+                os.remove(path)
+            self.server = UnixHTTPServer(path, MetricsHandler)
+            # allow the group (the ui web server) to connect
+            os.chmod(path, socket_mode)
+            self.address = path
+        self.server.registry = registry
+        # other paths served, path: callable(request handler)
+        self.server.handlers = {}
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info("Serving metrics at %s", self.address)
+
+    def add_handler(self, path, handler):
+        """Serve path by calling handler(request handler) (in a server
+        thread)"""
+        self.server.handlers[path] = handler
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not isinstance(self.server, http.server.HTTPServer):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
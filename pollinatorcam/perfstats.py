@@ -0,0 +1,120 @@
+"""
+Per camera performance stats in shared memory
+
+Each grabber writes a small fixed layout stats block (stats_dtype) to
+stats_dir/<name> (on a tmpfs, so a memory mapped file is shared memory)
+about once a second. The ui reads all blocks (without asking the grabbers
+or running subprocesses) to serve /perf.
+
+Writes are guarded by a sequence number (odd while writing) so readers
+retry instead of returning a partially written block.
+"""
+
+import glob
+import os
+import time
+
+import numpy
+
+from . import config
+
+
+stats_dir = os.path.join(config.working_cfg_dir, 'perf')
+
+stats_dtype = numpy.dtype([
+    ('sequence', 'u8'),
+    ('pid', 'i8'),
+    # time.time() of the last write
+    ('timestamp', 'f8'),
+    # frames received/analyzed per second
+    ('fps', 'f4'),
+    ('analysis_rate', 'f4'),
+    # inference seconds per roi
+    ('inference_p50', 'f4'),
+    ('inference_p99', 'f4'),
+    ('recording', 'u1'),
+    # fraction of the recorder (pre-record) buffer filled, -1 if unknown
+    ('buffer_fill', 'f4'),
+    ('bytes_per_hour', 'f8'),
+    ('bytes_written', 'u8'),
+    ('frames', 'u8'),
+    ('dropped_frames', 'u8'),
+    ('capture_restarts', 'u4'),
+    ('recorder_rebuilds', 'u4'),
+])
+
+# stats older than this (seconds) are from a stopped (or stuck) grabber
+stale_time = 10.0
+# reads to try before giving up on a block that is being written
+read_attempts = 10
+
+
+def stats_filename(name):
+    return os.path.join(stats_dir, name)
+
+
+class StatsWriter:
+    def __init__(self, name):
+        self.name = name
+        fn = stats_filename(name)
+        os.makedirs(stats_dir, exist_ok=True)
+        with open(fn, 'wb') as f:
+            f.write(b'\x00' * stats_dtype.itemsize)
+        self.block = numpy.memmap(fn, dtype=stats_dtype, mode='r+', shape=1)
+        self.block['pid'] = os.getpid()
+
+    def write(self, **values):
+        block = self.block
+        block['sequence'] += 1  # odd: writing
+        for k, v in values.items():
+            block[k] = v
+        block['timestamp'] = time.time()
+        block['sequence'] += 1  # even: done
+
+
+def block_to_dict(block):
+    stats = {k: block[k].item() for k in stats_dtype.names}
+    del stats['sequence']
+    stats['stale'] = time.time() - stats['timestamp'] > stale_time
+    if stats['buffer_fill'] < 0:
+        stats['buffer_fill'] = None
+    # no inference yet (nan isn't valid json)
+    for k in ('inference_p50', 'inference_p99'):
+        if numpy.isnan(stats[k]):
+            stats[k] = None
+    return stats
+
+
+def read_stats(name):
+    """Read stats for 1 camera (None if unavailable)"""
+    fn = stats_filename(name)
+    try:
+        with open(fn, 'rb') as f:
+            for _ in range(read_attempts):
+                f.seek(0)
+                b = f.read(stats_dtype.itemsize)
+                if len(b) != stats_dtype.itemsize:
+                    return None
+                block = numpy.frombuffer(b, dtype=stats_dtype)[0]
+                # re-read the sequence to check the block didn't change
+                f.seek(0)
+                sequence = numpy.frombuffer(f.read(8), dtype='u8')[0]
+                if (
+                        block['sequence'] % 2 == 0 and
+                        sequence == block['sequence']):
+                    return block_to_dict(block)
+                time.sleep(0.001)
+    except OSError:
+        return None
+    return None
+
+
+def read_all_stats():
+    """Read stats for all cameras, returns {name: stats}"""
+    stats = {}
+    for fn in sorted(glob.glob(os.path.join(stats_dir, '*'))):
+        name = os.path.basename(fn)
+        s = read_stats(name)
+        if s is not None:
+            stats[name] = s
+    return stats
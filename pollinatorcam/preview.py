@@ -0,0 +1,288 @@
+"""
+Live preview (mjpeg) of the frames a grabber analyzes
+
+The grabber already decodes the camera substream (see cvcapture) so a
+preview doesn't need another rtsp client on the camera. While someone is
+watching, the grabber hands each frame (and the last rois and detections)
+to a Preview. Viewer threads (of the grabber's metrics server) encode the
+newest frame (downscaled, with overlays) at most rate times a second and
+share it between viewers. Nothing is encoded while nobody is watching.
+
+Served by the grabber at /preview (multipart/x-mixed-replace, viewable
+in a browser) and /preview.jpg (1 frame) on its metrics socket. The ui
+site proxies /preview/<name> to these (see services/pcam-ui.nginx).
+"""
+
+import datetime
+import http.client
+import logging
+import socket
+import threading
+import time
+
+import cv2
+
+
+# frames per second
+default_rate = 2.0
+# preview width in pixels (height keeps the frame aspect ratio)
+default_width = 480
+quality = 70
+# seconds a frame request (/preview.jpg) keeps frames coming
+watch_timeout = 5.0
+# seconds a viewer waits for a frame before giving up
+frame_timeout = 5.0
+# seconds a stream is kept open without new frames (the last frame is
+# resent every frame_timeout so a disconnected viewer is noticed)
+stream_timeout = 30.0
+# concurrent stream viewers
+max_viewers = 4
+
+boundary = 'frame'
+
+# overlay colors (BGR)
+roi_color = (255, 0, 0)
+triggered_color = (0, 0, 255)
+text_color = (255, 255, 255)
+
+
+def draw_overlay(im, scale, rois, detections, triggered, timestamp):
+    """Draw rois (in full frame coordinates) with their top detection"""
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    for i, (t, b, l, r) in enumerate(rois):
+        color = triggered_color if triggered[i] else roi_color
+        pt0 = (int(l * scale), int(t * scale))
+        cv2.rectangle(
+            im, pt0, (int(r * scale) - 1, int(b * scale) - 1), color, 2)
+        if detections[i]:
+            label, score = detections[i][0]
+            cv2.putText(
+                im, '%s %0.2f' % (label, score), (pt0[0] + 4, pt0[1] + 16),
+                font, 0.45, color, 1, cv2.LINE_AA)
+    if timestamp is not None:
+        cv2.putText(
+            im, datetime.datetime.fromtimestamp(timestamp).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            (4, im.shape[0] - 6), font, 0.45, text_color, 1, cv2.LINE_AA)
+    return im
+
+
+class Preview:
+    def __init__(self, rate=None, width=None):
+        if rate is None:
+            rate = default_rate
+        if width is None:
+            width = default_width
+        self.rate = rate
+        self.width = width
+        self.condition = threading.Condition()
+        self.viewers = 0
+        self.last_request = None
+        # newest frame (and time.time() it was captured)
+        self.image = None
+        self.timestamp = None
+        self.sequence = 0
+        # rois, [(label, score), ...] per roi, triggered per roi
+        self.overlay = ([], [], [])
+        # last encoded frame (shared by all viewers)
+        self.jpeg = None
+        self.jpeg_sequence = 0
+        self.last_encode = None
+        self.encoding = False
+
+    def watched(self):
+        """True if frames should be handed to the preview"""
+        if self.rate <= 0:
+            return False
+        if self.viewers > 0:
+            return True
+        return (
+            self.last_request is not None and
+            time.monotonic() - self.last_request < watch_timeout)
+
+    def put(self, image, timestamp=None):
+        """Hand a (BGR) frame to the preview (only keeps a reference)"""
+        if not self.watched():
+            return
+        with self.condition:
+            self.image = image
+            self.timestamp = timestamp
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def set_detections(self, rois, detections, triggered):
+        """rois: [(top, bottom, left, right), ...] in frame pixels
+        detections: [[(label, score), ...] per roi] (highest score first)
+        triggered: [bool per roi]
+        """
+        if not self.watched():
+            return
+        self.overlay = (list(rois), list(detections), list(triggered))
+
+    def encode(self, image, timestamp):
+        h, w = image.shape[:2]
+        scale = min(1.0, self.width / w)
+        if scale < 1.0:
+            im = cv2.resize(
+                image, (self.width, round(h * scale)),
+                interpolation=cv2.INTER_AREA)
+        else:
+            im = image.copy()
+        draw_overlay(im, scale, *self.overlay, timestamp)
+        ok, buf = cv2.imencode(
+            '.jpg', im, (cv2.IMWRITE_JPEG_QUALITY, quality))
+        if not ok:
+            raise IOError("Failed to encode preview")
+        return buf.tobytes()
+
+    def next_jpeg(self, last_sequence=0, timeout=None):
+        """Wait for a frame newer than last_sequence (at most rate per
+        second), returns (sequence, jpeg bytes) or None on timeout"""
+        if timeout is None:
+            timeout = frame_timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if self.jpeg_sequence > last_sequence:
+                    return self.jpeg_sequence, self.jpeg
+                t = time.monotonic()
+                if t >= deadline:
+                    return None
+                next_encode = t
+                if self.last_encode is not None:
+                    next_encode = max(t, self.last_encode + 1. / self.rate)
+                if (
+                        not self.encoding and next_encode <= t and
+                        self.sequence > self.jpeg_sequence):
+                    break
+                # wait for the next frame (or encode time)
+                until = deadline
+                if next_encode > t:
+                    until = min(until, next_encode)
+                self.condition.wait(until - t)
+            self.encoding = True
+            self.last_encode = time.monotonic()
+            image, timestamp, sequence = (
+                self.image, self.timestamp, self.sequence)
+        # encode without holding the lock (so put doesn't block)
+        try:
+            jpeg = self.encode(image, timestamp)
+        finally:
+            with self.condition:
+                self.encoding = False
+                self.condition.notify_all()
+        with self.condition:
+            self.jpeg = jpeg
+            self.jpeg_sequence = sequence
+            self.condition.notify_all()
+        return sequence, jpeg
+
+    def serve_jpeg(self, handler):
+        """Send 1 frame (for http.server request handlers)"""
+        self.last_request = time.monotonic()
+        r = self.next_jpeg(0 if self.jpeg is None else self.jpeg_sequence)
+        if r is None:
+            handler.send_error(503, "No frames")
+            return
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'image/jpeg')
+        handler.send_header('Content-Length', str(len(r[1])))
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+        handler.wfile.write(r[1])
+
+    def serve_mjpeg(self, handler):
+        """Stream frames until the viewer disconnects"""
+        with self.condition:
+            if self.rate <= 0 or self.viewers >= max_viewers:
+                handler.send_error(503, "Preview unavailable")
+                return
+            self.viewers += 1
+        try:
+            handler.send_response(200)
+            handler.send_header(
+                'Content-Type',
+                'multipart/x-mixed-replace; boundary=%s' % boundary)
+            handler.send_header('Cache-Control', 'no-cache')
+            handler.end_headers()
+            sequence = 0
+            jpeg = None
+            last_frame = time.monotonic()
+            while True:
+                r = self.next_jpeg(sequence)
+                if r is not None:
+                    sequence, jpeg = r
+                    last_frame = time.monotonic()
+                elif time.monotonic() - last_frame > stream_timeout:
+                    logging.debug("No preview frames, ending stream")
+                    break
+                elif jpeg is None:  # nothing sent yet, keep waiting
+                    continue
+                # without new frames (capture restarting?) the last frame
+                # is resent so a disconnected viewer frees its slot
+                handler.wfile.write((
+                    '--%s\r\nContent-Type: image/jpeg\r\n'
+                    'Content-Length: %i\r\n\r\n' % (boundary, len(jpeg))
+                ).encode('ascii') + jpeg + b'\r\n')
+                handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.condition:
+                self.viewers -= 1
+            logging.debug("Preview viewer disconnected")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=frame_timeout * 2):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def open_preview(socket_path, path='/preview'):
+    """Request a preview from a grabber socket, returns the response"""
+    conn = UnixHTTPConnection(socket_path)
+    conn.request('GET', path)
+    return conn.getresponse()
+
+
+def test():
+    import numpy
+
+    p = Preview(rate=10.0, width=320)
+    assert not p.watched()
+    p.put(numpy.zeros((480, 640, 3), 'u1'))
+    assert p.image is None  # not watched, not kept
+    p.last_request = time.monotonic()
+    p.set_detections([(10, 110, 20, 120)], [[('bee', 0.9)]], [True])
+
+    def feed():
+        for i in range(30):
+            p.put(numpy.full((480, 640, 3), i, 'u1'), time.time())
+            time.sleep(0.01)
+
+    t0 = time.monotonic()
+    threading.Thread(target=feed, daemon=True).start()
+    sequences = []
+    s = 0
+    while True:
+        r = p.next_jpeg(s, timeout=0.5)
+        if r is None:
+            break
+        s = r[0]
+        sequences.append(s)
+    dt = time.monotonic() - t0 - 0.5
+    im = cv2.imdecode(numpy.frombuffer(p.jpeg, 'u1'), cv2.IMREAD_COLOR)
+    assert im.shape == (240, 320, 3), im.shape
+    # 30 frames over ~0.3 s at 10 fps: only a few encoded
+    assert 1 < len(sequences) <= dt * p.rate + 2, (sequences, dt)
+    print("preview test passed: %s frames encoded" % len(sequences))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,508 @@
+"""
+Prune (and offload to an archive) old data so the data disk never fills
+
+Each category of data (videos, detections...) has a policy:
+- max_age: days to keep files locally (None = forever)
+- max_bytes: max bytes of files kept locally (None = no limit), oldest
+  files are removed first
+- keep_annotated: never remove videos (and their detections) that have
+  annotations (in the sqlite index, see analysis/index_files.py), these
+  categories are not removed at all without an index
+- archive: copy files to the archive before removing them (if False,
+  files are deleted)
+
+Files to archive are put in a (bounded) queue and copied (at a limited
+bandwidth) by a CopyQueue thread. Each copy is verified (sha256 of the
+source and of the copy as read back from the archive) before the local
+file is deleted. If a sqlite index is provided, archived files are added
+to an archive table (path, archive_path, sha256...) and their index rows
+are pointed to the archive copy, deleted files are removed from the index
+tables so the index matches the disk.
+
+Index paths are relative to the directory holding all modules (e.g.
+Module1/videos/<camera>/<day>/<file>.mp4), paths here are relative to the
+data directory (videos/<camera>/...), see index_key.
+
+Policies are loaded from config retention.json (see config.load_config).
+"""
+
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from . import config
+
+
+cfg_name = 'retention.json'
+
+# category: (glob pattern relative to the data directory, index table)
+categories = {
+    'videos': (os.path.join('videos', '*', '*', '*.mp4'), 'videos'),
+    'detections': (
+        os.path.join('detections', '*', '*', '*.json'), 'detections'),
+    'rawdetections': (
+        os.path.join('rawdetections', '*', '*', '*.raw'), None),
+    'timelapse': (
+        os.path.join('[0-9a-f]*', '*-*-*', 'pic_001', '*.jpg'), 'stills'),
+    'overviews': (os.path.join('overviews', '*', '*.mp4'), None),
+}
+
+default_policies = {
+    'videos': {
+        'max_age': 30, 'max_bytes': None,
+        'keep_annotated': True, 'archive': True},
+    'detections': {
+        'max_age': 90, 'max_bytes': None,
+        'keep_annotated': True, 'archive': True},
+    'rawdetections': {
+        'max_age': 7, 'max_bytes': None,
+        'keep_annotated': False, 'archive': False},
+    'timelapse': {
+        'max_age': 60, 'max_bytes': None,
+        'keep_annotated': False, 'archive': True},
+    'overviews': {
+        'max_age': None, 'max_bytes': None,
+        'keep_annotated': False, 'archive': True},
+}
+
+# files modified in the last min_age seconds are never removed
+# (might still be written to)
+min_age = 600.
+# seconds between scans
+default_interval = 3600.
+# archive copy bandwidth (bytes per second, None = unlimited)
+default_bandwidth = 10e6
+# files waiting to be archived
+max_queued = 1000
+# bytes read/written at once when copying and hashing
+chunk_size = 1 << 20
+# seconds around a video to look for annotated stills
+annotation_window = 60
+
+# leading module directory of index paths
+module_pattern = re.compile(r'^Module[0-9]+$')
+
+
+def load_policies():
+    policies = {k: dict(v) for (k, v) in default_policies.items()}
+    for k, v in config.load_config(cfg_name, {}).items():
+        if k not in policies:
+            logging.warning("Unknown retention category: %s", k)
+            continue
+        policies[k].update(v)
+    return policies
+
+
+def file_sha256(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def find_files(data_dir, category):
+    """Returns [(mtime, size, relative path), ...] oldest first"""
+    pattern = categories[category][0]
+    files = []
+    for fn in glob.glob(os.path.join(data_dir, pattern)):
+        try:
+            st = os.stat(fn)
+        except OSError:  # removed while scanning
+            continue
+        files.append((st.st_mtime, st.st_size, os.path.relpath(fn, data_dir)))
+    files.sort()
+    return files
+
+
+def select_files(files, policy, now=None, keep=None):
+    """Select files (relative paths) to remove (oldest first)
+
+    files: [(mtime, size, path), ...] oldest first (see find_files)
+    keep: paths to never select
+    """
+    if now is None:
+        now = time.time()
+    if keep is None:
+        keep = set()
+    selected = []
+    total = sum(f[1] for f in files)
+    max_age = policy.get('max_age', None)
+    max_bytes = policy.get('max_bytes', None)
+    for mtime, size, path in files:
+        age = now - mtime
+        if age < min_age or path in keep:
+            continue
+        if (
+                (max_age is not None and age > max_age * 86400.) or
+                (max_bytes is not None and total > max_bytes)):
+            selected.append(path)
+            total -= size
+    return selected
+
+
+def table_exists(db, name):
+    return db.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
+        (name, )).fetchone() is not None
+
+
+def index_key(path, module=None):
+    """Convert an index path to a path relative to the data directory
+
+    Returns None if path is in a different module (if module is given)
+    """
+    parts = path.split('/')
+    if len(parts) > 1 and module_pattern.match(parts[0]):
+        if module is not None and parts[0] != module:
+            return None
+        parts = parts[1:]
+    elif module is not None:
+        return None
+    return os.path.join(*parts)
+
+
+def index_match(path, module=None):
+    """Returns (sql condition, args) matching index rows for path
+    (relative to the data directory)"""
+    path = path.replace(os.path.sep, '/')
+    if module is not None:
+        return "path=?", (module + '/' + path, )
+    # in any module (or not in a module)
+    suffix = '/' + path
+    return "(path=? OR substr(path, ?)=?)", (path, -len(suffix), suffix)
+
+
+def annotated_videos(db, module=None):
+    """Relative paths of videos with annotated stills (bboxes, labels or
+    tags) of the same camera within annotation_window seconds
+
+    Returns None if the index has no videos or stills (so annotations
+    are unknown)
+    """
+    if not table_exists(db, 'videos') or not table_exists(db, 'stills'):
+        return None
+    tables = [
+        t for t in ('bboxes', 'labels', 'tags') if table_exists(db, t)]
+    if not len(tables):
+        return set()
+    annotated = ' OR '.join(
+        's.still_id IN (SELECT still_id FROM %s)' % t for t in tables)
+    window = '%+i seconds'
+    rows = db.execute(
+        "SELECT v.path FROM videos v WHERE EXISTS ("
+        "SELECT 1 FROM stills s WHERE s.camera_id = v.camera_id AND "
+        "s.timestamp BETWEEN datetime(v.timestamp, ?) AND "
+        "datetime(v.timestamp, ?) AND (%s));" % annotated,
+        (window % -annotation_window, window % annotation_window))
+    keys = set(index_key(r[0], module) for r in rows)
+    keys.discard(None)
+    return keys
+
+
+def load_annotated(database, module=None):
+    """Annotated videos from the index at database (None if unknown)"""
+    if database is None or not os.path.exists(database):
+        return None
+    with sqlite3.connect(database) as db:
+        return annotated_videos(db, module)
+
+
+def video_detection_path(path):
+    """Relative path of the detection (json) saved for a video"""
+    parts = path.split(os.path.sep)
+    parts[0] = 'detections'
+    return os.path.splitext(os.path.join(*parts))[0] + '.json'
+
+
+class CopyQueue(threading.Thread):
+    """Archive (copy, verify then delete) or delete queued files
+
+    files are queued with put(category, relative path, archive)
+    """
+    def __init__(
+            self, data_dir, archive_dir=None, bandwidth=None,
+            database=None, module=None, *args, **kwargs):
+        kwargs['daemon'] = kwargs.get('daemon', True)
+        super(CopyQueue, self).__init__(*args, **kwargs)
+        self.data_dir = data_dir
+        self.archive_dir = archive_dir
+        self.bandwidth = bandwidth
+        self.database = database
+        # index module of data_dir (None to match any module)
+        self.module = module
+        self.db = None
+        self.queue = queue.Queue(max_queued)
+        # paths queued (or being processed) so scans don't requeue
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.keep_running = True
+        self.stats = {
+            'archived': 0, 'deleted': 0, 'failed': 0, 'bytes_copied': 0}
+
+    def put(self, category, path, archive, block=True):
+        with self.lock:
+            if path in self.queued:
+                return False
+            self.queued.add(path)
+        self.queue.put((category, path, archive), block=block)
+        return True
+
+    def copy_file(self, src, dst):
+        """Copy src to dst (at most bandwidth bytes/second), returns sha256
+        of the data read from src"""
+        h = hashlib.sha256()
+        tmp = dst + '.tmp'
+        n = 0
+        t0 = time.monotonic()
+        with open(src, 'rb') as sf, open(tmp, 'wb') as df:
+            for chunk in iter(lambda: sf.read(chunk_size), b''):
+                h.update(chunk)
+                df.write(chunk)
+                n += len(chunk)
+                if self.bandwidth:
+                    # sleep until this many bytes are 'due'
+                    dt = t0 + n / self.bandwidth - time.monotonic()
+                    if dt > 0:
+                        time.sleep(dt)
+            df.flush()
+            os.fsync(df.fileno())
+        os.replace(tmp, dst)
+        self.stats['bytes_copied'] += n
+        return h.hexdigest()
+
+    def archive_file(self, path):
+        """Copy path to the archive and verify, returns (sha256, size)"""
+        src = os.path.join(self.data_dir, path)
+        dst = os.path.join(self.archive_dir, path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        size = os.path.getsize(src)
+        if os.path.exists(dst) and os.path.getsize(dst) == size:
+            # already copied (by an interrupted run?)
+            checksum = file_sha256(src)
+        else:
+            checksum = self.copy_file(src, dst)
+        # read back the copy
+        if file_sha256(dst) != checksum:
+            os.remove(dst)
+            raise IOError("Archive copy of %s failed verification" % path)
+        return checksum, size
+
+    def update_index(self, category, path, archived):
+        if self.db is None:
+            return
+        table = categories[category][1]
+        if table is not None and not table_exists(self.db, table):
+            table = None
+        condition, args = index_match(path, self.module)
+        if archived is not None:
+            checksum, size = archived
+            archive_path = os.path.join(self.archive_dir, path)
+            self.db.execute(
+                "INSERT OR REPLACE INTO archive "
+                "(path, archive_path, sha256, size, timestamp) "
+                "VALUES (?, ?, ?, ?, ?);",
+                (path, archive_path, checksum, size, time.time()))
+            # keep the rows (annotations refer to them) but point them
+            # to the copy
+            if table is not None:
+                self.db.execute(
+                    "UPDATE %s SET path=? WHERE %s;" % (table, condition),
+                    (archive_path, ) + args)
+        elif table is not None:
+            self.db.execute(
+                "DELETE FROM %s WHERE %s;" % (table, condition), args)
+        self.db.commit()
+
+    def remove_empty_directories(self, category, path):
+        """Remove (now) empty directories below the camera directory"""
+        # camera directories are the first (timelapse) or second level
+        top = categories[category][0].split(os.path.sep)[0]
+        camera_depth = 0 if ('*' in top or '[' in top) else 1
+        parts = path.split(os.path.sep)[:-1]
+        while len(parts) > camera_depth + 1:
+            try:
+                os.rmdir(os.path.join(self.data_dir, *parts))
+            except OSError:  # not empty
+                break
+            parts.pop()
+
+    def process(self, category, path, archive):
+        fn = os.path.join(self.data_dir, path)
+        if not os.path.exists(fn):
+            return
+        archived = None
+        if archive:
+            archived = self.archive_file(path)
+        # only delete after the copy is verified
+        os.remove(fn)
+        self.remove_empty_directories(category, path)
+        self.update_index(category, path, archived)
+        if archive:
+            self.stats['archived'] += 1
+            logging.debug("Archived %s", path)
+        else:
+            self.stats['deleted'] += 1
+            logging.debug("Deleted %s", path)
+
+    def connect_database(self):
+        # sqlite connections can only be used in the thread that made them
+        if self.database is None:
+            return
+        self.db = sqlite3.connect(self.database)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS archive ("
+            "path TEXT PRIMARY KEY,"
+            "archive_path TEXT,"
+            "sha256 TEXT,"
+            "size INTEGER,"
+            "timestamp REAL"
+            ");")
+        self.db.commit()
+
+    def run(self):
+        self.connect_database()
+        while self.keep_running:
+            try:
+                category, path, archive = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                self.process(category, path, archive)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logging.warning("Failed to remove %s: %s", path, e)
+            finally:
+                with self.lock:
+                    self.queued.discard(path)
+                self.queue.task_done()
+
+    def stop(self):
+        if self.is_alive():
+            self.keep_running = False
+            self.join()
+
+
+def select_keep(category, policy, keep):
+    """Paths to keep for a category (None if they can't be known)
+
+    keep: annotated videos (see load_annotated)
+    """
+    if not policy.get('keep_annotated', False):
+        return set()
+    if keep is None:
+        return None
+    if category == 'detections':
+        return set(video_detection_path(p) for p in keep)
+    return keep
+
+
+def scan(copier, policies=None, now=None):
+    """Queue files to remove by policy, returns {category: n queued}"""
+    if policies is None:
+        policies = load_policies()
+    keep = None
+    if any(p.get('keep_annotated', False) for p in policies.values()):
+        keep = load_annotated(copier.database, copier.module)
+    queued = {}
+    for category, policy in policies.items():
+        archive = policy.get('archive', False)
+        if archive and copier.archive_dir is None:
+            logging.warning(
+                "No archive, not removing %s (policy requires archive)",
+                category)
+            continue
+        category_keep = select_keep(category, policy, keep)
+        if category_keep is None:
+            logging.warning(
+                "No index of annotations, not removing %s "
+                "(policy keeps annotated)", category)
+            continue
+        files = find_files(copier.data_dir, category)
+        selected = select_files(files, policy, now, category_keep)
+        queued[category] = sum(
+            copier.put(category, path, archive) for path in selected)
+        if queued[category]:
+            logging.info(
+                "Queued %i of %i %s files for %s", queued[category],
+                len(files), category, 'archive' if archive else 'deletion')
+    return queued
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--archive_dir', type=str, default=None,
+        help='archive directory (files are deleted after archiving)')
+    parser.add_argument(
+        '-b', '--database', type=str, default=None,
+        help='sqlite index to keep consistent')
+    parser.add_argument(
+        '-B', '--bandwidth', type=float, default=default_bandwidth / 1e6,
+        help='archive copy bandwidth (MB/s, 0 = unlimited)')
+    parser.add_argument(
+        '-d', '--data_dir', type=str, default='/mnt/data',
+        help='data directory')
+    parser.add_argument(
+        '-i', '--interval', type=float, default=default_interval,
+        help='seconds between scans')
+    parser.add_argument(
+        '-M', '--module', type=str, default=None,
+        help='index module of the data directory (default match any)')
+    parser.add_argument(
+        '-n', '--dry_run', action='store_true',
+        help='only report what would be removed')
+    parser.add_argument(
+        '-o', '--once', action='store_true',
+        help='scan and remove files once then exit')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='enable verbose output')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    policies = load_policies()
+    if args.dry_run:
+        keep = load_annotated(args.database, args.module)
+        for category, policy in policies.items():
+            category_keep = select_keep(category, policy, keep)
+            if category_keep is None:
+                print("%s: not removed (no index of annotations)" % (
+                    category, ))
+                continue
+            files = find_files(args.data_dir, category)
+            selected = select_files(files, policy, keep=category_keep)
+            print("%s: %i of %i files would be %s" % (
+                category, len(selected), len(files),
+                'archived' if policy.get('archive') else 'deleted'))
+        return
+
+    copier = CopyQueue(
+        args.data_dir, args.archive_dir, args.bandwidth * 1e6 or None,
+        args.database, args.module)
+    copier.start()
+    while True:
+        scan(copier, policies)
+        # wait for the queue to empty before rescanning
+        copier.queue.join()
+        logging.info("Retention stats: %s", copier.stats)
+        if args.once:
+            break
+        time.sleep(args.interval)
+        policies = load_policies()
+    copier.stop()
+
+
+if __name__ == '__main__':
+    cmdline_run()
@@ -0,0 +1,287 @@
+"""
+Simulate triggered recording (see trigger.Trigger) for whole detection logs
+
+simulate_trigger computes the recording intervals Trigger would produce
+(min/max/post times, duty cycle hold off) for arrays of analyzed frame times
+and detection states. Edges are found with numpy and each triggered period
+is resolved in closed form (recordings during a long trigger repeat every
+max_time + hold off) so the state machine isn't stepped for every frame.
+
+Run this module to estimate recording seconds and disk use per camera
+per day from raw detection logs (see logger.AnalysisResultsSaver):
+    python -m pollinatorcam.simtrigger -d /mnt/data
+"""
+
+import argparse
+import datetime
+import glob
+import os
+
+import numpy
+
+from . import config
+from . import dahuacam
+from . import logger
+
+
+default_recording = {
+    'duty_cycle': 0.1,
+    'post_time': 5.0,
+    'min_time': 10.0,
+    'max_time': 20.0,
+}
+
+
+def main_bitrate():
+    """Main stream bitrate (kbits/second) of the desired video config"""
+    for name, prefix, cfg in dahuacam.video_config():
+        if name == 'main':
+            return float(dict(cfg)['BitRate'])
+    raise ValueError("No main stream in video config")
+
+
+def simulate_trigger(
+        times, states, duty_cycle=0.1, post_time=1.0, min_time=3.0,
+        max_time=10.0, end=None):
+    """Compute recording intervals for analyzed frames
+
+    times: analyzed frame times (seconds, increasing)
+    states: trigger state (bool) of each analyzed frame
+    end: end of simulation (default last frame time), recording
+         intervals are clipped to end
+
+    Returns (n, 2) array of [start, stop) recording times
+    """
+    times = numpy.asarray(times, dtype='f8')
+    states = numpy.asarray(states, dtype=bool)
+    assert times.shape == states.shape
+    if end is None:
+        end = times[-1] if len(times) else 0.
+    if not len(times):
+        return numpy.empty((0, 2))
+
+    # rising/falling edges, each rising edge is followed by a falling
+    # edge (or the trigger is still high at the end)
+    previous = numpy.concatenate(([False], states[:-1]))
+    rising = times[states & ~previous]
+    falling = times[~states & previous]
+    falling = numpy.concatenate(
+        (falling, numpy.full(len(rising) - len(falling), numpy.inf)))
+
+    hold_off_dt = (max_time + post_time) * (1. / duty_cycle - 1.)
+    period = max_time + hold_off_dt
+    intervals = []
+    # start and (post_time/min_time) stop of the recording
+    # left running after the last falling edge
+    active_start = None
+    stop = None
+    for r, f in zip(rising.tolist(), falling.tolist()):
+        if active_start is not None and r < stop:
+            # triggered again before the last recording stopped
+            start = active_start
+            intervals.pop()
+        else:
+            start = r
+        t = min(f, end)
+        if duty_cycle == 1.0:
+            # never stopped while triggered
+            active_start = start
+        else:
+            # first recording stops at max_time (or now if triggered
+            # again after max_time)
+            first_stop = max(start + max_time, r)
+            if t < first_stop:
+                active_start = start
+            else:
+                intervals.append((start, first_stop))
+                # restart after each hold off
+                starts = (
+                    first_stop + hold_off_dt +
+                    numpy.arange(
+                        max(0, int((t - first_stop - hold_off_dt) // period)
+                            + 1)) * period)
+                starts = starts[starts <= t]
+                if len(starts) and t < starts[-1] + max_time:
+                    # still recording at the falling edge
+                    active_start = starts[-1]
+                    starts = starts[:-1]
+                else:
+                    # in hold off, the falling edge starts a recording
+                    active_start = t
+                intervals.extend(zip(
+                    starts.tolist(), (starts + max_time).tolist()))
+        if f == numpy.inf:
+            # still triggered at the end
+            intervals.append((active_start, end))
+            break
+        stop = max(f + post_time, active_start + min_time)
+        intervals.append((active_start, stop))
+
+    intervals = numpy.array(intervals, dtype='f8').reshape(-1, 2)
+    intervals[:, 1] = numpy.minimum(intervals[:, 1], end)
+    return intervals[intervals[:, 0] < intervals[:, 1]]
+
+
+def step_trigger(
+        times, states, duty_cycle=0.1, post_time=1.0, min_time=3.0,
+        max_time=10.0, end=None):
+    """Compute recording intervals by stepping trigger.Trigger (in simulated
+    time), slow but used to check simulate_trigger"""
+    # trigger imports gstrecorder (gst) which isn't needed otherwise
+    from . import clock
+    from . import trigger
+
+    class IntervalTrigger(trigger.Trigger):
+        def __init__(self, *args, **kwargs):
+            super(IntervalTrigger, self).__init__(*args, **kwargs)
+            self.intervals = []
+
+        def activate(self, t):
+            super(IntervalTrigger, self).activate(t)
+            self.intervals.append([t, None])
+
+        def deactivate(self, t):
+            super(IntervalTrigger, self).deactivate(t)
+            self.intervals[-1][1] = t
+
+    if end is None:
+        end = times[-1] if len(times) else 0.
+    sim_clock = clock.SimulatedClock(times[0] if len(times) else 0.)
+    trig = IntervalTrigger(
+        duty_cycle, post_time, min_time, max_time, clock=sim_clock)
+    for t, s in zip(times, states):
+        # timers due before (or at) this frame run first
+        sim_clock.advance(t - sim_clock.time())
+        trig.set_trigger(bool(s), {})
+    sim_clock.advance(max(0., end - sim_clock.time()))
+    trig.cancel_timer()
+    intervals = numpy.array([
+        (start, end if stop is None else min(stop, end))
+        for (start, stop) in trig.intervals], dtype='f8').reshape(-1, 2)
+    return intervals[intervals[:, 0] < intervals[:, 1]]
+
+
+def recording_seconds_per_day(intervals):
+    """Returns {date: recording seconds} splitting intervals at (local)
+    midnight"""
+    if not len(intervals):
+        return {}
+    day = datetime.datetime.fromtimestamp(intervals[0, 0]).date()
+    last_day = datetime.datetime.fromtimestamp(intervals[-1, 1]).date()
+    seconds = {}
+    while day <= last_day:
+        day_start = datetime.datetime.combine(day, datetime.time()).timestamp()
+        day += datetime.timedelta(days=1)
+        day_end = datetime.datetime.combine(day, datetime.time()).timestamp()
+        overlap = (
+            numpy.minimum(intervals[:, 1], day_end) -
+            numpy.maximum(intervals[:, 0], day_start))
+        seconds[day - datetime.timedelta(days=1)] = float(
+            overlap[overlap > 0].sum())
+    return seconds
+
+
+def load_raw_detections(directory):
+    """Load (times, states) from all raw detection logs in directory
+    (data_dir/rawdetections/<camera>)"""
+    times = []
+    states = []
+    for fn in sorted(glob.glob(os.path.join(directory, '*', '*.raw'))):
+        records = logger.load_raw_file(fn)
+        times.append(numpy.array(records['timestamp']))
+        states.append(records['detection'] != 0)
+    if not len(times):
+        return numpy.empty(0), numpy.empty(0, dtype=bool)
+    times = numpy.concatenate(times)
+    states = numpy.concatenate(states)
+    order = numpy.argsort(times, kind='stable')
+    return times[order], states[order]
+
+
+def test(n_trials=200, seed=0):
+    """Check simulate_trigger against stepping trigger.Trigger"""
+    rng = numpy.random.default_rng(seed)
+    for i in range(n_trials):
+        params = {
+            'duty_cycle': rng.choice([0.05, 0.1, 0.5, 1.0]),
+            'post_time': float(rng.choice([0.5, 1.0, 5.0, 30.0])),
+            'min_time': float(rng.choice([0.5, 3.0, 10.0])),
+            'max_time': float(rng.choice([2.0, 10.0, 20.0])),
+        }
+        n = int(rng.integers(1, 2000))
+        # irregular (stalled) analysis, bursty detections
+        times = numpy.cumsum(rng.choice(
+            [0.1, 0.5, 1.0, 1.0, 1.0, 7.0, 30.0], size=n))
+        p = rng.choice([0.01, 0.2, 0.8])
+        states = numpy.cumsum(rng.random(n) < p) % 2 == 1
+        end = times[-1] + float(rng.choice([0., 100.]))
+        fast = simulate_trigger(times, states, end=end, **params)
+        slow = step_trigger(times, states, end=end, **params)
+        if fast.shape != slow.shape or not numpy.allclose(fast, slow):
+            raise Exception(
+                "simulate_trigger mismatch [%s]: %s != %s" % (
+                    params, fast, slow))
+    print("simulate_trigger matched Trigger in %i trials" % n_trials)
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b', '--bitrate', type=float, default=None,
+        help='recording bitrate (kbits/second), default from video config')
+    parser.add_argument(
+        '-c', '--camera', type=str, action='append', default=[],
+        help='camera name (can be provided more than once), default all')
+    parser.add_argument(
+        '-d', '--data_dir', type=str, default='/mnt/data',
+        help='data directory (with rawdetections)')
+    parser.add_argument(
+        '-D', '--duty_cycle', type=float, default=None,
+        help='override duty cycle')
+    parser.add_argument(
+        '-m', '--min_time', type=float, default=None,
+        help='override min time')
+    parser.add_argument(
+        '-M', '--max_time', type=float, default=None,
+        help='override max time')
+    parser.add_argument(
+        '-p', '--post_time', type=float, default=None,
+        help='override post time')
+    parser.add_argument(
+        '-t', '--test', action='store_true',
+        help='check simulation against trigger.Trigger and exit')
+    args = parser.parse_args()
+
+    if args.test:
+        return test()
+
+    bitrate = args.bitrate
+    if bitrate is None:
+        bitrate = main_bitrate()
+    raw_dir = os.path.join(args.data_dir, 'rawdetections')
+    names = args.camera
+    if not len(names):
+        names = sorted(os.listdir(raw_dir))
+
+    total_seconds = 0.
+    for name in names:
+        # camera recording config (or defaults), with overrides
+        params = dict(default_recording)
+        cfg = config.load_config(name, {}) or {}
+        params.update(cfg.get('recording', {}))
+        for k in params:
+            if getattr(args, k) is not None:
+                params[k] = getattr(args, k)
+        times, states = load_raw_detections(os.path.join(raw_dir, name))
+        intervals = simulate_trigger(times, states, **params)
+        for day, seconds in sorted(recording_seconds_per_day(
+                intervals).items()):
+            total_seconds += seconds
+            print("%s %s: %0.1f seconds recorded, %0.1f MB" % (
+                name, day, seconds, seconds * bitrate / 8000.))
+    print("Total: %0.1f seconds recorded, %0.1f MB" % (
+        total_seconds, total_seconds * bitrate / 8000.))
+
+
+if __name__ == '__main__':
+    cmdline_run()
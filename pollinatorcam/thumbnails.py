@@ -0,0 +1,154 @@
+"""
+Downscaled (jpeg) copies of camera snapshots, made on demand
+
+Full snapshots (2592 x 1944) are much larger than the 400 pixel wide
+canvas of the ui. Thumbnails are decoded at a reduced size (libjpeg
+can skip most of the work for 1/2, 1/4 and 1/8 scales), resized and
+cached in memory (least recently used dropped beyond max_bytes).
+
+Thumbnails are keyed by file, modification time, file size and width so
+an overwritten file gets a new thumbnail (and etag).
+"""
+
+import collections
+import hashlib
+import os
+import threading
+
+import cv2
+
+
+# widths are clamped to this range (pixels)
+min_width = 16
+max_width = 1024
+# jpeg quality of thumbnails
+quality = 80
+# total bytes of cached thumbnails
+default_max_bytes = 32 * 1024 * 1024
+
+# imread flags by reduction factor
+reduced_flags = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def clamp_width(width):
+    return max(min_width, min(max_width, int(width)))
+
+
+def file_key(filename):
+    """Return (filename, mtime_ns, size) identifying a version of a file"""
+    st = os.stat(filename)
+    return filename, st.st_mtime_ns, st.st_size
+
+
+def make_etag(key, width=None):
+    return hashlib.sha1(repr((key, width)).encode('utf-8')).hexdigest()
+
+
+def make_thumbnail(filename, width, full_width=None):
+    """Read filename at reduced size and encode a width wide jpeg,
+    returns (jpeg bytes, full image width)
+
+    full_width: width of the full image (if known) to pick a reduced
+    decode that is at least width wide
+    """
+    im = None
+    factor = 1
+    if full_width is not None:
+        for factor, flag in reduced_flags:
+            if full_width // factor >= width:
+                im = cv2.imread(filename, flag)
+                break
+        # not the expected size, read the full image
+        if im is not None and im.shape[1] < width:
+            im = None
+    if im is None:
+        factor = 1
+        im = cv2.imread(filename, cv2.IMREAD_COLOR)
+    if im is None:
+        raise IOError("Failed to read image %s" % filename)
+    h, w = im.shape[:2]
+    full_width = w * factor
+    if w > width:
+        im = cv2.resize(
+            im, (width, max(1, round(h * width / w))),
+            interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode(
+        '.jpg', im, (cv2.IMWRITE_JPEG_QUALITY, quality))
+    if not ok:
+        raise IOError("Failed to encode thumbnail of %s" % filename)
+    return buf.tobytes(), full_width
+
+
+class ThumbnailCache:
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = default_max_bytes
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+        # (file key, width): jpeg bytes
+        self.thumbnails = collections.OrderedDict()
+        # full image widths by directory (all snapshots from 1 camera
+        # have the same size)
+        self.full_widths = {}
+
+    def get(self, filename, width):
+        """Return (jpeg bytes, etag) of a thumbnail of filename"""
+        width = clamp_width(width)
+        key = file_key(filename)
+        cache_key = (key, width)
+        with self.lock:
+            data = self.thumbnails.get(cache_key, None)
+            if data is not None:
+                self.thumbnails.move_to_end(cache_key)
+                return data, make_etag(key, width)
+        directory = os.path.dirname(filename)
+        data, full_width = make_thumbnail(
+            filename, width, self.full_widths.get(directory, None))
+        with self.lock:
+            self.full_widths[directory] = full_width
+            if cache_key not in self.thumbnails:
+                self.thumbnails[cache_key] = data
+                self.n_bytes += len(data)
+            while self.n_bytes > self.max_bytes and self.thumbnails:
+                _, old = self.thumbnails.popitem(last=False)
+                self.n_bytes -= len(old)
+        return data, make_etag(key, width)
+
+
+def test():
+    import tempfile
+    import time
+
+    import numpy
+
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, '12.00.00[M][0@0][0].jpg')
+        im = numpy.random.randint(0, 255, (1944, 2592, 3), dtype='u1')
+        cv2.imwrite(fn, im)
+        cache = ThumbnailCache(max_bytes=200000)
+        t0 = time.perf_counter()
+        data, etag = cache.get(fn, 400)
+        t1 = time.perf_counter()
+        data, etag = cache.get(fn, 400)
+        t2 = time.perf_counter()
+        # 2nd thumbnail uses a reduced decode
+        cache.get(fn, 300)
+        t3 = time.perf_counter()
+        thumb = cv2.imdecode(numpy.frombuffer(data, 'u1'), cv2.IMREAD_COLOR)
+        assert thumb.shape == (300, 400, 3), thumb.shape
+        assert etag != make_etag(file_key(fn), 300)
+        print(
+            "full decode %0.1f ms, cached %0.3f ms, reduced decode %0.1f ms"
+            % ((t1 - t0) * 1e3, (t2 - t1) * 1e3, (t3 - t2) * 1e3))
+        assert cache.get(fn, 100000)[0] != data  # clamped to max_width
+        assert cache.n_bytes <= cache.max_bytes
+    print("thumbnails test passed")
+
+
+if __name__ == '__main__':
+    test()
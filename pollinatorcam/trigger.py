@@ -27,11 +27,13 @@ Duty cycle limit only during triggered period
 import datetime
 #import json
 import logging
+import threading
 import time
 import os
 
 import numpy
 
+from . import clock as pcam_clock
 from . import gstrecorder
 
 
@@ -214,8 +216,23 @@ class RunningThreshold:
 
 
 class Trigger:
+    """Trigger state machine (see module docstring)
+
+    set_trigger is called for each analyzed frame. Time based transitions
+    (max_time, hold off, post_time and min_time) are also run by a timer
+    (from clock) at the time they are due so they happen on time even if
+    frames are analyzed late (or not at all).
+
+    on_activate(meta, last_meta) is called (from the timer, with the
+    trigger locked) when a timer starts a recording, as no frame (and so
+    no set_trigger return) is there to save the meta.
+    """
+    # meta keys set by activate (not copied to timer metas)
+    activation_keys = ('filename', 'video_index', 'admission')
+
     def __init__(
-            self, duty_cycle, post_time, min_time, max_time):
+            self, duty_cycle, post_time, min_time, max_time, clock=None,
+            on_activate=None):
         self.duty_cycle = duty_cycle
         self.min_time = min_time
         self.max_time = max_time
@@ -225,6 +242,14 @@ class Trigger:
         self.hold_off_dt = (max_time + post_time) * (1. / self.duty_cycle - 1.)
         self.triggered = False
 
+        if clock is None:
+            clock = pcam_clock.default_clock
+        self.clock = clock
+        self.timer = None
+        self.on_activate = on_activate
+        # set_trigger and timers can be called from different threads
+        self.lock = threading.RLock()
+
         self.times = {}
         self.meta = {}
 
@@ -237,15 +262,24 @@ class Trigger:
     def deactivate(self, t):
         self.active = False
 
+    def set_limits(self, duty_cycle, max_time):
+        """Change duty_cycle and max_time (and so the hold off)"""
+        with self.lock:
+            self.duty_cycle = duty_cycle
+            self.max_time = max_time
+            self.hold_off_dt = (
+                (max_time + self.post_time) * (1. / duty_cycle - 1.))
+            self.schedule_timer()
+
     def rising_edge(self):
-        self.times['rising'] = time.monotonic()
+        self.times['rising'] = self.clock.time()
         if not self.active:
             self.activate(self.times['rising'])
             return True
         return False
 
     def falling_edge(self):
-        self.times['falling'] = time.monotonic()
+        self.times['falling'] = self.clock.time()
         if 'hold_off' in self.times:
             del self.times['hold_off']
         if not self.active:
@@ -254,12 +288,14 @@ class Trigger:
         return False
 
     def high(self):
-        t = time.monotonic()
+        t = self.clock.time()
         if 'rising' not in self.times:
             self.rising_edge()
         # check duty cycle
         if self.active:
-            if t - self.times['start'] >= self.max_time:
+            # compare to the same sums as next_transition_time so timers
+            # are never (by rounding) a hair early
+            if t >= self.times['start'] + self.max_time:
                 if self.duty_cycle != 1.0:
                     # stop recording, go into hold off
                     self.deactivate(t)
@@ -272,35 +308,103 @@ class Trigger:
 
     def low(self):
         if self.active:
-            t = time.monotonic()
+            t = self.clock.time()
             if 'falling' not in self.times:
                 self.falling_edge()
             # stop after post_record and min_time
             if (
-                    (t - self.times['falling'] >= self.post_time) and
-                    (t - self.times['start'] >= self.min_time)):
+                    (t >= self.times['falling'] + self.post_time) and
+                    (t >= self.times['start'] + self.min_time)):
                 self.deactivate(t)
         return False
 
-    def set_trigger(self, trigger, meta):
-        self.last_meta = self.meta
-        self.meta = meta
-        if self.triggered:
-            if trigger:
-                self.meta['state'] = 'high'
+    def next_transition_time(self):
+        """Time of the next time based transition (or None)"""
+        if self.active:
+            if self.triggered:
+                if self.duty_cycle != 1.0:
+                    # stop at max time
+                    return self.times['start'] + self.max_time
+            elif 'falling' in self.times:
+                # stop after post_time and min_time
+                return max(
+                    self.times['falling'] + self.post_time,
+                    self.times['start'] + self.min_time)
+        elif self.triggered and 'hold_off' in self.times:
+            # restart after hold off
+            return self.times['hold_off']
+        return None
+
+    def schedule_timer(self):
+        t = self.next_transition_time()
+        if self.timer is not None:
+            if t is not None and self.timer.t == t:
+                return
+            self.timer.cancel()
+            self.timer = None
+        if t is not None:
+            self.timer = self.clock.call_at(t, self.on_timer)
+
+    def timer_meta(self):
+        """Meta for a timer transition: a copy of the last frame's meta
+        (detections...) with the current time"""
+        meta = {
+            k: v for (k, v) in self.meta.items()
+            if k not in self.activation_keys}
+        dt = datetime.datetime.now()
+        meta['datetime'] = dt
+        meta['timestamp'] = dt.strftime('%y%m%d_%H%M%S_%f')
+        meta['state'] = 'timer'
+        return meta
+
+    def on_timer(self):
+        with self.lock:
+            self.timer = None
+            # no new frame, start a new meta so a new recording started
+            # here doesn't reuse the last frame's filename
+            self.last_meta = self.meta
+            self.meta = self.timer_meta()
+            if self.triggered:
                 r = self.high()
             else:
-                self.meta['state'] = 'falling_edge'
-                r = self.falling_edge()
-        else:
-            if trigger:
-                self.meta['state'] = 'rising_edge'
-                r = self.rising_edge()
-            else:
-                self.meta['state'] = 'low'
                 r = self.low()
-        self.triggered = trigger
-        return r
+            self.schedule_timer()
+            if r and self.on_activate is not None:
+                self.on_activate(self.meta, self.last_meta)
+
+    def cancel_timer(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def set_trigger(self, trigger, meta):
+        """Update trigger state for an analyzed frame
+
+        Returns (True if a recording was started, meta, last_meta), metas
+        are returned as they were saved (a timer can replace them
+        as soon as this returns)
+        """
+        with self.lock:
+            self.last_meta = self.meta
+            self.meta = meta
+            if self.triggered:
+                if trigger:
+                    self.meta['state'] = 'high'
+                    r = self.high()
+                else:
+                    self.meta['state'] = 'falling_edge'
+                    r = self.falling_edge()
+            else:
+                if trigger:
+                    self.meta['state'] = 'rising_edge'
+                    r = self.rising_edge()
+                else:
+                    self.meta['state'] = 'low'
+                    r = self.low()
+            self.triggered = trigger
+            self.schedule_timer()
+            return r, self.meta, self.last_meta
 
     def __call__(self, trigger, meta):
         return self.set_trigger(trigger, meta)
@@ -309,12 +413,16 @@ class Trigger:
 class TriggeredRecording(Trigger):
     def __init__(
             self, url, directory, name,
-            duty_cycle=0.1, post_time=1.0, min_time=3.0, max_time=10.0):
+            duty_cycle=0.1, post_time=1.0, min_time=3.0, max_time=10.0,
+            clock=None, admission=None, on_activate=None):
         self.directory = directory
         self.name = name
+        # limit recordings as the disk fills (see admission.Admission)
+        self.admission = admission
+        self.limits = (duty_cycle, max_time)
         #self.filename_gen = filename_gen
         super(TriggeredRecording, self).__init__(
-            duty_cycle, post_time, min_time, max_time)
+            duty_cycle, post_time, min_time, max_time, clock, on_activate)
 
         #self.ip = ip
         self.url = url
@@ -355,10 +463,32 @@ class TriggeredRecording(Trigger):
             d,
             '%s_%s.mp4' % (dt.strftime('%H%M%S_%f'), self.name))
 
+    def check_admission(self):
+        """Check (and apply) admission limits, returns True if a video
+        can be recorded"""
+        if self.admission is None:
+            return True
+        duty_cycle, max_time = self.limits
+        decision = self.admission.check(duty_cycle, max_time, self.min_time)
+        self.meta['admission'] = decision
+        if (
+                decision['duty_cycle'] != self.duty_cycle or
+                decision['max_time'] != self.max_time):
+            logging.info(
+                "Limiting recording: duty_cycle %0.3f, max_time %0.1f",
+                decision['duty_cycle'], decision['max_time'])
+            self.set_limits(decision['duty_cycle'], decision['max_time'])
+        return decision['admit']
+
     def activate(self, t):
         super(TriggeredRecording, self).activate(t)
         if self.recorder.filename is not None:
             self.recorder.stop_saving()  # TODO instead switch files?
+            self.filename = None
+
+        if not self.check_admission():
+            logging.info("Recording not admitted (snapshot only)")
+            return
 
         # make new filename
         self.index += 1
@@ -375,6 +505,8 @@ class TriggeredRecording(Trigger):
         print("~~~ Started recording [%s] ~~~" % vfn)
         self.recorder.start_saving(vfn)
         self.filename = vfn
+        if self.admission is not None:
+            self.admission.add_recording(vfn)
 
         # save meta (and last_meta) data here
         #mfn = os.path.splitext(vfn)[0] + '.json'
@@ -399,88 +531,106 @@ class TriggeredRecording(Trigger):
 
 
 def test():
-
-    def run_trigger(trig, N, ts_func, tick=0.001): 
-        # run trigger for N seconds, monitor on/off times
-        st = time.monotonic()
-        stats = {
-            'start': st,
-            'on_times': [],
-            'off_times': [],
-            'on_time': 0.,
-            'off_time': 0.,
+    """Test trigger timing in simulated time"""
+
+    class TestTrigger(Trigger):
+        # record (simulated) activation/deactivation times
+        def __init__(self, *args, **kwargs):
+            super(TestTrigger, self).__init__(*args, **kwargs)
+            self.transitions = []
+
+        def activate(self, t):
+            super(TestTrigger, self).activate(t)
+            self.transitions.append((t, True))
+
+        def deactivate(self, t):
+            super(TestTrigger, self).deactivate(t)
+            self.transitions.append((t, False))
+
+    def run_trigger(
+            N, ts_func, tick=1.0, duty=0.1, post_time=1.0, min_time=3.0,
+            max_time=10.0):
+        # run trigger for N seconds analyzing a frame every tick seconds
+        # ts_func(t) returns the trigger state at time t (or None if the
+        # frame isn't analyzed)
+        clock = pcam_clock.SimulatedClock()
+        trig = TestTrigger(duty, post_time, min_time, max_time, clock=clock)
+        n_ticks = int(round(N / tick))
+        for i in range(n_ticks):
+            state = ts_func(clock.time())
+            if state is not None:
+                trig.set_trigger(state, {})
+            clock.advance(tick)
+        on_time = 0.
+        start = None
+        for t, active in trig.transitions:
+            if active and start is None:
+                start = t
+            elif not active and start is not None:
+                on_time += t - start
+                start = None
+        if start is not None:
+            on_time += N - start
+        return {
+            'transitions': trig.transitions,
+            'on_time': on_time,
+            'duty': on_time / N,
         }
-        t = st
-        s = None
-        last_state_change_time = None
-        while t - st <= N:
-            dt = t - st
-            trig.set_trigger(ts_func(dt), {})
-            if s is not None:
-                if s and not trig.active:  # trigger deactivated
-                    stats['on_time'] += (
-                        t - last_state_change_time)
-                    last_state_change_time = t
-                    stats['off_times'].append(dt)
-                elif not s and trig.active:  # trigger activated
-                    stats['off_time'] += (
-                        t - last_state_change_time)
-                    last_state_change_time = t
-                    stats['on_times'].append(dt)
-            else:
-                if trig.active:
-                    stats['on_times'].append(dt)
-                else:
-                    stats['off_times'].append(dt)
-                last_state_change_time = t
-            s = trig.active
-            time.sleep(tick)
-            t = time.monotonic()
-
-        # add last period
-        if trig.active:
-            stats['on_time'] += (t - last_state_change_time)
-        else:
-            stats['off_time'] += (t - last_state_change_time)
-
-        stats['duty'] = stats['on_time'] / N
-        return stats
-
-
-    N = 1.0
-    duty = 0.01
-    post_time = 0.001
-    min_time = 0.005
-    max_time = 0.01
 
+    t0 = time.monotonic()
     acceptable_duty_error = 0.1
 
-    # test all on
-    trig = Trigger(duty, post_time, min_time, max_time)
-    stats = run_trigger(trig, N, lambda dt: True)
-    if abs(stats['duty'] - duty) > (duty * acceptable_duty_error):
-        raise Exception("Bad duty cycle: %s != %s" % (stats['duty'], duty))
-
-    # across various duty cycles
+    # across various duty cycles (with a short post time so the duty
+    # cycle is close to the requested)
     for dc in (0.01, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0):
-        trig = Trigger(dc, post_time, min_time, max_time)
-        stats = run_trigger(trig, N, lambda dt: True)
+        stats = run_trigger(
+            10000, lambda t: True, tick=0.1, duty=dc, post_time=0.01)
         if abs(stats['duty'] - dc) > (dc * acceptable_duty_error):
             raise Exception("Bad duty cycle: %s != %s" % (stats['duty'], dc))
-        print(dc, stats['duty'])
 
     # test all off
-    trig = Trigger(duty, post_time, min_time, max_time)
-    stats = run_trigger(trig, N, lambda dt: False)
-    assert stats['duty'] < acceptable_duty_error
-
-    # test min time
-    N = 0.015
-    trig = Trigger(duty, post_time, min_time, max_time)
-    stats = run_trigger(trig, N, lambda dt: dt < 0.002, tick=0.0001)
-    assert abs(stats['on_time'] - min_time) < 0.005
-
-    # test max time
-    trig = Trigger(duty, post_time, min_time, max_time)
-    stats = run_trigger(trig, N, lambda dt: True, tick=0.0001)
-    assert abs(stats['on_time'] - max_time) < 0.005
+    stats = run_trigger(100, lambda t: False)
+    assert stats['on_time'] == 0.
+    assert len(stats['transitions']) == 0
+
+    # test min time: short trigger records for min_time
+    stats = run_trigger(20, lambda t: t < 0.5, tick=0.5)
+    assert stats['transitions'] == [(0., True), (3., False)], stats
+
+    # test post time: recording continues post_time after falling edge
+    stats = run_trigger(20, lambda t: t < 5, tick=0.5)
+    assert stats['transitions'] == [(0., True), (6., False)], stats
+
+    # test max time: stops at max_time then restarts after hold off
+    stats = run_trigger(200, lambda t: True, tick=0.5)
+    hold_off_dt = (10. + 1.) * (1. / 0.1 - 1.)
+    assert stats['transitions'][:3] == [
+        (0., True), (10., False), (10. + hold_off_dt, True)], stats
+
+    # analysis stalls after the first frame: transitions still happen
+    # on time (not at the next analyzed frame)
+    stats = run_trigger(20, lambda t: True if t == 0 else None, tick=0.5)
+    assert stats['transitions'] == [(0., True), (10., False)], stats
+    stats = run_trigger(
+        20, lambda t: {0.: True, 1.: False}.get(t, None), tick=0.5)
+    assert stats['transitions'] == [(0., True), (3., False)], stats
+
+    # slow analysis (1 frame every 7 seconds): stop is not late
+    stats = run_trigger(40, lambda t: t < 1, tick=7.0)
+    assert stats['transitions'] == [(0., True), (8., False)], stats
+
+    # a hold off restart (by the timer) reports the frame's meta
+    activations = []
+    clock = pcam_clock.SimulatedClock()
+    trig = Trigger(
+        0.5, 1.0, 3.0, 10.0, clock=clock,
+        on_activate=lambda m, lm: activations.append((m, lm)))
+    r, meta, last_meta = trig.set_trigger(True, {'detections': 1})
+    assert r and meta['state'] == 'rising_edge'
+    clock.advance(40.)
+    assert len(activations) == 1, activations
+    meta, last_meta = activations[0]
+    assert meta['state'] == 'timer' and meta['detections'] == 1, meta
+    assert 'datetime' in meta
+
+    print("Trigger tests passed in %0.3f seconds" % (time.monotonic() - t0))
@@ -6,7 +6,7 @@ Functions
 - camera status
   - name & ip
   - systemd service status and up time
-  - recording state (can I get this?)
+  - recording state (see /perf)
   - link to open in vlc [make from ip & PCAM_* env vars]
   - link to most recent snapshot
   - link to data for yesterday & today [requires static file serving]
@@ -17,7 +17,7 @@ Functions
 """
 
 import datetime
-import glob
+import hashlib
 import shutil
 import os
 
@@ -25,13 +25,21 @@ import flask
 
 from . import config
 from . import discover
+from . import fileindex
 from . import grabber
+from . import media
+from . import perfstats
+from . import preview
+from . import thumbnails
 
 
 this_dir = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
 app = flask.Flask(
     'pcam', static_folder=os.path.join(this_dir, 'static'))
 
+# number of most recent detections (per camera) returned by /cameras
+n_recent_detections = 500
+
 
 @app.route("/", methods=["GET"])
 def index():
@@ -56,6 +64,18 @@ def disk_info():
     })
 
 
+@app.route("/perf", methods=["GET"])
+@app.route("/perf/<name>", methods=["GET"])
+def perf(name=None):
+    # read from shared memory stats written by each grabber
+    if name is None:
+        return flask.jsonify(perfstats.read_all_stats())
+    stats = perfstats.read_stats(name)
+    if stats is None:
+        return flask.abort(404)
+    return flask.jsonify(stats)
+
+
 @app.route("/freeze", methods=["POST"])
 def freeze_camera_configs():
     # write all camera configs to static directory
@@ -91,66 +111,187 @@ def camera_config(name=None):
         return flask.make_response(flask.jsonify(None), 200)
 
 
-@app.route("/cameras", methods=["GET"])
-@app.route("/cameras/", methods=["GET"])
-@app.route("/cameras/<date>", methods=["GET"])
-def camera_list(date=None):
+def parse_day(date):
+    """Return (datetime, YYYY-MM-DD) for a date string (None for today)"""
     if date is None:
         date = datetime.datetime.now()
-        day = date.strftime('%Y-%m-%d')
-    else:
-        day = date
-        try:
-            date = datetime.datetime.fromisoformat(date)
-        except ValueError:
-            return flask.abort(400)
+        return date, date.strftime('%Y-%m-%d')
+    return datetime.datetime.fromisoformat(date), date
+
 
-    ts = date.strftime('%y%m%d')
+def detections_directory(name, date):
+    return os.path.join(
+        grabber.data_dir, 'detections', name, date.strftime('%y%m%d'))
 
-    # load config key=ip, value=name [or False if not a camera]
-    #cfg = discover.load_cascaded_config()
-    #ips_to_names = {k: cfg[k] for k in cfg if isinstance(cfg[k], str)}
 
-    # get systemd status and uptime of all ips
-    #service_states = discover.status_of_all_camera_services()
+# configs by name: (modified time, config)
+config_cache = {}
+
+
+def cached_config(name, default=None):
+    """Load a config only if it was modified since the last load"""
+    mtime = config.get_modified_time(name)
+    if mtime is not None and name in config_cache:
+        cached_mtime, cfg = config_cache[name]
+        if cached_mtime == mtime:
+            return cfg
+    cfg = config.load_config(name, default)
+    if mtime is not None:
+        config_cache[name] = (mtime, cfg)
+    return cfg
+
+
+def configured_cameras(cfg):
+    """Return [(ip, name), ...] of configured cameras in a discover
+    result sorted by name (then ip), name is None if it's unknown"""
+    cams = [
+        (ip, cfg[ip]['name']) for ip in cfg
+        if cfg[ip]['is_camera'] and cfg[ip]['is_configured']]
+    return sorted(cams, key=lambda c: (c[1] is None, c[1] or '', c[0]))
+
+
+def query_int(key, default=None, minimum=0):
+    value = flask.request.args.get(key, None)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        return flask.abort(400)
+    if value < minimum:
+        return flask.abort(400)
+    return value
+
+
+def not_modified(etag):
+    """Return a 304 response if the client has etag (else None)"""
+    if flask.request.if_none_match.contains_weak(etag):
+        resp = flask.make_response('', 304)
+        resp.set_etag(etag, weak=True)
+        return resp
+    return None
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+@app.route("/cameras", methods=["GET"])
+@app.route("/cameras/", methods=["GET"])
+@app.route("/cameras/<date>", methods=["GET"])
+def camera_list(date=None):
+    """List cameras (sorted by name) with detections for a day
 
-    detections_path = os.path.join(grabber.data_dir, 'detections')
+    query args:
+    - detections: number of most recent detections per camera
+      (default n_recent_detections, see /detections for the rest)
+    - page & per_page: return only 1 page of cameras (all by default)
+      the total number of cameras is in the X-Total-Count header
+    """
+    try:
+        date, day = parse_day(date)
+    except ValueError:
+        return flask.abort(400)
+    n_recent = query_int('detections', n_recent_detections)
+    per_page = query_int('per_page', None, 1)
+    page = query_int('page', 0)
 
     # load last 'discover' result
-    cfg = config.load_config(discover.cfg_name, {})
-    
-    cams = []
-    #for ip in ips_to_names:
-    for ip in cfg:
-        if not cfg[ip]['is_camera'] or not cfg[ip]['is_configured']:
+    cfg = cached_config(discover.cfg_name, {})
+    # keyed by ip (names might be missing or shared)
+    cameras = configured_cameras(cfg)
+    n_cameras = len(cameras)
+    if per_page is not None:
+        cameras = cameras[page * per_page:(page + 1) * per_page]
+
+    # detections and config of each camera, listed from the index
+    index = fileindex.get_index()
+    summaries = {}
+    tag_parts = [
+        config.get_modified_time(discover.cfg_name), day, n_recent,
+        per_page, page]
+    for ip, name in cameras:
+        if name is None:
+            summaries[ip] = (0, 0, [])
             continue
-        #s = service_states.get(ip, {})
+        summaries[ip] = index.summary(
+            detections_directory(name, date), n_recent)
+        tag_parts.append((
+            ip, name, summaries[ip][:2], config.get_modified_time(name)))
+    etag = make_etag(*tag_parts)
+    resp = not_modified(etag)
+    if resp is not None:
+        return resp
+
+    cams = []
+    for ip, name in cameras:
         s = cfg[ip]['service']
-        #name = ips_to_names[ip]
-        name = cfg[ip]['name']
-        detections = sorted(glob.glob(os.path.join(
-            detections_path,
-            name,
-            ts,
-            '*',
-        )))
+        n, _, recent = summaries[ip]
+        if name is None:
+            detections = []
+            cam_cfg = None
+        else:
+            ddir = detections_directory(name, date)
+            detections = [os.path.join(ddir, fn) for fn in recent]
+            cam_cfg = cached_config(name)
         cams.append({
             'day': day,
             'ip': ip,
             'name': name,
             'active': s.get('Active', False),
             'uptime': s.get('Uptime', -1),
+            'n_detections': n,
             'detections': detections,
-            'cfg': config.load_config(name),
+            'cfg': cam_cfg,
         })
-    cams.sort(key=lambda c: c['name'])
-    return flask.jsonify(cams)
+    resp = flask.jsonify(cams)
+    resp.set_etag(etag, weak=True)
+    resp.headers['X-Total-Count'] = str(n_cameras)
+    return resp
+
+
+@app.route("/detections/<name>", methods=["GET"])
+@app.route("/detections/<name>/", methods=["GET"])
+@app.route("/detections/<name>/<date>", methods=["GET"])
+def detection_list(name, date=None):
+    """Page through detections for 1 camera and day
+
+    query args: offset (default 0) and limit (default all)
+    """
+    cfg = cached_config(discover.cfg_name, {})
+    if name not in {n for _, n in configured_cameras(cfg)}:
+        return flask.abort(404)
+    try:
+        date, day = parse_day(date)
+    except ValueError:
+        return flask.abort(400)
+    offset = query_int('offset', 0)
+    limit = query_int('limit', None)
+    ddir = detections_directory(name, date)
+    index = fileindex.get_index()
+    n, digest, _ = index.summary(ddir, 0)
+    etag = make_etag(name, day, n, digest, offset, limit)
+    resp = not_modified(etag)
+    if resp is not None:
+        return resp
+    n, fns = index.page(ddir, offset, limit)
+    resp = flask.jsonify({
+        'day': day,
+        'name': name,
+        'total': n,
+        'offset': offset,
+        'detections': [os.path.join(ddir, fn) for fn in fns],
+    })
+    resp.set_etag(etag, weak=True)
+    return resp
 
 
 @app.route("/snapshot/<name>", methods=["GET"])
 @app.route("/snapshot/<name>/", methods=["GET"])
 @app.route("/snapshot/<name>/<date>", methods=["GET"])
 def snapshot(name, date=None):
+    """Return the snapshot for a date (the most recent if no time is given
+    and the date is today), ?width=N returns a N pixel wide thumbnail"""
     most_recent = True
     if date is None:
         date = datetime.datetime.now()
@@ -170,14 +311,90 @@ def snapshot(name, date=None):
         name,
         date.strftime('%Y-%m-%d'),
         'pic_001')
+    # look up from the (inotify updated) index instead of listing the day
+    index = fileindex.get_index()
     if most_recent:
-        fn_glob = os.path.join(path, '*.jpg')
+        fn = index.last_matching(path, suffix='.jpg')
+    else:
+        fn = index.last_matching(path, date.strftime('%H.%M'), '.jpg')
+    if fn is None:
+        return flask.abort(404)
+    fn = os.path.join(path, fn)
+    try:
+        key = thumbnails.file_key(fn)
+    except OSError:  # removed since indexed
+        return flask.abort(404)
+
+    width = query_int('width', None, 1)
+    if width is None:
+        # sent by nginx (or flask) which handles conditional requests
+        resp = media.send_media(fn, grabber.data_dir, 'image/jpg')
     else:
-        fn_glob = os.path.join(path, date.strftime('%H.%M') + '*.jpg')
-    fns = sorted(glob.glob(fn_glob))
-    if len(fns) == 0:
+        width = thumbnails.clamp_width(width)
+        etag = thumbnails.make_etag(key, width)
+        resp = not_modified(etag)
+        if resp is None:
+            data, etag = get_thumbnails().get(fn, width)
+            resp = flask.make_response(data)
+            resp.mimetype = 'image/jpg'
+            resp.set_etag(etag, weak=True)
+            resp.last_modified = key[1] / 1e9
+    # the most recent snapshot changes, always revalidate
+    resp.cache_control.no_cache = True
+    return resp
+
+
+@app.route("/media/<path:path>", methods=["GET"])
+def media_file(path):
+    """Any file in data_dir (videos...) with byte range support"""
+    return media.send_media(path, grabber.data_dir)
+
+
+@app.route("/preview/<name>", methods=["GET"])
+def live_preview(name):
+    """Live (mjpeg) preview from a grabber, <name>.jpg for 1 frame
+
+    nginx proxies these straight to the grabber (see pcam-ui.nginx) so
+    this is only used without nginx (flask development server)
+    """
+    path = '/preview'
+    if name.endswith('.jpg'):
+        name = name[:-4]
+        path = '/preview.jpg'
+    sock = os.path.join(grabber.metrics_dir, '%s.sock' % name)
+    if os.path.dirname(sock) != grabber.metrics_dir:
+        return flask.abort(404)
+    try:
+        resp = preview.open_preview(sock, path)
+    except OSError:
         return flask.abort(404)
-    return flask.send_file(fns[-1], mimetype='image/jpg')
+    if resp.status != 200:
+        resp.close()
+        return flask.abort(resp.status)
+
+    def stream():
+        try:
+            while True:
+                b = resp.read1(65536)
+                if not b:
+                    break
+                yield b
+        finally:
+            resp.close()
+
+    return flask.Response(
+        stream(), content_type=resp.getheader('Content-Type'),
+        headers={'Cache-Control': 'no-cache'})
+
+
+_thumbnails = None
+
+
+def get_thumbnails():
+    global _thumbnails
+    if _thumbnails is None:
+        _thumbnails = thumbnails.ThumbnailCache()
+    return _thumbnails
 
 
 def run_ui(**kwargs):
@@ -1,16 +1,40 @@
+"""
+Generate daily overview (timelapse) videos from camera snapshots
 
+By default, generates overviews for yesterday. To backfill, provide a
+number of days (-n) or a start date (-s) [and end date (-e)].
+Encoding jobs (1 per camera per day) are run in a bounded pool (-j).
+Days with an existing overview newer than all snapshots are skipped
+(unless forced with -f). Overviews are written to a temporary file and
+renamed when complete so a partial overview is never left behind.
+"""
+
+import argparse
+import concurrent.futures
 import datetime
 import os
 import subprocess
+import threading
+import time
 
 
 ddir = '/mnt/data'
 odir = os.path.join(ddir, 'overviews')
 delta_hours = -24
-cmd_string = (
-    "ffmpeg -framerate 30 -f image2 -pattern_type glob -i '*.jpg' "
-    "-vf scale=640:-1 -codec h264_omx -profile:v high -b:v 3200k "
-    "{output_filename}")
+
+# encoders in order of preference, with encoder specific options
+encoders = [
+    ('h264_omx', ['-profile:v', 'high', '-b:v', '3200k']),
+    ('h264_v4l2m2m', ['-b:v', '3200k']),
+    ('libx264', ['-preset', 'veryfast', '-b:v', '3200k']),
+]
+
+print_lock = threading.Lock()
+
+
+def log(msg):
+    with print_lock:
+        print(msg, flush=True)
 
 
 def is_name(n):
@@ -24,31 +48,165 @@ def is_name(n):
     return False
 
 
-# for yesterday
-td = datetime.timedelta(hours=delta_hours)
-dt = datetime.datetime.now() + td
-ts = dt.strftime('%Y-%m-%d')
-print("Processing overviews for %s" % ts)
-names = [n for n in os.listdir(ddir) if is_name(n)]
-results = {}
-for n in names:
-    idir = os.path.join(ddir, n, ts, 'pic_001')
-    if not os.path.exists(idir):
-        print("No images for %s, skipping" % n)
-        continue
-
-    # make output filename
-    fn = os.path.join(odir, n, '%s_%s.mp4' % (n, ts))
+def encoder_works(encoder, options):
+    """Try encoding a few test frames, listed encoders might not work"""
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'testsrc=size=640x480:rate=30:duration=0.2',
+        '-codec', encoder, '-pix_fmt', 'yuv420p'] + options + [
+        '-f', 'null', '-']
+    try:
+        r = subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return r.returncode == 0
+
+
+def detect_encoder(name=None):
+    """Return (encoder, options) for the first working encoder"""
+    for encoder, options in encoders:
+        if name is not None and encoder != name:
+            continue
+        if encoder_works(encoder, options):
+            return encoder, options
+        log("Encoder %s not available" % encoder)
+    raise Exception("No working encoder found")
+
+
+def find_jobs(dates, force=False):
+    """Find (name, date, image directory, output filename, n images)
+    for all cameras and dates that need an overview"""
+    names = sorted(n for n in os.listdir(ddir) if is_name(n))
+    jobs = []
+    for ts in dates:
+        for n in names:
+            idir = os.path.join(ddir, n, ts, 'pic_001')
+            if not os.path.exists(idir):
+                log("No images for %s %s, skipping" % (n, ts))
+                continue
+            n_images = 0
+            input_mtime = os.path.getmtime(idir)
+            with os.scandir(idir) as it:
+                for e in it:
+                    if not e.name.endswith('.jpg'):
+                        continue
+                    n_images += 1
+                    input_mtime = max(input_mtime, e.stat().st_mtime)
+            if n_images == 0:
+                log("No images for %s %s, skipping" % (n, ts))
+                continue
+
+            # make output filename
+            fn = os.path.join(odir, n, '%s_%s.mp4' % (n, ts))
+            if (
+                    not force and os.path.exists(fn) and
+                    os.path.getmtime(fn) > input_mtime):
+                log("Overview %s is up to date, skipping" % fn)
+                continue
+            jobs.append((n, ts, idir, fn, n_images))
+    return jobs
+
+
+def generate_overview(job, encoder, options):
+    n, ts, idir, fn, n_images = job
     dn = os.path.dirname(fn)
     if not os.path.exists(dn):
-        os.makedirs(dn)
-    print("Generating %s" % fn)
-    cmd = cmd_string.format(output_filename=fn)
-    # run in shell and cmd not as list to allow wildcard
-    r = subprocess.run(cmd, cwd=idir, shell=True)
-    print("Overview finished with %s" % r.returncode)
-    results[n] = r.returncode
-
-print("Overview generation finished")
-for n in results:
-    print("\t%s: %s" % (n, results[n]))
+        os.makedirs(dn, exist_ok=True)
+    tfn = fn + '.partial'
+    # ffmpeg expands the glob (no shell needed)
+    cmd = [
+        'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+        '-framerate', '30', '-f', 'image2', '-pattern_type', 'glob',
+        '-i', '*.jpg', '-vf', 'scale=640:-2', '-codec', encoder,
+        '-pix_fmt', 'yuv420p'] + options + ['-f', 'mp4', tfn]
+    log("Generating %s [%s images]" % (fn, n_images))
+    t0 = time.monotonic()
+    r = subprocess.run(cmd, cwd=idir)
+    dt = time.monotonic() - t0
+    if r.returncode == 0:
+        os.replace(tfn, fn)
+        log(
+            "Overview %s finished in %0.1f seconds: "
+            "%0.1f frames/second, %0.1f MB" % (
+                fn, dt, n_images / dt, os.path.getsize(fn) / 1e6))
+    else:
+        if os.path.exists(tfn):
+            os.remove(tfn)
+        log("Overview %s failed with %s" % (fn, r.returncode))
+    return r.returncode
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-e', '--end', type=str, default=None,
+        help='last date (YYYY-MM-DD) to process (default yesterday)')
+    parser.add_argument(
+        '-E', '--encoder', type=str, default=None,
+        help='encoder to use (default first working of %s)' % (
+            ', '.join(e[0] for e in encoders)))
+    parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='regenerate up-to-date overviews')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=2,
+        help='number of encoding jobs to run at once')
+    parser.add_argument(
+        '-n', '--ndays', type=int, default=1,
+        help='number of days (ending at end) to process')
+    parser.add_argument(
+        '-s', '--start', type=str, default=None,
+        help='first date (YYYY-MM-DD) to process (overrides ndays)')
+    args = parser.parse_args()
+
+    if args.end is None:
+        end = (
+            datetime.datetime.now() +
+            datetime.timedelta(hours=delta_hours)).date()
+    else:
+        end = datetime.date.fromisoformat(args.end)
+    if args.start is None:
+        start = end - datetime.timedelta(days=args.ndays - 1)
+    else:
+        start = datetime.date.fromisoformat(args.start)
+    dates = []
+    d = start
+    while d <= end:
+        dates.append(d.strftime('%Y-%m-%d'))
+        d += datetime.timedelta(days=1)
+    print("Processing overviews for %s to %s" % (dates[0], dates[-1]))
+
+    jobs = find_jobs(dates, args.force)
+    if len(jobs) == 0:
+        print("No overviews to generate")
+        return
+    encoder, options = detect_encoder(args.encoder)
+    print("Generating %i overviews with %s using %i jobs" % (
+        len(jobs), encoder, args.jobs))
+
+    t0 = time.monotonic()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+        futures = {
+            pool.submit(generate_overview, job, encoder, options): job
+            for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            n, ts = futures[future][:2]
+            try:
+                results[(n, ts)] = future.result()
+            except Exception as e:
+                log("Overview for %s %s failed: %s" % (n, ts, e))
+                results[(n, ts)] = e
+    dt = time.monotonic() - t0
+
+    n_images = sum(job[4] for job in jobs)
+    print("Overview generation finished in %0.1f seconds [%0.1f frames/second]" % (
+        dt, n_images / dt))
+    for k in sorted(results):
+        print("\t%s %s: %s" % (k[0], k[1], results[k]))
+
+
+if __name__ == '__main__':
+    cmdline_run()
@@ -14,4 +14,4 @@ if [ ! -d "/dev/shm/pcam" ]; then
   chown pi /dev/shm/pcam
   chgrp pi /dev/shm/pcam
 fi
-python3 -m pollinatorcam discover -v -i $MY_IP/24
+exec python3 -m pollinatorcam discover -d -v -i $MY_IP/24